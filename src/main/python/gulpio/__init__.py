@@ -1,3 +1,4 @@
 __version__ = '$version'
 
 from .fileio import GulpDirectory, GulpChunk, ChunkWriter, GulpIngestor # noqa
+from .fileio import MultiGulpDirectory # noqa
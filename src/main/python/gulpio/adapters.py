@@ -13,6 +13,8 @@ from .utils import (get_single_video_path,
                     resize_images,
                     resize_by_short_edge,
                     burst_video_into_frames,
+                    read_video_frames,
+                    load_encoded_image,
                     temp_dir_for_bursting,
                     ImageNotFound,
                     )
@@ -26,7 +28,11 @@ class AbstractDatasetAdapter(ABC):  # pragma: no cover
     dictionary with the following fields:
 
         id     : a unique(?) ID for the element.
-        frames : a list of frames (PIL images, numpy arrays..)
+        frames : a list or an iterator of frames (PIL images, numpy
+                 arrays.., or the bytes of JPEG files, which are stored
+                 without re-encoding). Iterators are consumed while writing,
+                 so frames can be decoded lazily and long videos never have
+                 to be held in memory.
         meta   : a dictionary with arbitrary metadata (labels, start_time...)
 
     For examples, see the custom adapters below.
@@ -72,11 +78,17 @@ class Custom20BNAdapterMixin(object):
 
 class Custom20BNJsonVideoAdapter(AbstractDatasetAdapter,
                                  Custom20BNAdapterMixin):
-    """ Adapter for 20BN datasets specified by JSON file and MP4 videos. """
+    """ Adapter for 20BN datasets specified by JSON file and MP4 videos.
+
+    With `pipe_frames=True` the videos are decoded, resized and resampled by
+    ffmpeg and the frames are piped into memory, instead of bursting them as
+    JPEG files to `shm_dir_path` and reading them back.
+    """
 
     def __init__(self, json_file, folder, output_folder,
                  shuffle=False, frame_size=-1, frame_rate=8,
-                 shm_dir_path='/dev/shm', label_name='template'):
+                 shm_dir_path='/dev/shm', label_name='template',
+                 pipe_frames=False):
         self.json_file = json_file
         if json_file.endswith('.json.gz'):
             self.data = self.read_gz_json(json_file)
@@ -92,6 +104,7 @@ class Custom20BNJsonVideoAdapter(AbstractDatasetAdapter,
         self.frame_size = int(frame_size)
         self.frame_rate = int(frame_rate)
         self.shm_dir_path = shm_dir_path
+        self.pipe_frames = pipe_frames
         self.all_meta = self.get_meta()
         if self.shuffle:
             random.shuffle(self.all_meta)
@@ -120,24 +133,38 @@ class Custom20BNJsonVideoAdapter(AbstractDatasetAdapter,
         for meta in self.all_meta[slice_element]:
             video_folder = os.path.join(self.folder, str(meta['id']))
             video_path = get_single_video_path(video_folder, format_='mp4')
-            with temp_dir_for_bursting(self.shm_dir_path) as temp_burst_dir:
-                frame_paths = burst_video_into_frames(
-                    video_path, temp_burst_dir, frame_rate=self.frame_rate)
-                frames = list(resize_images(frame_paths, self.frame_size))
             result = {'meta': meta,
-                      'frames': frames,
+                      'frames': self.iter_frames(video_path),
                       'id': meta['id']}
             yield result
         else:
             self.write_label2idx_dict()
 
+    def iter_frames(self, video_path):
+        if self.pipe_frames:
+            yield from read_video_frames(video_path,
+                                         frame_rate=self.frame_rate,
+                                         img_size=self.frame_size)
+        else:
+            with temp_dir_for_bursting(self.shm_dir_path) as temp_burst_dir:
+                frame_paths = burst_video_into_frames(
+                    video_path, temp_burst_dir, frame_rate=self.frame_rate)
+                yield from resize_images(frame_paths, self.frame_size)
+
 
 class Custom20BNCsvJpegAdapter(AbstractDatasetAdapter,
                                Custom20BNAdapterMixin):
-    """ Adapter for 20BN datasets specified by CSV file and JPEG frames. """
+    """ Adapter for 20BN datasets specified by CSV file and JPEG frames.
+
+    With `jpeg_passthrough=True` and no resizing (`frame_size` -1) the JPEG
+    files are stored as they are, without decoding and re-encoding.
+    Truncated JPEG files are re-encoded. With `validate_jpeg=True` every
+    JPEG file is decoded once and the video fails if that is not possible.
+    """
 
     def __init__(self, csv_file, folder, output_folder,
-                 shuffle=False, frame_size=-1, shm_dir_path='/dev/shm'):
+                 shuffle=False, frame_size=-1, shm_dir_path='/dev/shm',
+                 jpeg_passthrough=False, validate_jpeg=False):
         self.data = self.read_csv(csv_file)
         self.output_folder = output_folder
         self.labels2idx = self.create_label2idx_dict('label')
@@ -145,6 +172,8 @@ class Custom20BNCsvJpegAdapter(AbstractDatasetAdapter,
         self.shuffle = shuffle
         self.frame_size = frame_size
         self.shm_dir_path = shm_dir_path
+        self.jpeg_passthrough = jpeg_passthrough
+        self.validate_jpeg = validate_jpeg
         self.all_meta = self.get_meta()
         if self.shuffle:
             random.shuffle(self.all_meta)
@@ -171,7 +200,11 @@ class Custom20BNCsvJpegAdapter(AbstractDatasetAdapter,
         for meta in self.all_meta[slice_element]:
             video_folder = os.path.join(self.folder, str(meta['id']))
             frame_paths = find_images_in_folder(video_folder, formats=['jpg'])
-            frames = list(resize_images(frame_paths, self.frame_size))
+            if self.jpeg_passthrough and self.frame_size < 1:
+                frames = (load_encoded_image(p, self.validate_jpeg)
+                          for p in frame_paths)
+            else:
+                frames = resize_images(frame_paths, self.frame_size)
             result = {'meta': meta,
                       'frames': frames,
                       'id': meta['id']}
@@ -187,10 +220,16 @@ class ImageListAdapter(AbstractDatasetAdapter):
         ...
 
         and it iterates through images/
+
+    With `jpeg_passthrough=True` and no resizing (`img_size` -1) JPEG files
+    are stored as they are, without decoding and re-encoding. Truncated
+    JPEG files are re-encoded. With `validate_jpeg=True` every JPEG file is
+    decoded once and treated as unreadable if that is not possible.
     """
 
     def __init__(self, input_file, output_folder, root_folder='',
-                 shuffle=False, img_size=-1):
+                 shuffle=False, img_size=-1, jpeg_passthrough=False,
+                 validate_jpeg=False):
         self.input_file = input_file
         self.output_folder = output_folder
         self.root_folder = root_folder
@@ -199,6 +238,8 @@ class ImageListAdapter(AbstractDatasetAdapter):
         self.label2idx = self.create_label2idx_dict()
         self.shuffle = shuffle
         self.img_size = img_size
+        self.jpeg_passthrough = jpeg_passthrough
+        self.validate_jpeg = validate_jpeg
         self.all_meta = self.get_meta()
         if self.shuffle:
             random.shuffle(self.all_meta)
@@ -232,13 +273,17 @@ class ImageListAdapter(AbstractDatasetAdapter):
                   open(os.path.join(self.output_folder, 'label2idx.json'),
                        'w'))
 
+    def read_image(self, img_path):
+        if self.jpeg_passthrough and self.img_size < 1:
+            return load_encoded_image(img_path, self.validate_jpeg)
+        return resize_by_short_edge(img_path, self.img_size)
+
     def iter_data(self, slice_element=None):
         slice_element = slice_element or slice(0, len(self))
-        self.all_meta = self.all_meta[slice_element]
-        for meta in self.all_meta:
+        for meta in self.all_meta[slice_element]:
             img_path = os.path.join(self.root_folder, str(meta['path']))
             try:
-                img = resize_by_short_edge(img_path, self.img_size)
+                img = self.read_image(img_path)
             except ImageNotFound as e:
                 print(e)
                 continue  # skip the item if image is not readable
@@ -254,11 +299,17 @@ class ImageListAdapter(AbstractDatasetAdapter):
 class ImageFolderAdapter(AbstractDatasetAdapter):
     r"""Parse the given folder assuming each subfolder is a category and it
     includes the category images.
+
+    With `jpeg_passthrough=True` and no resizing (`img_size` -1) JPEG files
+    are stored as they are, without decoding and re-encoding. Truncated
+    JPEG files are re-encoded. With `validate_jpeg=True` every JPEG file is
+    decoded once and treated as unreadable if that is not possible.
     """
 
     def __init__(self, folder, output_folder,
                  file_extensions=['.jpg', '.png'], shuffle=False,
-                 img_size=-1):
+                 img_size=-1, jpeg_passthrough=False,
+                 validate_jpeg=False):
         self.file_extensions = file_extensions
         self.data = self.parse_folder(folder)
         self.output_folder = output_folder
@@ -266,6 +317,8 @@ class ImageFolderAdapter(AbstractDatasetAdapter):
         self.folder = folder
         self.shuffle = shuffle
         self.img_size = img_size
+        self.jpeg_passthrough = jpeg_passthrough
+        self.validate_jpeg = validate_jpeg
         self.all_meta = self.get_meta()
         if self.shuffle:
             random.shuffle(self.all_meta)
@@ -307,11 +360,16 @@ class ImageFolderAdapter(AbstractDatasetAdapter):
                   open(os.path.join(self.output_folder, 'label2idx.json'),
                        'w'))
 
+    def read_image(self, img_path):
+        if self.jpeg_passthrough and self.img_size < 1:
+            return load_encoded_image(img_path, self.validate_jpeg)
+        return resize_by_short_edge(img_path, self.img_size)
+
     def iter_data(self, slice_element=None):
         slice_element = slice_element or slice(0, len(self))
         for meta in self.all_meta[slice_element]:
             img_path = os.path.join(str(meta['path']), str(meta['id']))
-            img = resize_by_short_edge(img_path, self.img_size)
+            img = self.read_image(img_path)
             result = {'meta': meta,
                       'frames': [img],
                       'id': meta['id']}
@@ -329,22 +387,27 @@ class ActivitynetAdapter(AbstractDatasetAdapter):
     where
       vid: video id that was assigned by youtube
       ext: file extensions
+    With `pipe_frames=True` frames are piped from ffmpeg instead of being
+    bursted to `shm_dir_path`.
     """
 
     def __init__(self, json_file, folder,
                  shuffle=False, frame_size=-1,
-                 shm_dir_path='/dev/shm', phase='training'):
+                 shm_dir_path='/dev/shm', phase='training',
+                 pipe_frames=False):
         self.json_file = json_file
         self.json_storage = self.read_json(json_file)
         self.folder = folder
         self.set_video_storage(phase)
         self.frame_size = frame_size
         self.shm_dir_path = shm_dir_path
+        self.pipe_frames = pipe_frames
+        self.shuffle = shuffle
         if shuffle:
             random.shuffle(self.vid_storage)
 
     def set_video_storage(self, phase='training'):
-        self.vid_storage = [f for f in os.listdir(self.folder)
+        self.vid_storage = [f for f in sorted(os.listdir(self.folder))
                             if (os.path.isfile(os.path.join(self.folder, f))
                             and (not f.endswith('part'))
                             and (f.split('.')[0] in self.json_storage.keys())
@@ -360,17 +423,22 @@ class ActivitynetAdapter(AbstractDatasetAdapter):
         return len(self.vid_storage)
 
     def get_bursted_frames(self, vid_file):
+        return list(self.iter_frames(vid_file))
+
+    def iter_frames(self, vid_file):
         vid_file = os.path.join(self.folder, vid_file)
-        with temp_dir_for_bursting(self.shm_dir_path) as temp_burst_dir:
-            frame_paths = burst_video_into_frames(vid_file,
-                                                  temp_burst_dir)
-            frames = list(resize_images(frame_paths, self.frame_size))
-        return frames
+        if self.pipe_frames:
+            yield from read_video_frames(vid_file, img_size=self.frame_size)
+        else:
+            with temp_dir_for_bursting(self.shm_dir_path) as temp_burst_dir:
+                frame_paths = burst_video_into_frames(vid_file,
+                                                      temp_burst_dir)
+                yield from resize_images(frame_paths, self.frame_size)
 
     def iter_data(self, slice_element=None):
         slice_element = slice_element or slice(0, len(self))
         for vid_file in self.vid_storage[slice_element]:
-            frames = self.get_bursted_frames(vid_file)
+            frames = self.iter_frames(vid_file)
             vid_id = vid_file.split('.')[0]
             meta = self.json_storage[vid_id]
             result = {'meta': meta,
@@ -391,22 +459,27 @@ class KineticsAdapter(AbstractDatasetAdapter):
              in 6 digit-second
       end: the end of trimming in the original youtube video
              in 6 digit-second
+    With `pipe_frames=True` frames are piped from ffmpeg instead of being
+    bursted to `shm_dir_path`.
     """
     def __init__(self, json_file, folder,
                  shuffle=False, frame_size=-1,
-                 shm_dir_path='/dev/shm'):
+                 shm_dir_path='/dev/shm', pipe_frames=False):
         self.json_file = json_file
         self.json_storage = self.read_json(json_file)
         self.folder = folder
         self.set_video_storage()
         self.frame_size = frame_size
         self.shm_dir_path = shm_dir_path
+        self.pipe_frames = pipe_frames
+        self.shuffle = shuffle
         if shuffle:
             random.shuffle(self.vid_storage)
 
     def set_video_storage(self):
         self.vid_storage = []
-        self.vid_storage.extend(glob.glob(os.path.join(self.folder, '*/*.mp4')))
+        self.vid_storage.extend(
+            sorted(glob.glob(os.path.join(self.folder, '*/*.mp4'))))
 
     def read_json(self, json_file):
         with open(json_file, 'r') as f:
@@ -417,17 +490,22 @@ class KineticsAdapter(AbstractDatasetAdapter):
         return len(self.vid_storage)
 
     def get_bursted_frames(self, vid_file):
+        return list(self.iter_frames(vid_file))
+
+    def iter_frames(self, vid_file):
         vid_file = os.path.join(self.folder, vid_file)
-        with temp_dir_for_bursting(self.shm_dir_path) as temp_burst_dir:
-            frame_paths = burst_video_into_frames(vid_file,
-                                                  temp_burst_dir)
-            frames = list(resize_images(frame_paths, self.frame_size))
-        return frames
+        if self.pipe_frames:
+            yield from read_video_frames(vid_file, img_size=self.frame_size)
+        else:
+            with temp_dir_for_bursting(self.shm_dir_path) as temp_burst_dir:
+                frame_paths = burst_video_into_frames(vid_file,
+                                                      temp_burst_dir)
+                yield from resize_images(frame_paths, self.frame_size)
 
     def iter_data(self, slice_element=None):
         slice_element = slice_element or slice(0, len(self))
         for vid_file in self.vid_storage[slice_element]:
-            frames = self.get_bursted_frames(vid_file)
+            frames = self.iter_frames(vid_file)
             # this is due to current file names of trimmed videos
             vid_id = vid_file.split('/')[-1].split('_00')[0]
             meta = self.json_storage[vid_id]
@@ -0,0 +1,181 @@
+"""Micro-benchmarks for the transforms in `gulpio.transforms`.
+
+Every transform runs on synthetic uint8 data of a configurable size. Per
+call latency, throughput in frames per second and the memory allocated by
+a call (measured with `tracemalloc`) are reported as a JSON serializable
+dict, so that results of different versions can be compared.
+"""
+
+import sys
+import time
+import platform
+import tracemalloc
+
+import cv2
+import numpy as np
+
+from . import __version__
+from . import transforms as T
+
+
+# input kinds: a single frame, a list of frames, a stacked clip
+# (T, H, W, C) and a collated batch (B, T, H, W, C)
+KINDS = ('image', 'video', 'clip', 'batch')
+
+MEAN, STD = [123., 117., 104.], [58., 57., 57.]
+
+
+def default_transforms(height, width):
+    """ Return (name, input kind, transform) for every transform class in
+    `gulpio.transforms`, configured for frames of size (height, width). """
+    crop = min(height, width) * 7 // 8
+    small = min(height, width) // 2
+    jitter = [crop, crop * 7 // 8, crop * 3 // 4]
+    return [
+        ('Compose', 'image',
+         T.Compose([T.CenterCrop(crop), T.Normalize(MEAN, STD)])),
+        ('ComposeVideo', 'video',
+         T.ComposeVideo([T.Normalize(MEAN, STD)],
+                        [T.RandHorFlipVideo(), T.RandomCropVideo(crop)])),
+        ('RandHorFlipVideo', 'video', T.RandHorFlipVideo()),
+        ('RandVerFlipVideo', 'video', T.RandVerFlipVideo()),
+        ('Normalize', 'image', T.Normalize(MEAN, STD)),
+        ('UnitNorm', 'image', T.UnitNorm()),
+        ('CenterCrop', 'image', T.CenterCrop(crop)),
+        ('RandomCrop', 'image', T.RandomCrop(crop)),
+        ('RandomCropVideo', 'video', T.RandomCropVideo(crop)),
+        ('JitterCrop', 'image', T.JitterCrop(jitter)),
+        ('JitterCropVideo', 'video', T.JitterCropVideo(jitter)),
+        ('Scale', 'image', T.Scale(small)),
+        ('CropResizeNormalize', 'image',
+         T.CropResizeNormalize(small, MEAN, STD, crop_size=crop)),
+        ('RandHorFlipClip', 'clip', T.RandHorFlipClip()),
+        ('RandVerFlipClip', 'clip', T.RandVerFlipClip()),
+        ('CenterCropClip', 'clip', T.CenterCropClip(crop)),
+        ('RandomCropClip', 'clip', T.RandomCropClip(crop)),
+        ('JitterCropClip', 'clip', T.JitterCropClip(jitter)),
+        ('ScaleClip', 'clip', T.ScaleClip(small)),
+        ('MultiCropClip', 'clip', T.MultiCropClip(crop)),
+        ('RandHorFlipBatch', 'batch', T.RandHorFlipBatch()),
+        ('RandVerFlipBatch', 'batch', T.RandVerFlipBatch()),
+        ('CenterCropBatch', 'batch', T.CenterCropBatch(crop)),
+        ('RandomCropBatch', 'batch', T.RandomCropBatch(crop)),
+        ('NormalizeBatch', 'batch', T.NormalizeBatch(MEAN, STD)),
+        ('DecodeCrop', 'video', T.DecodeCrop(crop, size=small)),
+    ]
+
+
+def make_input(kind, height, width, num_frames, batch_size, seed=0):
+    """ Create random uint8 input of the given kind. """
+    rng = np.random.RandomState(seed)
+    shape = {'image': (height, width, 3),
+             'video': (num_frames, height, width, 3),
+             'clip': (num_frames, height, width, 3),
+             'batch': (batch_size, num_frames, height, width, 3)}[kind]
+    data = rng.randint(0, 256, shape).astype('uint8')
+    if kind == 'video':
+        return list(data)
+    return data
+
+
+def _fresh(data):
+    # transforms may replace the frames of a video list, not its arrays
+    return list(data) if isinstance(data, list) else data
+
+
+def _frames_per_call(kind, num_frames, batch_size):
+    return {'image': 1, 'video': num_frames, 'clip': num_frames,
+            'batch': batch_size * num_frames}[kind]
+
+
+def measure_allocations(transform, data):
+    """ Return (peak, retained) bytes allocated during one call. """
+    data = _fresh(data)
+    tracemalloc.start()
+    try:
+        result = transform(data)
+        retained, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del result
+    return peak, retained
+
+
+def benchmark_transform(transform, data, frames_per_call=1, repeat=20,
+                        warmup=2):
+    """ Time `repeat` calls of a transform on (copies of the list of) data.
+
+    Returns a dict with the latency statistics in milliseconds, the
+    throughput in frames per second and the allocations of a call.
+    """
+    for _ in range(warmup):
+        transform(_fresh(data))
+    timings = []
+    for _ in range(repeat):
+        args = _fresh(data)
+        start = time.perf_counter()
+        transform(args)
+        timings.append(time.perf_counter() - start)
+    timings = np.array(timings) * 1000.
+    median = float(np.median(timings))
+    peak, retained = measure_allocations(transform, data)
+    return {'latency_ms': {'median': median,
+                           'mean': float(timings.mean()),
+                           'min': float(timings.min()),
+                           'p90': float(np.percentile(timings, 90))},
+            'frames_per_second': (frames_per_call * 1000. / median
+                                  if median > 0 else float('inf')),
+            'peak_alloc_bytes': peak,
+            'retained_bytes': retained,
+            }
+
+
+def run_benchmarks(height=256, width=340, num_frames=16, batch_size=8,
+                   repeat=20, warmup=2, names=None):
+    """ Benchmark all transforms of `default_transforms`, or only those in
+    `names`, and return the results together with the configuration. """
+    inputs = {}
+    results = []
+    for name, kind, transform in default_transforms(height, width):
+        if names is not None and name not in names:
+            continue
+        if kind not in inputs:
+            inputs[kind] = make_input(kind, height, width, num_frames,
+                                      batch_size)
+        frames = _frames_per_call(kind, num_frames, batch_size)
+        result = benchmark_transform(transform, inputs[kind], frames,
+                                     repeat=repeat, warmup=warmup)
+        result.update(name=name, kind=kind)
+        results.append(result)
+    return {'config': {'height': height,
+                       'width': width,
+                       'num_frames': num_frames,
+                       'batch_size': batch_size,
+                       'repeat': repeat,
+                       'gulpio': __version__,
+                       'numpy': np.__version__,
+                       'opencv': cv2.__version__,
+                       'python': sys.version.split()[0],
+                       'machine': platform.machine(),
+                       },
+            'results': results}
+
+
+def compare_results(baseline, current, threshold=0.2):
+    """ Compare the median latency of two benchmark reports.
+
+    Returns a list of (name, baseline ms, current ms, relative change) for
+    all transforms that got slower by more than `threshold`.
+    """
+    before = {r['name']: r['latency_ms']['median']
+              for r in baseline['results']}
+    regressions = []
+    for result in current['results']:
+        name = result['name']
+        if name not in before or before[name] <= 0:
+            continue
+        now = result['latency_ms']['median']
+        change = now / before[name] - 1.
+        if change > threshold:
+            regressions.append((name, before[name], now, change))
+    return regressions
@@ -1,22 +1,48 @@
 import os
 import numpy as np
 import json
-from .fileio import GulpDirectory
+from .fileio import GulpDirectory, MultiGulpDirectory
+from .transforms import defer_normalize as _defer_normalize
 
 
 class GulpIOEmptyFolder(Exception):  # pragma: no cover
         pass
 
 
+def load_gulp_directory(data_path):
+    """Open a GulpIO dataset folder, or several folders as one dataset.
+
+    Args:
+        data_path (str or list of str): path(s) to GulpIO dataset folder(s).
+    Returns:
+        gulp directory, list of (item key, item info), label2idx dict. For
+        several folders, item keys are global indices into a
+        `MultiGulpDirectory` and labels are merged by name.
+    """
+    if isinstance(data_path, str):
+        gd = GulpDirectory(data_path)
+        items = list(gd.merged_meta_dict.items())
+        label2idx = json.load(open(os.path.join(data_path,
+                                                'label2idx.json')))
+    else:
+        gd = MultiGulpDirectory(data_path)
+        items = list(enumerate(gd.item_infos()))
+        label2idx = gd.label2idx
+    return gd, items, label2idx
+
+
 class GulpVideoDataset(object):
 
     def __init__(self, data_path, num_frames, step_size,
                  is_val, transform=None, target_transform=None, stack=True,
-                 random_offset=True):
+                 random_offset=True, segment_sampling=False, num_clips=1,
+                 decode_crop=None, defer_normalize=False):
         r"""Simple data loader for GulpIO format.
 
             Args:
-                data_path (str): path to GulpIO dataset folder
+                data_path (str or list of str): path to GulpIO dataset
+            folder, or a list of paths to read several folders as one
+            dataset.
                 label_path (str): path to GulpIO label dictionary matching
             label ids to label names
                 num_frames (int): number of frames to be fetched.
@@ -30,12 +56,25 @@ class GulpVideoDataset(object):
                 stack (bool): stack frames into a numpy.array. Default is True.
                 random_offset (bool): random offsetting to pick frames, if
             number of frames are more than what is necessary.
+                segment_sampling (bool): split each video into `num_frames`
+            equally long segments and pick one frame per segment (a random
+            one in training, the central one in validation) instead of a
+            contiguous window. `step_size` is ignored. Default is False.
+                num_clips (int): number of clips sampled per video. If larger
+            than 1, the clips are returned as an extra leading dimension.
+            Default is 1.
+                decode_crop (DecodeCrop): crop and resize the frames while
+            decoding, before `transform` is applied. All frames of a video
+            get the same crop. Default is None.
+                defer_normalize (bool): remove the `Normalize` step from
+            `transform`, so clips stay uint8 through collation and transport,
+            and expose it as `batch_transform`, which `DataLoader` applies to
+            every batch in the main process. Default is False.
         """
 
-        self.gd = GulpDirectory(data_path)
-        self.items = list(self.gd.merged_meta_dict.items())
-        self.label2idx = json.load(open(os.path.join(data_path,
-                                                     'label2idx.json')))
+        if segment_sampling and num_frames < 1:
+            raise ValueError("segment_sampling requires num_frames > 0")
+        self.gd, self.items, self.label2idx = load_gulp_directory(data_path)
         self.num_chunks = self.gd.num_chunks
 
         if self.num_chunks == 0:
@@ -46,12 +85,57 @@ class GulpVideoDataset(object):
         self.data_path = data_path
         self.classes = self.label2idx.keys()
         self.transform_video = transform
+        self.batch_transform = None
+        if defer_normalize:
+            self.transform_video, self.batch_transform = \
+                _defer_normalize(transform)
         self.target_transform = target_transform
         self.num_frames = num_frames
         self.step_size = step_size
         self.is_val = is_val
         self.stack = stack
         self.random_offset = random_offset
+        self.segment_sampling = segment_sampling
+        self.num_clips = num_clips
+        self.decode_crop = decode_crop
+
+    def _window_indices(self, num_frames):
+        # set number of necessary frames
+        if self.num_frames > -1:
+            num_frames_necessary = self.num_frames * self.step_size
+        else:
+            num_frames_necessary = num_frames
+        offsets = np.zeros(self.num_clips, dtype='int64')
+        if num_frames_necessary < num_frames:
+            # If there are more frames, then sample starting offset.
+            diff = (num_frames - num_frames_necessary)
+            # temporal augmentation
+            if not self.is_val and self.random_offset:
+                offsets = np.random.randint(0, diff, size=self.num_clips)
+            elif self.num_clips > 1:
+                offsets = np.linspace(0, diff, self.num_clips).astype('int64')
+        indices = (offsets[:, np.newaxis] +
+                   np.arange(0, num_frames_necessary, self.step_size))
+        # pad with the last frame if video is shorter than necessary
+        return np.minimum(indices, num_frames - 1)
+
+    def _segment_indices(self, num_frames):
+        edges = np.linspace(0, num_frames, self.num_frames + 1)
+        if self.is_val:
+            positions = ((np.arange(self.num_clips) + 0.5) /
+                         self.num_clips)[:, np.newaxis]
+        else:
+            positions = np.random.rand(self.num_clips, self.num_frames)
+        indices = (edges[:-1] + positions * np.diff(edges)).astype('int64')
+        return np.minimum(indices, num_frames - 1)
+
+    def sample_indices(self, num_frames):
+        """Return the indices of the frames to be loaded from a video with
+        `num_frames` frames as an array of shape (num_clips, clip length).
+        """
+        if self.segment_sampling:
+            return self._segment_indices(num_frames)
+        return self._window_indices(num_frames)
 
     def __getitem__(self, index):
         """
@@ -63,35 +147,30 @@ class GulpVideoDataset(object):
 
         target_name = item_info['meta_data'][0]['label']
         target_idx = self.label2idx[target_name]
-        frames = item_info['frame_info']
-        num_frames = len(frames)
-        # set number of necessary frames
-        if self.num_frames > -1:
-            num_frames_necessary = self.num_frames * self.step_size
-        else:
-            num_frames_necessary = num_frames
-        offset = 0
-        if num_frames_necessary < num_frames and self.random_offset:
-            # If there are more frames, then sample starting offset.
-            diff = (num_frames - num_frames_necessary)
-            # temporal augmentation
-            if not self.is_val:
-                offset = np.random.randint(0, diff)
-        # set target frames to be loaded
-        frames_slice = slice(offset, num_frames_necessary + offset,
-                             self.step_size)
-        frames, meta = self.gd[item_id, frames_slice]
-        # padding last frame
-        if num_frames_necessary > num_frames:
-            # Pad last frame if video is shorter than necessary
-            frames.extend([frames[-1]] * (num_frames_necessary - num_frames))
-        # augmentation
-        if self.transform_video:
-            frames = self.transform_video(frames)
-        # format data to torch tensor
+        indices = self.sample_indices(len(item_info['frame_info']))
+        # every distinct frame is read once, in a single sorted pass
+        unique_indices, positions = np.unique(indices.ravel(),
+                                              return_inverse=True)
+        frames, meta = self.gd.fetch(item_id, unique_indices.tolist(),
+                                     decode_crop=self.decode_crop)
+        clips = []
+        for clip_positions in positions.reshape(indices.shape):
+            clip = [frames[p] for p in clip_positions]
+            # augmentation
+            if self.transform_video:
+                clip = self.transform_video(clip)
+            # format data to torch tensor
+            if isinstance(clip, np.ndarray):
+                # already stacked by clip transforms, resolve views
+                clip = np.ascontiguousarray(clip)
+            elif self.stack:
+                clip = np.stack(clip)
+            clips.append(clip)
+        if self.num_clips == 1:
+            return (clips[0], target_idx)
         if self.stack:
-            frames = np.stack(frames)
-        return (frames, target_idx)
+            clips = np.stack(clips)
+        return (clips, target_idx)
 
     def __len__(self):
         """
@@ -103,11 +182,14 @@ class GulpVideoDataset(object):
 class GulpImageDataset(object):
 
     def __init__(self, data_path, is_val=False, transform=None,
-                 target_transform=None):
+                 target_transform=None, decode_crop=None,
+                 defer_normalize=False):
         r"""Simple image data loader for GulpIO format.
 
             Args:
-                data_path (str): path to GulpIO dataset folder
+                data_path (str or list of str): path to GulpIO dataset
+            folder, or a list of paths to read several folders as one
+            dataset.
                 label_path (str): path to GulpIO label dictionary matching
             label ids to label names
                 is_va (bool): sets the necessary augmention procedure.
@@ -115,12 +197,13 @@ class GulpImageDataset(object):
             Compose(). Default is None.
                 target_transform (func): performs preprocessing on labels if
             defined. Default is None.
+                decode_crop (DecodeCrop): crop and resize the image while
+            decoding, before `transform` is applied. Default is None.
+                defer_normalize (bool): keep images uint8 and normalize
+            whole batches instead, see `GulpVideoDataset`. Default is False.
         """
 
-        self.gd = GulpDirectory(data_path)
-        self.items = list(self.gd.merged_meta_dict.items())
-        self.label2idx = json.load(open(os.path.join(data_path,
-                                                     'label2idx.json')))
+        self.gd, self.items, self.label2idx = load_gulp_directory(data_path)
         self.num_chunks = self.gd.num_chunks
 
         if self.num_chunks == 0:
@@ -131,8 +214,13 @@ class GulpImageDataset(object):
         self.data_path = data_path
         self.classes = self.label2idx.keys()
         self.transform = transform
+        self.batch_transform = None
+        if defer_normalize:
+            self.transform, self.batch_transform = \
+                _defer_normalize(transform)
         self.target_transform = target_transform
         self.is_val = is_val
+        self.decode_crop = decode_crop
 
     def __getitem__(self, index):
         """
@@ -147,7 +235,7 @@ class GulpImageDataset(object):
         img_rec = item_info['frame_info']
         assert len(img_rec) == 1
         # set number of necessary frames
-        img, meta = self.gd[item_id]
+        img, meta = self.gd.fetch(item_id, decode_crop=self.decode_crop)
         img = img[0]
         # augmentation
         if self.transform:
@@ -2,25 +2,56 @@
 
 import os
 import re
+import sys
 import cv2
 import pickle
 import json
 import glob
+import time
+import queue
+import shutil
+import struct
+import functools
+import threading
+import traceback
+import multiprocessing
 import numpy as np
 
 from abc import ABC, abstractmethod
-from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from contextlib import contextmanager
-from collections import namedtuple, OrderedDict
+from collections import namedtuple, OrderedDict, deque
 from tqdm import tqdm
 
-from .utils import ensure_output_dir_exists
+from .stats import (IngestionStats,
+                    active_stats,
+                    record_item,
+                    recording,
+                    timed,
+                    )
+from .utils import (ensure_output_dir_exists,
+                    get_jpeg_orientation,
+                    get_jpeg_size,
+                    is_complete_jpeg,
+                    parse_byte_size,
+                    parse_shard,
+                    )
 
 
 ImgInfo = namedtuple('ImgInfo', ['loc',
                                  'pad',
                                  'length'])
 
+# imdecode flags for (scale reduction, grayscale)
+_REDUCED_DECODE_FLAGS = {
+    (2, False): cv2.IMREAD_REDUCED_COLOR_2,
+    (4, False): cv2.IMREAD_REDUCED_COLOR_4,
+    (8, False): cv2.IMREAD_REDUCED_COLOR_8,
+    (2, True): cv2.IMREAD_REDUCED_GRAYSCALE_2,
+    (4, True): cv2.IMREAD_REDUCED_GRAYSCALE_4,
+    (8, True): cv2.IMREAD_REDUCED_GRAYSCALE_8,
+}
+
 
 class AbstractSerializer(ABC):  # pragma: no cover
 
@@ -32,6 +63,14 @@ class AbstractSerializer(ABC):  # pragma: no cover
     def dump(self, thing, file_name):
         pass
 
+    @abstractmethod
+    def loads(self, data):
+        pass
+
+    @abstractmethod
+    def dumps(self, thing):
+        pass
+
 
 class PickleSerializer(AbstractSerializer):
 
@@ -43,6 +82,12 @@ class PickleSerializer(AbstractSerializer):
         with open(file_name, 'wb') as file_pointer:
             pickle.dump(thing, file_pointer)
 
+    def loads(self, data):
+        return pickle.loads(data)
+
+    def dumps(self, thing):
+        return pickle.dumps(thing)
+
 
 class JSONSerializer(AbstractSerializer):
 
@@ -54,11 +99,36 @@ class JSONSerializer(AbstractSerializer):
         with open(file_name, 'w') as file_pointer:
             json.dump(thing, file_pointer)
 
+    def loads(self, data):
+        return json.loads(data, object_pairs_hook=OrderedDict)
+
+    def dumps(self, thing):
+        return json.dumps(thing).encode()
+
 
 pickle_serializer = PickleSerializer()
 json_serializer = JSONSerializer()
 
 
+def chunk_file_paths(output_dir, chunk_id):
+    """ Return the (data file, meta file) paths of a chunk. """
+    data_file_path = os.path.join(output_dir, 'data_{}.gulp'.format(chunk_id))
+    meta_file_path = os.path.join(output_dir, 'meta_{}.gmeta'.format(chunk_id))
+    return data_file_path, meta_file_path
+
+
+def journal_file_path(meta_file_path):
+    """ Return the path of the write journal that belongs to a meta file. """
+    return os.path.splitext(meta_file_path)[0] + '.gjournal'
+
+
+def _dump_atomic(serializer, thing, file_name):
+    """ Dump to a temporary file and move it into place, so that readers
+    and a crash in between never leave a partially written file. """
+    serializer.dump(thing, file_name + '.tmp')
+    os.replace(file_name + '.tmp', file_name)
+
+
 def extract_input_for_getitem(element):
     if isinstance(element, tuple) and len(element) == 2:
         id_, slice_ = element
@@ -80,6 +150,8 @@ class GulpDirectory(object):
 
     Attributes
     ----------
+    all_chunks: (list of GulpChunk)
+        All chunks, in the same order as `all_meta_dicts`.
     all_meta_dicts: (list of dicts)
         All meta dicts from all chunks as a list.
     chunk_lookup: (dict: int -> str)
@@ -91,7 +163,8 @@ class GulpDirectory(object):
 
     def __init__(self, output_dir):
         self.output_dir = output_dir
-        self.all_meta_dicts = [c.meta_dict for c in self.chunks()]
+        self.all_chunks = list(self.chunks())
+        self.all_meta_dicts = [c.meta_dict for c in self.all_chunks]
         self.num_chunks = len(self.all_meta_dicts)
         self.chunk_lookup = {}
         for chunk_id, meta_dict in zip(self._chunk_ids(), self.all_meta_dicts):
@@ -113,7 +186,7 @@ class GulpDirectory(object):
         to be opened and read from. """
         return ((GulpChunk(*paths) for paths in self._existing_file_paths()))
 
-    def new_chunks(self, total_new_chunks):
+    def new_chunks(self, total_new_chunks, encode_threads=1):
         """ Return a generator over freshly setup GulpChunk objects which are ready
         to be opened and written to.
 
@@ -121,16 +194,38 @@ class GulpDirectory(object):
         ----------
         total_new_chunks: (int)
             The total number of new chunks to initialize.
+        encode_threads: (int)
+            The number of threads encoding frames in each chunk.
         """
-        return ((GulpChunk(*paths) for paths in
+        return ((GulpChunk(*paths, encode_threads=encode_threads)
+                 for paths in
                  self._allocate_new_file_paths(total_new_chunks)))
 
     def __getitem__(self, element):
-        id_, _ = extract_input_for_getitem(element)
+        id_, slice_ = extract_input_for_getitem(element)
+        return self.fetch(id_, slice_)
+
+    def fetch(self, id_, slice_=None, decode_crop=None):
+        """ Read frames for a single item.
+
+        Parameters
+        ----------
+        id_: (str)
+            The ID of the item
+        slice_: (slice or list of int)
+            Selects the frames, see `GulpChunk.read_frames`.
+        decode_crop: (gulpio.transforms.DecodeCrop)
+            Crop and resize the frames while decoding them.
+
+        Returns
+        -------
+        frames (list), meta(dict)
+        """
+        id_ = str(id_)
         chunk_id = self.chunk_lookup[id_]
         gulp_chunk = GulpChunk(*self._initialize_filenames(chunk_id))
         with gulp_chunk.open():
-            return gulp_chunk[element]
+            return gulp_chunk.read_frames(id_, slice_, decode_crop)
 
     def _find_existing_data_paths(self):
         return sorted(glob.glob(os.path.join(self.output_dir, 'data*.gulp')))
@@ -173,11 +268,7 @@ class GulpDirectory(object):
                                next_chunk_id + total_new_chunks)]
 
     def _initialize_filenames(self, chunk_id):
-        data_file_path = os.path.join(
-            self.output_dir, 'data_{}.gulp'.format(chunk_id))
-        meta_file_path = os.path.join(
-            self.output_dir, 'meta_{}.gmeta'.format(chunk_id))
-        return data_file_path, meta_file_path
+        return chunk_file_paths(self.output_dir, chunk_id)
 
 
 class GulpChunk(object):
@@ -191,16 +282,33 @@ class GulpChunk(object):
         Path to the *.gmeta file.
     serializer: (subclass of AbstractSerializer)
         The type of serializer to use.
+    journal_interval: (int or None)
+        If not None, every appended item is also recorded in an append-only
+        journal next to the meta file (*.gjournal), which is flushed
+        together with the data file after this many items. If the writer
+        dies before the meta file is written, `recover` rebuilds it from
+        the journal. The journal is removed once the chunk is closed.
+    encode_threads: (int)
+        The number of threads that JPEG encode the frames of an item in
+        `append`. Frames are still written in order.
 
     """
 
     def __init__(self, data_file_path, meta_file_path,
-                 serializer=json_serializer):
+                 serializer=json_serializer, journal_interval=None,
+                 encode_threads=1):
         self.serializer = serializer
         self.data_file_path = data_file_path
         self.meta_file_path = meta_file_path
+        self.journal_file_path = journal_file_path(meta_file_path)
+        self.journal_interval = journal_interval
+        self.encode_threads = encode_threads
         self.meta_dict = self._get_or_create_dict()
         self.fp = None
+        self._encode_pool = None
+        self._journal = None
+        self._journal_flag = None
+        self._journal_pending = 0
 
     def __contains__(self, id_):
         return self._get_frame_infos(id_)
@@ -239,9 +347,32 @@ class GulpChunk(object):
             self.meta_dict[id_] = self._default_factory()
         self.meta_dict[id_]['meta_data'].append(meta_data)
 
+    @staticmethod
+    def _validate_jpeg(id_, data):
+        data = bytes(data)
+        size = get_jpeg_size(data)
+        if size is None or min(size) == 0 or not is_complete_jpeg(data):
+            raise ValueError("Encoded frame of item '{}' is not a valid "
+                             "JPEG".format(id_))
+        return data
+
+    @staticmethod
+    def encode_frame(image):
+        """ JPEG encode a frame the way `append` does. """
+        with timed('encode'):
+            return cv2.imencode('.jpg', image)[1].tostring()
+
+    def _encode(self, id_, image):
+        if isinstance(image, (bytes, bytearray, memoryview)):
+            # already encoded, written as it is
+            return self._validate_jpeg(id_, image)
+        return self.encode_frame(image)
+
     def _write_frame(self, id_, image):
+        self._write_record(id_, self._encode(id_, image))
+
+    def _write_record(self, id_, img_str):
         loc = self.fp.tell()
-        img_str = cv2.imencode('.jpg', image)[1].tostring()
         assert len(img_str) > 0
         pad = self._pad_image(len(img_str))
         record = img_str.ljust(len(img_str) + pad, b'\0')
@@ -253,11 +384,96 @@ class GulpChunk(object):
         if id_ not in self.meta_dict:  # implements an OrderedDefaultDict
             self.meta_dict[id_] = self._default_factory()
         self.meta_dict[id_]['frame_info'].append(img_info)
-        self.fp.write(record)
+        with timed('write'):
+            self.fp.write(record)
 
     def _write_frames(self, id_, frames):
+        if self.encode_threads > 1:
+            return self._write_frames_threaded(id_, frames)
+        num_frames = 0
         for frame in frames:
             self._write_frame(id_, frame)
+            num_frames += 1
+        return num_frames
+
+    def _write_frames_threaded(self, id_, frames):
+        # cv2.imencode releases the GIL, so frames are encoded in parallel.
+        # At most two frames per thread are in flight, which keeps memory
+        # bounded for long videos.
+        if self._encode_pool is None:
+            self._encode_pool = ThreadPoolExecutor(self.encode_threads)
+        pending = deque()
+        num_frames = 0
+        try:
+            for frame in frames:
+                pending.append(self._encode_pool.submit(self._encode, id_,
+                                                        frame))
+                if len(pending) >= 2 * self.encode_threads:
+                    self._write_record(id_, pending.popleft().result())
+                    num_frames += 1
+            while pending:
+                self._write_record(id_, pending.popleft().result())
+                num_frames += 1
+        finally:
+            for future in pending:
+                future.cancel()
+        return num_frames
+
+    def _rollback(self, id_, is_new, num_frame_infos, loc):
+        """ Remove an item appended at `loc` from the data and meta dict. """
+        if is_new:
+            del self.meta_dict[id_]
+        else:
+            self.meta_dict[id_]['meta_data'].pop()
+            del self.meta_dict[id_]['frame_info'][num_frame_infos:]
+        self.fp.seek(loc)
+        self.fp.truncate()
+
+    def _write_journal(self, id_, meta_data, frame_infos):
+        """ Record an appended item in the journal, as an entry serialized
+        with the serializer of the chunk and prefixed by its length. """
+        if self.journal_interval is None:
+            return
+        entry = self.serializer.dumps({'id': id_, 'meta_data': meta_data,
+                                       'frame_info': frame_infos})
+        if self._journal is None:
+            self._journal = open(self.journal_file_path,
+                                 self._journal_flag or 'ab')
+        self._journal.write(struct.pack('<I', len(entry)) + entry)
+        self._journal_pending += 1
+        if self._journal_pending >= self.journal_interval:
+            # data first, so that journaled records are always on disk
+            self.fp.flush()
+            self._journal.flush()
+            self._journal_pending = 0
+
+    def _read_journal(self):
+        """ Return the entries of the journal up to the first incomplete
+        one. """
+        entries = []
+        if not os.path.exists(self.journal_file_path):
+            return entries
+        with open(self.journal_file_path, 'rb') as journal:
+            while True:
+                header = journal.read(4)
+                if len(header) < 4:
+                    break
+                length, = struct.unpack('<I', header)
+                data = journal.read(length)
+                if len(data) < length:
+                    break
+                try:
+                    entries.append(self.serializer.loads(data))
+                except (ValueError, EOFError, pickle.UnpicklingError):
+                    break
+        return entries
+
+    def _close_journal(self):
+        if self._journal is not None:
+            self._journal.close()
+            os.remove(self.journal_file_path)
+        self._journal = None
+        self._journal_pending = 0
 
     @contextmanager
     def open(self, flag='rb'):
@@ -280,15 +496,23 @@ class GulpChunk(object):
         else:
             m = "This file does not support the mode: '{}'".format(flag)
             raise NotImplementedError(m)
+        # a journal left over from an earlier writer is replaced by 'wb'
+        self._journal_flag = 'wb' if flag == 'wb' else 'ab'
         yield
         if flag in ['wb', 'ab']:
             self.flush()
+            self._close_journal()
+        if self._encode_pool is not None:
+            self._encode_pool.shutdown()
+            self._encode_pool = None
         self.fp.close()
 
     def flush(self):
         """Flush all buffers and write the meta file."""
-        self.fp.flush()
-        self.serializer.dump(self.meta_dict, self.meta_file_path)
+        with timed('write'):
+            self.fp.flush()
+            _dump_atomic(self.serializer, self.meta_dict,
+                         self.meta_file_path)
 
     def append(self, id_, meta_data, frames):
         """ Append an item to the gulp.
@@ -299,23 +523,159 @@ class GulpChunk(object):
             The ID of the item
         meta_data: (dict)
             The meta-data associated with the item.
-        frames: (list of numpy arrays)
-            The frames of the item as a list of numpy dictionaries consisting
-            of image pixel values.
+        frames: (iterable of numpy arrays or bytes)
+            The frames of the item as a list or any other iterable (e.g. a
+            generator) of numpy arrays consisting of image pixel values.
+            Frames given as bytes must be JPEG encoded, they are stored
+            without re-encoding after checking the JPEG header.
+            Frames are written as they are produced, so only one frame is
+            held in memory at a time.
+
+        Returns
+        -------
+        int
+            The number of frames written. If there are no frames, or the
+            iterable raises, the item is rolled back and no data or meta
+            data of it remain in the chunk.
 
         """
+        id_ = str(id_)
+        is_new = id_ not in self.meta_dict
+        num_frame_infos = (0 if is_new else
+                           len(self.meta_dict[id_]['frame_info']))
+        loc = self.fp.tell()
         self._append_meta(id_, meta_data)
-        self._write_frames(id_, frames)
+        try:
+            num_frames = self._write_frames(id_, frames)
+            if num_frames > 0:
+                self._write_journal(
+                    id_, meta_data,
+                    self.meta_dict[id_]['frame_info'][num_frame_infos:])
+        except BaseException:
+            self._rollback(id_, is_new, num_frame_infos, loc)
+            raise
+        if num_frames == 0:
+            self._rollback(id_, is_new, num_frame_infos, loc)
+        return num_frames
+
+    def recover(self):
+        """ Rebuild the meta file of a chunk whose writer did not finish, by
+        replaying its journal on top of the existing meta data.
+
+        Journal entries are replayed in order until the first one that is
+        incomplete or refers to data beyond the end of the data file.
+        Entries whose frames are already in the meta data are skipped, the
+        writer may have died after writing the meta file but before
+        removing the journal. The data file is then truncated after the
+        last complete record and the meta file is written, the journal is
+        removed.
+
+        Returns
+        -------
+        int
+            The number of items recovered from the journal.
+
+        """
+        data_size = os.path.getsize(self.data_file_path)
+        known_locs = {info[0] for item in self.meta_dict.values()
+                      for info in item['frame_info']}
+        num_recovered = 0
+        for entry in self._read_journal():
+            if max(loc + length for loc, _, length in entry['frame_info']) \
+                    > data_size:
+                break
+            if entry['frame_info'][0][0] in known_locs:
+                continue
+            self._append_meta(entry['id'], entry['meta_data'])
+            self.meta_dict[str(entry['id'])]['frame_info'].extend(
+                entry['frame_info'])
+            num_recovered += 1
+        end = max([loc + length
+                   for item in self.meta_dict.values()
+                   for loc, _, length in item['frame_info']] or [0])
+        with open(self.data_file_path, 'r+b') as fp:
+            fp.truncate(end)
+        _dump_atomic(self.serializer, self.meta_dict, self.meta_file_path)
+        if os.path.exists(self.journal_file_path):
+            os.remove(self.journal_file_path)
+        return num_recovered
+
+    def _read_records(self, frame_infos):
+        """ Read the raw records of the given frames from the data file.
+
+        Records are read in offset order and each run of adjacent records is
+        fetched with a single seek and read.
 
-    def read_frames(self, id_, slice_=None):
+        Returns
+        -------
+        dict: loc -> memoryview
+            The (unpadded) record of every requested frame by offset.
+
+        """
+        runs = []
+        for info in sorted(set(frame_infos)):
+            if runs and runs[-1][-1].loc + runs[-1][-1].length == info.loc:
+                runs[-1].append(info)
+            else:
+                runs.append([info])
+        records = {}
+        for run in runs:
+            start = run[0].loc
+            self.fp.seek(start)
+            buffer_ = memoryview(
+                self.fp.read(run[-1].loc + run[-1].length - start))
+            for info in run:
+                begin = info.loc - start
+                records[info.loc] = buffer_[begin:
+                                            begin + info.length - info.pad]
+        return records
+
+    @staticmethod
+    def _decode_record(record, flags=cv2.IMREAD_ANYCOLOR, crop=None):
+        nparr = np.frombuffer(record, np.uint8)
+        img = cv2.imdecode(nparr, flags)
+        if crop is not None:
+            img = crop(img)
+        if img.ndim > 2:
+            img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+        return img
+
+    @staticmethod
+    def _plan_decoding(record, decode_crop):
+        """ Plan the decoding of all frames of an item from its first record.
+        Returns the imdecode flags and the crop function of the plan. """
+        header = get_jpeg_size(record)
+        if header is None:
+            # not a JPEG, no reduced decoding: get the size the hard way
+            h, w = GulpChunk._decode_record(record).shape[:2]
+            plan = decode_crop.plan(h, w, reduced=False)
+            flags = cv2.IMREAD_ANYCOLOR
+        else:
+            h, w, components = header
+            if get_jpeg_orientation(record) >= 5:
+                # imdecode applies the EXIF orientation, which turns the
+                # frame by 90 degrees
+                h, w = w, h
+            plan = decode_crop.plan(h, w)
+            flags = _REDUCED_DECODE_FLAGS.get((plan.reduce, components == 1),
+                                              cv2.IMREAD_ANYCOLOR)
+        return flags, lambda img: decode_crop.apply(plan, img)
+
+    def read_frames(self, id_, slice_=None, decode_crop=None):
         """ Read frames for a single item.
 
         Parameters
         ----------
         id_: (str)
             The ID of the item
-        slice_: (slice:
-            A slice with which to select frames.
+        slice_: (slice or list of int)
+            A slice or a list of frame indices with which to select frames.
+            Indices may be unsorted and contain duplicates, every distinct
+            frame is only read and decoded once.
+        decode_crop: (gulpio.transforms.DecodeCrop)
+            Crop and resize the frames while decoding them, all frames get
+            the same geometry. Frames are decoded at a reduced scale when
+            the output size allows it.
         Returns
         -------
         frames (int), meta(dict)
@@ -323,22 +683,31 @@ class GulpChunk(object):
             image pixel values. And the metadata.
 
         """
+        selected, meta_data = self._select_frames(id_, slice_)
+        records = self._read_records(selected)
+        return self._decode_frames(selected, records, decode_crop), meta_data
+
+    def _select_frames(self, id_, slice_):
+        """ Return the frame infos of the selected frames and the meta data
+        of an item. """
         frame_infos, meta_data = self._get_frame_infos(id_)
-        frames = []
-        slice_element = slice_ or slice(0, len(frame_infos))
-
-        def extract_frame(frame_info):
-            self.fp.seek(frame_info.loc)
-            record = self.fp.read(frame_info.length)
-            img_str = record[:len(record)-frame_info.pad]
-            nparr = np.fromstring(img_str, np.uint8)
-            img = cv2.imdecode(nparr, cv2.IMREAD_ANYCOLOR)
-            if img.ndim > 2:
-                img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-            return img
-        frames = [extract_frame(frame_info)
-                  for frame_info in frame_infos[slice_element]]
-        return frames, meta_data
+        if slice_ is None or isinstance(slice_, slice):
+            slice_element = slice_ or slice(0, len(frame_infos))
+            selected = frame_infos[slice_element]
+        else:
+            selected = [frame_infos[i] for i in slice_]
+        return selected, meta_data
+
+    def _decode_frames(self, selected, records, decode_crop):
+        """ Decode the records read by `_read_records` into the selected
+        frames. Does not touch the data file. """
+        flags, crop = cv2.IMREAD_ANYCOLOR, None
+        if decode_crop is not None and selected:
+            flags, crop = self._plan_decoding(records[selected[0].loc],
+                                              decode_crop)
+        decoded = {loc: self._decode_record(record, flags, crop)
+                   for loc, record in records.items()}
+        return [decoded[frame_info.loc] for frame_info in selected]
 
     def iter_all(self, accepted_ids=None, shuffle=False):
         """ Iterate over all frames in the gulp.
@@ -373,6 +742,365 @@ class GulpChunk(object):
                 yield frames, meta
 
 
+def data_chunk_ids(output_dir):
+    """ Return the ids of all chunks in a directory that have a data file,
+    including chunks that are still being written. """
+    return sorted(int(re.findall(r'\d+', os.path.basename(p))[0])
+                  for p in glob.glob(os.path.join(output_dir, 'data*.gulp')))
+
+
+def recover_chunks(output_dir, chunk_ids=None):
+    """ Recover all chunks in a directory that were not closed properly.
+
+    A chunk needs recovery if it has a journal or if its data file has no
+    meta file. A meta file that can not be read next to a journal (it was
+    torn by a crash while being written) is rebuilt from the journal alone.
+    Chunks that are empty after recovery are removed.
+
+    Parameters
+    ----------
+    output_dir: (str)
+        Path to the directory containing the files.
+    chunk_ids: (iterable of int)
+        Only consider these chunks, e.g. the chunks of one shard while the
+        other shards are still being written. All chunks if None.
+
+    Returns
+    -------
+    dict: int -> int
+        The number of recovered items for every recovered chunk id.
+
+    """
+    recovered = {}
+    if chunk_ids is None:
+        chunk_ids = data_chunk_ids(output_dir)
+    for chunk_id in chunk_ids:
+        paths = chunk_file_paths(output_dir, chunk_id)
+        if (os.path.exists(paths[1]) and
+                not os.path.exists(journal_file_path(paths[1]))):
+            continue
+        try:
+            chunk = GulpChunk(*paths)
+        except (ValueError, EOFError, pickle.UnpicklingError):
+            if not os.path.exists(journal_file_path(paths[1])):
+                raise
+            os.remove(paths[1])
+            chunk = GulpChunk(*paths)
+        recovered[chunk_id] = chunk.recover()
+        if not chunk.meta_dict:
+            os.remove(chunk.data_file_path)
+            os.remove(chunk.meta_file_path)
+    return recovered
+
+
+def shard_index_path(output_dir, shard):
+    """ Return the path of the partial index of shard (i, N). """
+    return os.path.join(output_dir, 'shard_{}_of_{}.gindex'.format(*shard))
+
+
+def shard_chunk_ids(output_dir, shard, first_chunk_id):
+    """ Return the ids of the chunks that shard (i, N) wrote into a
+    directory: the chunks from `first_chunk_id` on, whose id modulo N is i.
+    """
+    index, count = shard
+    return [chunk_id for chunk_id in data_chunk_ids(output_dir)
+            if chunk_id >= first_chunk_id and chunk_id % count == index]
+
+
+def _dump_shard_index(output_dir, shard_index):
+    # replace atomically, other nodes may be reading it
+    path = shard_index_path(output_dir, (shard_index['shard'],
+                                         shard_index['num_shards']))
+    _dump_atomic(json_serializer, shard_index, path)
+
+
+def _load_complete_shard_indexes(output_dir):
+    index_paths = sorted(glob.glob(os.path.join(output_dir, '*.gindex')))
+    shard_indexes = [json_serializer.load(p) for p in index_paths]
+    incomplete = ['{shard}/{num_shards}'.format(**i)
+                  for i in shard_indexes if not i['complete']]
+    if incomplete:
+        raise ValueError("Shards {} in '{}' are not complete"
+                         .format(incomplete, output_dir))
+    return index_paths, shard_indexes
+
+
+def _move_shard(shard_dir, output_dir):
+    """ Move the chunks, partial indexes and label dict of a shard that was
+    written to its own directory into `output_dir`. """
+    index_paths, shard_indexes = _load_complete_shard_indexes(shard_dir)
+    if not shard_indexes:
+        raise ValueError("No shard index found in: '{}'".format(shard_dir))
+    paths = [p for chunk_id in data_chunk_ids(shard_dir)
+             for p in chunk_file_paths(shard_dir, chunk_id)] + index_paths
+    for path in paths:
+        if os.path.exists(os.path.join(output_dir, os.path.basename(path))):
+            raise ValueError("'{}' exists in both '{}' and '{}'".format(
+                os.path.basename(path), shard_dir, output_dir))
+    label_path = os.path.join(shard_dir, 'label2idx.json')
+    if os.path.exists(label_path):
+        output_label_path = os.path.join(output_dir, 'label2idx.json')
+        if not os.path.exists(output_label_path):
+            paths.append(label_path)
+        elif (json_serializer.load(label_path) !=
+              json_serializer.load(output_label_path)):
+            raise ValueError("The labels of '{}' differ from those of '{}'"
+                             .format(shard_dir, output_dir))
+    for path in paths:
+        shutil.move(path, output_dir)
+
+
+def merge_shards(output_dir, shard_dirs=()):
+    """ Combine the shards of a sharded ingestion into one gulp directory.
+
+    Shards written into their own directories (e.g. on the local disk of
+    every node) are moved into `output_dir` first. The partial indexes of
+    all shards must be present and complete. They are checked against the
+    chunks in the directory and removed once the shards are merged.
+
+    Parameters
+    ----------
+    output_dir: (str)
+        The directory to merge the shards into.
+    shard_dirs: (list of str)
+        Directories of shards that were not written into `output_dir`.
+
+    Returns
+    -------
+    GulpDirectory
+        The merged directory.
+
+    """
+    ensure_output_dir_exists(output_dir)
+    for shard_dir in shard_dirs:
+        _move_shard(shard_dir, output_dir)
+    index_paths, shard_indexes = _load_complete_shard_indexes(output_dir)
+    if not shard_indexes:
+        raise ValueError("No shard index found in: '{}'".format(output_dir))
+    num_shards = {i['num_shards'] for i in shard_indexes}
+    if len(num_shards) != 1:
+        raise ValueError("Shard indexes of different numbers of shards: {}"
+                         .format(sorted(num_shards)))
+    num_shards = num_shards.pop()
+    missing = set(range(num_shards)) - {i['shard'] for i in shard_indexes}
+    if missing:
+        raise ValueError("Shards {} of {} are missing".format(
+            sorted(missing), num_shards))
+    shard_of_id = {}
+    for shard_index in shard_indexes:
+        for chunk_id, ids in shard_index['chunks'].items():
+            for id_ in ids:
+                if id_ in shard_of_id:
+                    raise ValueError(
+                        "Duplicate id '{}' in shards {} and {} of {}, were "
+                        "the shards ingested from the same order of items?"
+                        .format(id_, shard_of_id[id_], shard_index['shard'],
+                                num_shards))
+                shard_of_id[id_] = shard_index['shard']
+    chunk_ids = {}
+    for chunk_id in data_chunk_ids(output_dir):
+        for id_ in GulpChunk(*chunk_file_paths(output_dir,
+                                               chunk_id)).meta_dict:
+            if id_ in chunk_ids:
+                raise ValueError("Duplicate id '{}' in chunks {} and {}"
+                                 .format(id_, chunk_ids[id_], chunk_id))
+            chunk_ids[id_] = chunk_id
+    for shard_index in shard_indexes:
+        for chunk_id, ids in shard_index['chunks'].items():
+            for id_ in ids:
+                if chunk_ids.get(id_) != int(chunk_id):
+                    raise ValueError(
+                        "Item '{}' of shard {}/{} is missing from chunk {}"
+                        .format(id_, shard_index['shard'], num_shards,
+                                chunk_id))
+    gulp_directory = GulpDirectory(output_dir)
+    for path in index_paths:
+        os.remove(path)
+    return gulp_directory
+
+
+class ChunkHandlePool(object):
+    """ Keeps up to `max_open` data files open for reading.
+
+    The least recently used file is closed when the limit is reached. All
+    handles are dropped when the pool is used from a new (forked) process or
+    unpickled, so that processes never share file offsets.
+
+    Parameters
+    ----------
+    max_open: (int)
+        Maximum number of simultaneously open files.
+
+    """
+
+    def __init__(self, max_open=32):
+        assert max_open > 0
+        self.max_open = max_open
+        self._handles = OrderedDict()
+        self._pid = os.getpid()
+
+    def __len__(self):
+        return len(self._handles)
+
+    def __getstate__(self):
+        return {'max_open': self.max_open}
+
+    def __setstate__(self, state):
+        self.__init__(state['max_open'])
+
+    def get(self, data_file_path):
+        """ Return an open read handle for the given data file. """
+        if self._pid != os.getpid():
+            self.close()
+            self._pid = os.getpid()
+        if data_file_path in self._handles:
+            self._handles.move_to_end(data_file_path)
+        else:
+            if len(self._handles) >= self.max_open:
+                _, fp = self._handles.popitem(last=False)
+                fp.close()
+            self._handles[data_file_path] = open(data_file_path, 'rb')
+        return self._handles[data_file_path]
+
+    def close(self):
+        """ Close all open handles. """
+        while self._handles:
+            _, fp = self._handles.popitem()
+            fp.close()
+
+
+class MultiGulpDirectory(object):
+    """ Represents several gulp directories as one dataset.
+
+    Items of all directories are addressed by a global integer index, which
+    is mapped to (directory, chunk, item id) in O(1) using flat arrays. The
+    labels of all directories are merged by name into a single `label2idx`.
+    Chunks and their meta dicts are loaded once and share one pool of open
+    file handles.
+
+    Parameters
+    ----------
+    output_dirs: (list of str)
+        Paths to the directories containing the files.
+    max_open_chunks: (int)
+        Maximum number of simultaneously open data files.
+
+    Attributes
+    ----------
+    directories: (list of GulpDirectory)
+        The underlying directories.
+    label2idx: (dict: label name -> int)
+        Merged label dictionary of all directories.
+    label_maps: (list of numpy arrays)
+        Per directory, mapping a local label index to the global one.
+    chunk_lookup: (numpy array)
+        Mapping global item index to global chunk index.
+    chunk_directory: (numpy array)
+        Mapping global chunk index to directory index.
+    chunk_ids: (numpy array)
+        Mapping global chunk index to the chunk id within its directory.
+    ids: (list of str)
+        Mapping global item index to item id within its directory.
+
+    """
+
+    def __init__(self, output_dirs, max_open_chunks=32):
+        self.output_dirs = list(output_dirs)
+        self.directories = [GulpDirectory(d) for d in self.output_dirs]
+        self.handles = ChunkHandlePool(max_open_chunks)
+        self._lock = threading.Lock()
+        self._chunks = []
+        chunk_directory, chunk_ids, chunk_sizes = [], [], []
+        self.ids = []
+        for dir_index, gd in enumerate(self.directories):
+            for chunk_id, chunk in zip(gd._chunk_ids(), gd.all_chunks):
+                self._chunks.append(chunk)
+                chunk_directory.append(dir_index)
+                chunk_ids.append(chunk_id)
+                chunk_sizes.append(len(chunk.meta_dict))
+                self.ids.extend(chunk.meta_dict.keys())
+        self.num_chunks = len(self._chunks)
+        self.chunk_directory = np.array(chunk_directory, dtype='int32')
+        self.chunk_ids = np.array(chunk_ids, dtype='int64')
+        self.chunk_lookup = np.repeat(
+            np.arange(self.num_chunks, dtype='int32'),
+            np.array(chunk_sizes, dtype='int64'))
+        self.label2idx, self.label_maps = self._merge_label_dicts()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _merge_label_dicts(self):
+        label2idx, label_maps = OrderedDict(), []
+        for gd in self.directories:
+            label_path = os.path.join(gd.output_dir, 'label2idx.json')
+            local = {}
+            if os.path.exists(label_path):
+                local = gd._load_label_dict()
+            label_map = np.full(max(local.values(), default=-1) + 1, -1,
+                                dtype='int64')
+            for name, idx in sorted(local.items(), key=lambda x: x[1]):
+                label_map[idx] = label2idx.setdefault(name, len(label2idx))
+            label_maps.append(label_map)
+        return label2idx, label_maps
+
+    def __len__(self):
+        return len(self.ids)
+
+    def locate(self, index):
+        """ Return (directory index, chunk id, item id) of a global index. """
+        chunk_index = self.chunk_lookup[index]
+        return (int(self.chunk_directory[chunk_index]),
+                int(self.chunk_ids[chunk_index]),
+                self.ids[index])
+
+    def item_info(self, index):
+        """ Return the meta dict entry (frame_info and meta_data) of an item.
+        """
+        chunk = self._chunks[self.chunk_lookup[index]]
+        return chunk.meta_dict[self.ids[index]]
+
+    def item_infos(self):
+        """ Return a generator over the meta dict entries of all items, in
+        order of their global index. """
+        return (chunk.meta_dict[id_]
+                for chunk in self._chunks for id_ in chunk.meta_dict)
+
+    def __getitem__(self, element):
+        if isinstance(element, tuple) and len(element) == 2:
+            index, slice_ = element
+        elif isinstance(element, (int, np.integer)):
+            index, slice_ = element, None
+        else:
+            raise TypeError("Undefined input type! index or (index, slice) "
+                            "expected")
+        return self.fetch(index, slice_)
+
+    def fetch(self, index, slice_=None, decode_crop=None):
+        """ Read frames for the item at a global index, see
+        `GulpDirectory.fetch`. Only reading the records holds the lock of
+        the shared handles, decoding runs in parallel across threads. """
+        chunk = self._chunks[self.chunk_lookup[index]]
+        selected, meta_data = chunk._select_frames(self.ids[index], slice_)
+        with self._lock:
+            chunk.fp = self.handles.get(chunk.data_file_path)
+            try:
+                records = chunk._read_records(selected)
+            finally:
+                chunk.fp = None
+        return chunk._decode_frames(selected, records, decode_crop), meta_data
+
+    def close(self):
+        """ Close all open data files. """
+        self.handles.close()
+
+
 class ChunkWriter(object):
     """Can write from an adapter to a gulp chunk.
 
@@ -396,17 +1124,322 @@ class ChunkWriter(object):
         input_slice: (slice)
            The slice to use from the adapter.
 
+        Returns
+        -------
+        dict
+            The state of the `IngestionStats` recorded while writing.
+
         """
-        with output_chunk.open('wb'):
-            for video in self.adapter.iter_data(input_slice):
-                id_ = video['id']
-                meta_data = video['meta']
-                frames = video['frames']
-                if len(frames) > 0:
-                    output_chunk.append(id_, meta_data, frames)
-                else:
-                    print("Failed to write video with id: {}; no frames"
-                          .format(id_))
+        with recording() as stats:
+            with output_chunk.open('wb'):
+                for video, seconds in _iter_timed(
+                        self.adapter.iter_data(input_slice)):
+                    if not _append_timed(output_chunk, video, seconds):
+                        print("Failed to write video with id: {}; no frames"
+                              .format(video['id']))
+        return stats.state()
+
+
+def _iter_timed(items):
+    """Yield the items of an iterable together with the seconds it took to
+    produce each of them."""
+    items = iter(items)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(items)
+        except StopIteration:
+            return
+        yield item, time.perf_counter() - start
+
+
+def _append_timed(chunk, video, upstream_seconds=0.):
+    """Append an item (a dict as yielded by adapters) to an open chunk and
+    record it in the ingestion stats, with `upstream_seconds` added to the
+    time it took. Returns the number of frames written."""
+    start = time.perf_counter()
+    loc = chunk.fp.tell()
+    num_frames = chunk.append(video['id'], video['meta'], video['frames'])
+    if num_frames:
+        record_item(video['id'],
+                    upstream_seconds + time.perf_counter() - start,
+                    num_frames, chunk.fp.tell() - loc)
+    return num_frames
+
+
+# items between two flushes of the journal (and the data file) of a chunk
+JOURNAL_INTERVAL = 16
+
+
+class RollingChunkWriter(object):
+    """Writes items into a series of new chunks. A chunk is started when
+    the first item arrives and finished once it holds `videos_per_chunk`
+    items, the next item starts a new chunk.
+
+    Parameters
+    ----------
+    output_folder: (str)
+        The folder/directory to write to.
+    next_chunk_id: (callable)
+        Returns a fresh chunk id, which no other writer will use.
+    videos_per_chunk: (int or None)
+        The maximum number of items per chunk, None for no limit.
+    chunk_size_bytes: (int or None)
+        Finish a chunk once its data file holds at least this many bytes.
+        The item that crosses the budget still goes into the chunk, so a
+        chunk exceeds it by less than one item.
+    encode_threads: (int)
+        The number of threads encoding frames in each chunk.
+    journal_interval: (int or None)
+        Journal the items of each chunk and flush the journal after this
+        many items (see `GulpChunk`), so that an interrupted ingestion can
+        be resumed. At most this many items are lost when a writer dies.
+        No journal if None.
+
+    """
+
+    def __init__(self, output_folder, next_chunk_id, videos_per_chunk,
+                 chunk_size_bytes=None, encode_threads=1,
+                 journal_interval=JOURNAL_INTERVAL):
+        self.output_folder = output_folder
+        self.next_chunk_id = next_chunk_id
+        self.videos_per_chunk = videos_per_chunk
+        self.chunk_size_bytes = chunk_size_bytes
+        self.encode_threads = encode_threads
+        self.journal_interval = journal_interval
+        self.chunk = None
+        self._chunk_context = None
+
+    def _start_chunk(self):
+        chunk_id = self.next_chunk_id()
+        self.chunk = GulpChunk(*chunk_file_paths(self.output_folder,
+                                                 chunk_id),
+                               journal_interval=self.journal_interval,
+                               encode_threads=self.encode_threads)
+        self._chunk_context = self.chunk.open('wb')
+        self._chunk_context.__enter__()
+
+    def _chunk_is_full(self):
+        if (self.chunk_size_bytes is not None and
+                self.chunk.fp.tell() >= self.chunk_size_bytes):
+            return True
+        return (self.videos_per_chunk is not None and
+                len(self.chunk.meta_dict) >= self.videos_per_chunk)
+
+    def write(self, video, upstream_seconds=0.):
+        """Append an item (a dict with 'id', 'meta' and 'frames', as yielded
+        by adapters) to the current chunk. `upstream_seconds`, the time
+        already spent on the item (e.g. reading it), is added to its time in
+        the ingestion stats.
+
+        Returns
+        -------
+        int
+            The number of frames written.
+        """
+        if self.chunk is None:
+            self._start_chunk()
+        num_frames = _append_timed(self.chunk, video, upstream_seconds)
+        if not num_frames:
+            print("Failed to write video with id: {}; no frames"
+                  .format(video['id']))
+        if self._chunk_is_full():
+            self.close()
+        return num_frames
+
+    def close(self):
+        """Finish the current chunk. A chunk without items is removed."""
+        if self.chunk is None:
+            return
+        self._chunk_context.__exit__(None, None, None)
+        if not self.chunk.meta_dict:
+            os.remove(self.chunk.data_file_path)
+            os.remove(self.chunk.meta_file_path)
+        self.chunk = self._chunk_context = None
+
+
+class SharedCounter(object):
+    """A counter shared by processes, calling it returns the next value.
+
+    Parameters
+    ----------
+    start: (int)
+        The first value.
+    step: (int)
+        The difference between two consecutive values.
+
+    """
+
+    def __init__(self, start=0, step=1):
+        self.value = multiprocessing.Value('l', start)
+        self.step = step
+
+    def __call__(self):
+        with self.value.get_lock():
+            value = self.value.value
+            self.value.value += self.step
+        return value
+
+
+# seconds between two updates of the ingestion stats sent by a worker
+STATS_INTERVAL = 1.
+
+
+def _send_stats(results, stage=None, min_interval=0.):
+    """Put the state of the ingestion stats recorded since the last call on
+    the `results` queue, paired with the `stage` name if given, unless less
+    than `min_interval` seconds passed since then."""
+    stats = active_stats()
+    state = stats.pop_state(min_interval) if stats is not None else None
+    if state is not None:
+        results.put(state if stage is None else (stage, state))
+
+
+def _work_stealing_worker(adapter, writer, units, results,
+                          skip_ids=frozenset()):
+    """Take slices of the adapter from the `units` queue until a None is
+    received and write them with a `RollingChunkWriter`, leaving out items
+    whose id is in `skip_ids`. The number of items of every finished slice
+    and, every `STATS_INTERVAL` seconds, the state of the ingestion stats
+    are put on the `results` queue, followed by None when done or by the
+    formatted traceback if an error occurred.
+    """
+    try:
+        with recording():
+            for unit in iter(units.get, None):
+                for video, seconds in _iter_timed(adapter.iter_data(unit)):
+                    # frames are not consumed, so skipping does not decode
+                    # them
+                    if str(video['id']) in skip_ids:
+                        continue
+                    writer.write(video, seconds)
+                results.put(unit.stop - unit.start)
+                _send_stats(results, min_interval=STATS_INTERVAL)
+            writer.close()
+            _send_stats(results)
+    except Exception:
+        results.put("".join(traceback.format_exception(*sys.exc_info())))
+    else:
+        results.put(None)
+
+
+# seconds to wait for a message from the workers before checking that they
+# are still alive
+RESULT_TIMEOUT = 1.
+
+
+def _get_result(results, workers, num_done):
+    """Return the next message on the `results` queue of the ingestion
+    `workers`, of which `num_done` reported that they are done.
+
+    Raises a RuntimeError if a worker died without reporting an error: it
+    exited with a nonzero code (e.g. killed by the OOM killer), or it exited
+    before reporting that it is done.
+    """
+    exited_early = False
+    while True:
+        try:
+            return results.get(timeout=RESULT_TIMEOUT)
+        except queue.Empty:
+            pass
+        exitcodes = [worker.exitcode for worker in workers]
+        for worker, exitcode in zip(workers, exitcodes):
+            if exitcode not in (None, 0):
+                raise RuntimeError("Ingestion worker {} died with exit code "
+                                   "{}".format(worker.name, exitcode))
+        # the messages of a worker that exited are all sent, but may still
+        # be on the way, so wait for one more timeout before giving up
+        if exitcodes.count(0) > num_done:
+            if exited_early:
+                raise RuntimeError("Ingestion worker exited before it was "
+                                   "done")
+            exited_early = True
+
+
+def _stop_workers(workers, queues):
+    """Terminate the workers after a failure and close the queues, without
+    waiting for the items in them to be consumed."""
+    for worker in workers:
+        worker.terminate()
+    for worker in workers:
+        worker.join()
+    for queue_ in queues:
+        queue_.cancel_join_thread()
+        queue_.close()
+
+
+def _finish_stage(remaining, downstream, num_downstream):
+    """Count a worker of a pipeline stage as finished. The last worker of
+    the stage tells every worker of the next stage that no more items are
+    coming."""
+    with remaining.get_lock():
+        remaining.value -= 1
+        if downstream is None:
+            return
+        if remaining.value == 0:
+            for _ in range(num_downstream):
+                downstream.put(None)
+        # Items are sent by a feeder thread. Flushing them while holding
+        # the lock makes sure that the items of all workers of the stage
+        # are in the queue before the Nones of the last one.
+        downstream.close()
+        downstream.join_thread()
+
+
+def _run_stage(stage, work, results, remaining, downstream, num_downstream):
+    """Run the `work` of a pipeline worker and report to `results`: the
+    stage name together with the state of the ingestion stats and None when
+    done, or the formatted traceback if an error occurred."""
+    try:
+        with recording():
+            work()
+            _send_stats(results, stage)
+    except Exception:
+        results.put((stage, "".join(
+            traceback.format_exception(*sys.exc_info()))))
+    else:
+        _finish_stage(remaining, downstream, num_downstream)
+        results.put((stage, None))
+
+
+# Items are passed between the stages as (id, meta, frames, seconds), where
+# seconds is the time spent on the item in the previous stages. The frames
+# of an item are not split up, so that the item reaches a single writer
+# whichever encoder handled it; memory per queue slot grows with the length
+# of the video (see `GulpIngestor`).
+
+def _decode_items(adapter, units, decoded, results, skip_ids):
+    for unit in iter(units.get, None):
+        num_items = 0
+        for video, seconds in _iter_timed(adapter.iter_data(unit)):
+            if str(video['id']) in skip_ids:
+                continue
+            start = time.perf_counter()
+            frames = list(video['frames'])
+            decoded.put((video['id'], video['meta'], frames,
+                         seconds + time.perf_counter() - start))
+            num_items += 1
+        # items that will not reach the writers count as finished
+        results.put(('decode', unit.stop - unit.start - num_items))
+        _send_stats(results, 'decode', STATS_INTERVAL)
+
+
+def _encode_items(decoded, encoded, results):
+    for id_, meta, frames, seconds in iter(decoded.get, None):
+        start = time.perf_counter()
+        frames = [frame if isinstance(frame, (bytes, bytearray, memoryview))
+                  else GulpChunk.encode_frame(frame) for frame in frames]
+        encoded.put((id_, meta, frames,
+                     seconds + time.perf_counter() - start))
+        _send_stats(results, 'encode', STATS_INTERVAL)
+
+
+def _write_items(writer, encoded, results):
+    for id_, meta, frames, seconds in iter(encoded.get, None):
+        writer.write({'id': id_, 'meta': meta, 'frames': frames}, seconds)
+        results.put(('write', 1))
+        _send_stats(results, 'write', STATS_INTERVAL)
+    writer.close()
 
 
 def calculate_chunk_slices(items_per_chunk, num_items):
@@ -439,33 +1472,343 @@ class GulpIngestor(object):
         The adapter to ingest from.
     output_folder: (str)
         The folder/directory to write to.
-    videos_per_chunk: (int)
-        The total number of items per chunk.
+    videos_per_chunk: (int or None)
+        The total number of items per chunk. May be None if
+        `chunk_size_bytes` is given.
     num_workers: (int)
         The level of parallelism.
+    dynamic: (bool)
+        Hand out work in small units of `unit_size` items to whichever
+        worker is idle, instead of one fixed slice per chunk. Every worker
+        writes into its own chunk and starts a new one when it is full, so
+        the order of items in the chunks is not deterministic.
+    unit_size: (int)
+        The number of items per unit of work in dynamic mode.
+    chunk_size_bytes: (int, str or None)
+        Target size of the data file of a chunk, e.g. 512M or 2G. Chunks
+        roll over once they reach this size (or `videos_per_chunk` items,
+        if that is not None as well). Implies dynamic mode, since the
+        number of items per chunk is not known in advance.
+    resume: (bool)
+        Continue an interrupted ingestion into `output_folder`: chunks that
+        were not closed are recovered from their journals (see
+        `recover_chunks`) and items whose id is already in the directory
+        are skipped. Implies dynamic mode.
+    pipeline: (bool)
+        Split the ingestion into stages that run in separate processes and
+        are connected by bounded queues: `num_workers` processes read and
+        resize items with the adapter, `num_encoders` processes JPEG encode
+        the frames and `num_writers` processes write them into chunks.
+        Implies dynamic mode. Items are passed between the stages whole,
+        with all their decoded frames, so up to about 2 * `queue_size` plus
+        one per process items are in memory at once. For long videos, use
+        a small `queue_size` or ingest without the pipeline, which writes
+        the frames of an item as they are decoded.
+    num_encoders: (int)
+        The number of encoding processes in pipeline mode.
+    num_writers: (int)
+        The number of writing processes in pipeline mode, each writes into
+        its own chunks.
+    queue_size: (int)
+        The maximum number of items waiting between two stages. Bounds the
+        memory of the pipeline in items, not in frames.
+    encode_threads: (int)
+        The number of threads with which each worker encodes the frames of
+        an item. Useful if there are fewer chunks or items than cores.
+    shard: (tuple (i, N), str 'i/N' or None)
+        Ingest only the i-th of N contiguous parts of the adapter's items.
+        The shard uses the chunk ids that are i modulo N, so shards running
+        in different processes or on different nodes can write into the
+        same folder, or into folders that are merged later, without
+        colliding. The shard keeps a partial index (shard_i_of_N.gindex)
+        in `output_folder`, which is marked complete when it is done;
+        `merge_shards` combines the shards once all are complete. With
+        `resume`, only the chunks of this shard are recovered. Implies
+        dynamic mode. Every node must list the items of the adapter in the
+        same order, so a shuffling adapter can not be sharded.
+    report_path: (str or None)
+        Write the report of the ingestion stats (see `IngestionStats`) to
+        this JSON file when done. Calling the ingestor returns the report
+        in any case.
+    live_report_path: (str or None)
+        Append the report so far as a line of JSON to this file every
+        `report_interval` seconds while ingesting.
+    report_interval: (float)
+        The seconds between two live reports.
+    num_slowest: (int)
+        The number of slowest items in the report.
 
     """
-    def __init__(self, adapter, output_folder, videos_per_chunk, num_workers):
+    def __init__(self, adapter, output_folder, videos_per_chunk, num_workers,
+                 dynamic=False, unit_size=1, chunk_size_bytes=None,
+                 resume=False, pipeline=False, num_encoders=1, num_writers=1,
+                 queue_size=8, encode_threads=1, shard=None,
+                 report_path=None, live_report_path=None,
+                 report_interval=10., num_slowest=10):
         assert int(num_workers) > 0
+        assert int(unit_size) > 0
+        assert int(num_encoders) > 0
+        assert int(num_writers) > 0
+        assert int(queue_size) > 0
+        assert int(encode_threads) > 0
+        if chunk_size_bytes is not None:
+            chunk_size_bytes = parse_byte_size(chunk_size_bytes)
+            assert chunk_size_bytes > 0
+        else:
+            assert videos_per_chunk is not None
         self.adapter = adapter
         self.output_folder = output_folder
-        self.videos_per_chunk = int(videos_per_chunk)
+        self.videos_per_chunk = (int(videos_per_chunk)
+                                 if videos_per_chunk is not None else None)
         self.num_workers = int(num_workers)
+        if shard is not None and not isinstance(shard, str):
+            shard = '{}/{}'.format(*shard)
+        self.shard = parse_shard(shard) if shard is not None else None
+        if self.shard is not None and getattr(adapter, 'shuffle', False):
+            raise ValueError("A shuffled adapter can not be sharded, every "
+                             "node would split a different order of items")
+        self.dynamic = (dynamic or chunk_size_bytes is not None or resume or
+                        pipeline or self.shard is not None)
+        self.unit_size = int(unit_size)
+        self.chunk_size_bytes = chunk_size_bytes
+        self.resume = resume
+        self.pipeline = pipeline
+        self.num_encoders = int(num_encoders)
+        self.num_writers = int(num_writers)
+        self.queue_size = int(queue_size)
+        self.encode_threads = int(encode_threads)
+        self.report_path = report_path
+        self.live_report_path = live_report_path
+        self.report_interval = float(report_interval)
+        self.num_slowest = int(num_slowest)
+        self.stats = None
 
     def __call__(self):
         ensure_output_dir_exists(self.output_folder)
+        self.stats = IngestionStats(self.num_slowest)
+        self._start_time = self._last_report_time = time.perf_counter()
+        if self.pipeline:
+            self._ingest_pipelined()
+        elif self.dynamic:
+            self._ingest_dynamic()
+        else:
+            self._ingest_static()
+        if self.shard is not None:
+            self._publish_shard_index()
+        report = self._report()
+        if self.report_path is not None:
+            json_serializer.dump(report, self.report_path)
+        return report
+
+    def _report(self):
+        report = self.stats.report(time.perf_counter() - self._start_time)
+        report['mode'] = ('pipeline' if self.pipeline else
+                          'dynamic' if self.dynamic else 'static')
+        report['num_workers'] = self.num_workers
+        return report
+
+    def _merge_stats(self, state, progress):
+        """Merge the stats sent by a worker, show the throughput so far in
+        the progress bar and write the live report when it is due."""
+        self.stats.merge(state)
+        elapsed = time.perf_counter() - self._start_time
+        if elapsed > 0:
+            progress.set_postfix(OrderedDict([
+                ('frames/s', '{:.1f}'.format(self.stats.frames / elapsed)),
+                ('MB/s', '{:.2f}'.format(self.stats.bytes / elapsed / 1e6)),
+            ]))
+        now = time.perf_counter()
+        if (self.live_report_path is not None and
+                now - self._last_report_time >= self.report_interval):
+            self._last_report_time = now
+            with open(self.live_report_path, 'a') as fp:
+                fp.write(json.dumps(self._report()) + '\n')
+
+    def _ingest_static(self):
         chunk_slices = calculate_chunk_slices(self.videos_per_chunk,
                                               len(self.adapter))
         gulp_directory = GulpDirectory(self.output_folder)
-        new_chunks = gulp_directory.new_chunks(len(chunk_slices))
+        new_chunks = gulp_directory.new_chunks(len(chunk_slices),
+                                               self.encode_threads)
         chunk_writer = ChunkWriter(self.adapter)
         with ProcessPoolExecutor(max_workers=self.num_workers) as executor:
             result = executor.map(chunk_writer.write_chunk,
                                   new_chunks,
                                   chunk_slices)
-            for r in tqdm(result,
-                          desc='Chunks finished',
-                          unit='chunk',
-                          dynamic_ncols=True,
-                          total=len(chunk_slices)):
-                pass
+            with tqdm(desc='Chunks finished',
+                      unit='chunk',
+                      dynamic_ncols=True,
+                      total=len(chunk_slices)) as progress:
+                for state in result:
+                    self._merge_stats(state, progress)
+                    progress.update(1)
+
+    def _item_range(self):
+        """Return the (start, stop) indices of the items to ingest."""
+        num_items = len(self.adapter)
+        if self.shard is None:
+            return 0, num_items
+        index, count = self.shard
+        return index * num_items // count, (index + 1) * num_items // count
+
+    def _num_items(self):
+        start, stop = self._item_range()
+        return stop - start
+
+    def _schedule_units(self):
+        """Return the queue of units of work for `num_workers` workers, the
+        ids to skip and the counter for new chunk ids."""
+        if self.shard is not None:
+            skip_ids, next_chunk_id = self._prepare_shard()
+        else:
+            skip_ids = frozenset()
+            if self.resume:
+                recover_chunks(self.output_folder)
+                skip_ids = frozenset(
+                    GulpDirectory(self.output_folder).merged_meta_dict)
+            next_chunk_id = SharedCounter(
+                GulpDirectory(self.output_folder)._next_chunk_id())
+        units = multiprocessing.Queue()
+        start, stop = self._item_range()
+        if stop > start:
+            for unit in calculate_chunk_slices(self.unit_size, stop - start):
+                units.put(slice(start + unit.start, start + unit.stop))
+        for _ in range(self.num_workers):
+            units.put(None)
+        return units, skip_ids, next_chunk_id
+
+    def _prepare_shard(self):
+        """Start (or with `resume` continue) the partial index of the shard
+        and return the ids to skip and the counter for its chunk ids. Other
+        shards may be writing into the same folder, so only chunks of this
+        shard are touched."""
+        index, count = self.shard
+        index_path = shard_index_path(self.output_folder, self.shard)
+        skip_ids = frozenset()
+        first_chunk_id = None
+        if self.resume and os.path.exists(index_path):
+            first_chunk_id = json_serializer.load(index_path)[
+                'first_chunk_id']
+            recover_chunks(self.output_folder, shard_chunk_ids(
+                self.output_folder, self.shard, first_chunk_id))
+            skip_ids = frozenset(
+                id_ for chunk_id in shard_chunk_ids(
+                    self.output_folder, self.shard, first_chunk_id)
+                for id_ in GulpChunk(*chunk_file_paths(
+                    self.output_folder, chunk_id)).meta_dict)
+        chunk_ids = data_chunk_ids(self.output_folder)
+        next_chunk_id = chunk_ids[-1] + 1 if chunk_ids else 0
+        next_chunk_id += (index - next_chunk_id) % count
+        if first_chunk_id is None:
+            first_chunk_id = next_chunk_id
+        _dump_shard_index(self.output_folder,
+                          {'shard': index,
+                           'num_shards': count,
+                           'first_chunk_id': first_chunk_id,
+                           'complete': False,
+                           'chunks': {}})
+        return skip_ids, SharedCounter(next_chunk_id, count)
+
+    def _publish_shard_index(self):
+        """Record the chunks and items of the shard and mark it complete."""
+        shard_index = json_serializer.load(
+            shard_index_path(self.output_folder, self.shard))
+        shard_index['chunks'] = OrderedDict(
+            (str(chunk_id), list(GulpChunk(*chunk_file_paths(
+                self.output_folder, chunk_id)).meta_dict))
+            for chunk_id in shard_chunk_ids(self.output_folder, self.shard,
+                                            shard_index['first_chunk_id']))
+        shard_index['complete'] = True
+        _dump_shard_index(self.output_folder, shard_index)
+
+    def _rolling_chunk_writer(self, next_chunk_id):
+        return RollingChunkWriter(self.output_folder, next_chunk_id,
+                                  self.videos_per_chunk,
+                                  self.chunk_size_bytes,
+                                  self.encode_threads)
+
+    def _ingest_dynamic(self):
+        units, skip_ids, next_chunk_id = self._schedule_units()
+        results = multiprocessing.Queue()
+        workers = [multiprocessing.Process(
+            target=_work_stealing_worker,
+            args=(self.adapter, self._rolling_chunk_writer(next_chunk_id),
+                  units, results, skip_ids))
+            for _ in range(self.num_workers)]
+        for worker in workers:
+            worker.start()
+        running = len(workers)
+        try:
+            with tqdm(desc='Videos finished', unit='video',
+                      dynamic_ncols=True,
+                      total=self._num_items()) as progress:
+                while running:
+                    result = _get_result(results, workers,
+                                         len(workers) - running)
+                    if result is None:
+                        running -= 1
+                    elif isinstance(result, str):
+                        raise RuntimeError("Ingestion worker failed:\n" +
+                                           result)
+                    elif isinstance(result, dict):
+                        self._merge_stats(result, progress)
+                    else:
+                        progress.update(result)
+        except BaseException:
+            _stop_workers(workers, [units, results])
+            raise
+        for worker in workers:
+            worker.join()
+
+    def _ingest_pipelined(self):
+        units, skip_ids, next_chunk_id = self._schedule_units()
+        decoded = multiprocessing.Queue(self.queue_size)
+        encoded = multiprocessing.Queue(self.queue_size)
+        results = multiprocessing.Queue()
+        # every process gets its own copy of the work, and thus its own
+        # RollingChunkWriter
+        stages = [
+            ('decode', self.num_workers, decoded, self.num_encoders,
+             functools.partial(_decode_items, self.adapter, units, decoded,
+                               results, skip_ids)),
+            ('encode', self.num_encoders, encoded, self.num_writers,
+             functools.partial(_encode_items, decoded, encoded, results)),
+            ('write', self.num_writers, None, 0,
+             functools.partial(_write_items,
+                               self._rolling_chunk_writer(next_chunk_id),
+                               encoded, results)),
+        ]
+        workers = []
+        for stage, num, downstream, num_downstream, work in stages:
+            remaining = multiprocessing.Value('l', num)
+            workers.extend(multiprocessing.Process(
+                target=_run_stage, name='{}-{}'.format(stage, i),
+                args=(stage, work, results, remaining, downstream,
+                      num_downstream))
+                for i in range(num))
+        for worker in workers:
+            worker.start()
+        running = len(workers)
+        try:
+            with tqdm(desc='Videos finished', unit='video',
+                      dynamic_ncols=True,
+                      total=self._num_items()) as progress:
+                while running:
+                    stage, result = _get_result(results, workers,
+                                                len(workers) - running)
+                    if result is None:
+                        running -= 1
+                    elif isinstance(result, str):
+                        raise RuntimeError("Ingestion {} worker failed:\n{}"
+                                           .format(stage, result))
+                    elif isinstance(result, dict):
+                        self._merge_stats(result, progress)
+                    else:
+                        progress.update(result)
+        except BaseException:
+            # workers blocked on a full queue of a dead stage are
+            # terminated as well
+            _stop_workers(workers, [units, decoded, encoded, results])
+            raise
+        for worker in workers:
+            worker.join()
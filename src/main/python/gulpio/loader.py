@@ -1,10 +1,14 @@
 import numpy as np
-import collections
 import sys
 import traceback
 import threading
 from multiprocessing import SimpleQueue, Process
 from gulpio.sampler import SequentialSampler, RandomSampler, BatchSampler
+from gulpio.transforms import Compose
+try:
+    from collections.abc import Sequence
+except ImportError:  # pragma: no cover
+    from collections import Sequence
 # import queue
 string_classes = (str, bytes)
 
@@ -40,7 +44,9 @@ def _worker_loop(dataset, index_queue, data_queue, collate_fn):
 
 
 def default_collate(batch):
-    "Puts each data field into a tensor with outer dimension batch size"
+    """Puts each data field into a tensor with outer dimension batch size.
+    Arrays keep their dtype, so uint8 clips of datasets with deferred
+    normalization are transported and collated as uint8."""
     if type(batch[0]).__module__ == 'numpy':
         elem = batch[0]
         if type(elem).__name__ == 'ndarray':
@@ -49,7 +55,7 @@ def default_collate(batch):
             return batch
     elif isinstance(batch[0], int) or isinstance(batch[0], float):
         return batch
-    elif isinstance(batch[0], collections.Sequence):
+    elif isinstance(batch[0], Sequence):
         transposed = zip(*batch)
         return [default_collate(list(samples)) for samples in transposed]
     raise TypeError(("batch must contain tensors or lists; found {}"
@@ -62,6 +68,7 @@ class DataLoaderIter(object):
     def __init__(self, loader):
         self.dataset = loader.dataset
         self.collate_fn = loader.collate_fn
+        self.batch_transform = loader.batch_transform
         self.batch_sampler = loader.batch_sampler
         self.num_workers = loader.num_workers
         self.done_event = threading.Event()
@@ -98,7 +105,7 @@ class DataLoaderIter(object):
         if self.num_workers == 0:  # same-process loading
             indices = next(self.sample_iter)  # may raise StopIteration
             batch = self.collate_fn([self.dataset[i] for i in indices])
-            return batch
+            return self._transform_batch(batch)
 
         # check if the next sample has already been generated
         if self.rcvd_idx in self.reorder_dict:
@@ -136,7 +143,14 @@ class DataLoaderIter(object):
         self._put_indices()
         if isinstance(batch, ExceptionWrapper):
             raise batch.exc_type(batch.exc_msg)
-        return batch
+        return self._transform_batch(batch)
+
+    def _transform_batch(self, batch):
+        if self.batch_transform is None:
+            return batch
+        if isinstance(batch, list):
+            return [self.batch_transform(batch[0])] + batch[1:]
+        return self.batch_transform(batch)
 
     def __getstate__(self):
         raise NotImplementedError("DataLoaderIterator cannot be pickled")
@@ -176,15 +190,27 @@ class DataLoader(object):
             if the dataset size is not divisible by the batch size. If False and
             the size of dataset is not divisible by the batch size, then the last batch
             will be smaller. (default: False)
+        batch_transform (callable, optional): applied in the main process to
+            every collated batch, or to its first field (the data) if the
+            batch is a list. Runs vectorized transforms such as
+            ``RandHorFlipBatch`` once per batch. If the dataset defers its
+            normalization (``defer_normalize=True``), the dataset's
+            ``batch_transform`` is applied afterwards. (default: None)
     """
 
     def __init__(self, dataset, batch_size=1, shuffle=False, sampler=None, batch_sampler=None,
-                 num_workers=0, collate_fn=default_collate, drop_last=False):
+                 num_workers=0, collate_fn=default_collate, drop_last=False,
+                 batch_transform=None):
         self.dataset = dataset
         self.batch_size = batch_size
         self.num_workers = num_workers
         self.collate_fn = collate_fn
         self.drop_last = drop_last
+        deferred = getattr(dataset, 'batch_transform', None)
+        if deferred is not None:
+            batch_transform = (deferred if batch_transform is None else
+                               Compose([batch_transform, deferred]))
+        self.batch_transform = batch_transform
 
         if batch_sampler is not None:
             if batch_size > 1 or shuffle or sampler is not None or drop_last:
@@ -100,3 +100,324 @@ class BatchSampler(object):
             return len(self.sampler) // self.batch_size
         else:
             return (len(self.sampler) + self.batch_size - 1) // self.batch_size
+
+
+class DistributedSampler(AbstractBaseSampler):
+    """Restricts sampling to the shard of a dataset that belongs to one rank.
+    Every rank draws the same number of samples per epoch, short shards are
+    padded by repeating their own indices. Call ``set_epoch`` at the
+    beginning of every epoch to get a fresh (but rank-consistent) shuffle.
+    Arguments:
+        data_source (Dataset): dataset to sample from
+        num_replicas (int): total number of ranks (world size)
+        rank (int): rank of the current process, ``0 <= rank < num_replicas``
+        shuffle (bool, optional): shuffle the indices (default: True)
+        seed (int, optional): base seed, shared by all ranks (default: 0)
+        chunk_aligned (bool, optional): assign whole gulp chunks to ranks, so
+            each rank only reads its own ``.gulp`` files. Requires a gulp
+            dataset exposing ``gd`` and ``items`` (default: False)
+    Example:
+        >>> sampler = DistributedSampler(dataset, num_replicas=4, rank=0)
+        >>> for epoch in range(num_epochs):
+        ...     sampler.set_epoch(epoch)
+        ...     for data, label in DataLoader(dataset, sampler=sampler):
+        ...         pass
+    """
+
+    def __init__(self, data_source, num_replicas, rank, shuffle=True, seed=0,
+                 chunk_aligned=False):
+        if not 0 <= rank < num_replicas:
+            raise ValueError("rank should be in [0, {}), got {}"
+                             .format(num_replicas, rank))
+        self.data_source = data_source
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.seed = seed
+        self.chunk_aligned = chunk_aligned
+        self.epoch = 0
+        if self.chunk_aligned:
+            self.chunks = self._assign_chunks()
+            self.num_samples = max(self._shard_sizes)
+        else:
+            self.num_samples = -(-len(self.data_source) // self.num_replicas)
+
+    def _assign_chunks(self):
+        """Greedily assign chunks, largest first, to the least loaded rank.
+        The assignment only depends on the chunk sizes, so it is the same on
+        every rank and stays fixed across epochs (keeping page caches warm).
+        """
+        chunk_ids = np.array([self.data_source.gd.chunk_lookup[id_]
+                              for id_, _ in self.data_source.items])
+        unique_ids, inverse = np.unique(chunk_ids, return_inverse=True)
+        if len(unique_ids) < self.num_replicas:
+            raise ValueError("Cannot align {} chunks to {} replicas"
+                             .format(len(unique_ids), self.num_replicas))
+        order = np.argsort(inverse, kind='stable')
+        members = np.split(order, np.cumsum(np.bincount(inverse))[:-1])
+        loads = np.zeros(self.num_replicas, dtype='int64')
+        own_chunks = []
+        for c in sorted(range(len(members)), key=lambda c: -len(members[c])):
+            target = int(np.argmin(loads))
+            loads[target] += len(members[c])
+            if target == self.rank:
+                own_chunks.append(members[c])
+        self._shard_sizes = loads
+        return own_chunks
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _shard(self):
+        rng = np.random.RandomState(self.seed + self.epoch)
+        if self.chunk_aligned:
+            chunks = self.chunks
+            if self.shuffle:
+                chunks = [chunks[i] for i in rng.permutation(len(chunks))]
+                chunks = [rng.permutation(c) for c in chunks]
+            indices = np.concatenate(chunks)
+        else:
+            if self.shuffle:
+                indices = rng.permutation(len(self.data_source))
+            else:
+                indices = np.arange(len(self.data_source))
+            total_size = self.num_samples * self.num_replicas
+            indices = np.resize(indices, total_size)
+            indices = indices[self.rank::self.num_replicas]
+        # pad by wrapping around so that every rank yields num_samples
+        return np.resize(indices, self.num_samples).astype('int64')
+
+    def __iter__(self):
+        return iter(self._shard().tolist())
+
+    def __len__(self):
+        return self.num_samples
+
+
+class BucketBatchSampler(object):
+    """Yields mini-batches of indices of items with similar frame counts, to
+    minimize padding and wasted decoding within a batch. Frame counts are
+    read once from the ``frame_info`` entries of the directory index, no
+    frames are loaded. If the dataset only loads a fixed number of frames
+    (``num_frames > -1``), longer items are treated as equally long.
+    Args:
+        data_source (Dataset): gulp dataset exposing ``items``.
+        batch_size (int): Size of mini-batch.
+        drop_last (bool): If ``True``, the sampler will drop the last batch if
+            its size would be less than ``batch_size``
+        shuffle (bool): Shuffle items of equal length and the order of the
+            batches. Default is True.
+    Example:
+        >>> batch_sampler = BucketBatchSampler(dataset, batch_size=8)
+        >>> loader = DataLoader(dataset, batch_sampler=batch_sampler)
+    """
+
+    def __init__(self, data_source, batch_size, drop_last=False,
+                 shuffle=True):
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+        self.shuffle = shuffle
+        self.lengths = np.fromiter((len(info['frame_info'])
+                                    for _, info in data_source.items),
+                                   dtype='int64',
+                                   count=len(data_source.items))
+        num_frames = getattr(data_source, 'num_frames', -1)
+        if num_frames > -1:
+            self.lengths = np.minimum(self.lengths,
+                                      num_frames * data_source.step_size)
+
+    def __iter__(self):
+        if self.shuffle:
+            # random tie-breaking among items of the same length
+            order = np.lexsort((np.random.rand(len(self.lengths)),
+                                self.lengths))
+        else:
+            order = np.argsort(self.lengths, kind='stable')
+        batches = [order[i:i + self.batch_size]
+                   for i in range(0, len(order), self.batch_size)]
+        if self.drop_last and batches and len(batches[-1]) < self.batch_size:
+            batches.pop()
+        if self.shuffle:
+            batches = [batches[i] for i in np.random.permutation(len(batches))]
+        for batch in batches:
+            yield batch.tolist()
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.lengths) // self.batch_size
+        else:
+            return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+
+class WeightedRandomSampler(AbstractBaseSampler):
+    """Samples elements from ``[0,..,len(weights)-1]`` with given
+    probabilities (weights). Both modes are vectorized: with replacement by
+    inverse transform sampling on the cumulative weights, without
+    replacement by drawing the ``num_samples`` largest random keys
+    ``log(u) / w`` (Efraimidis-Spirakis) with a linear time partition.
+    Arguments:
+        weights (sequence): non-negative weights, need not sum up to one
+        num_samples (int): number of samples to draw
+        replacement (bool): draw with or without replacement (default: True)
+    """
+
+    def __init__(self, weights, num_samples, replacement=True):
+        self.weights = np.asarray(weights, dtype='float64')
+        self.num_samples = num_samples
+        self.replacement = replacement
+        if (self.weights < 0).any() or not self.weights.sum() > 0:
+            raise ValueError("weights should be non-negative and not all 0")
+        if not replacement and num_samples > np.count_nonzero(self.weights):
+            raise ValueError("Cannot draw {} samples without replacement "
+                             "from {} items with non-zero weight"
+                             .format(num_samples,
+                                     np.count_nonzero(self.weights)))
+
+    def _draw(self):
+        if self.replacement:
+            cdf = np.cumsum(self.weights)
+            targets = np.random.rand(self.num_samples) * cdf[-1]
+            # rounding can make a target equal to cdf[-1], which lies past
+            # the end: clip to the last item with a non-zero weight
+            last = np.flatnonzero(self.weights)[-1]
+            return np.minimum(np.searchsorted(cdf, targets, side='right'),
+                              last)
+        with np.errstate(divide='ignore'):
+            keys = np.log(np.random.rand(len(self.weights))) / self.weights
+        if self.num_samples < len(keys):
+            selected = np.argpartition(-keys, self.num_samples)
+            selected = selected[:self.num_samples]
+        else:
+            selected = np.arange(len(keys))
+        return selected[np.argsort(-keys[selected])]
+
+    def __iter__(self):
+        return iter(self._draw().tolist())
+
+    def __len__(self):
+        return self.num_samples
+
+
+class ClassBalancedSampler(WeightedRandomSampler):
+    """Samples elements so that every label is drawn equally often on
+    average. The label of every item is looked up once from the meta data of
+    a ``GulpVideoDataset`` or ``GulpImageDataset``; item weights are the
+    inverse label frequencies.
+    Arguments:
+        data_source (Dataset): gulp dataset exposing ``items`` and
+            ``label2idx``
+        num_samples (int, optional): number of samples to draw per epoch
+            (default: ``len(data_source)``)
+        replacement (bool): draw with or without replacement (default: True)
+    """
+
+    def __init__(self, data_source, num_samples=None, replacement=True):
+        self.labels = self.label_array(data_source)
+        counts = np.bincount(self.labels)
+        weights = 1. / counts[self.labels]
+        if num_samples is None:
+            num_samples = len(self.labels)
+        super().__init__(weights, num_samples, replacement=replacement)
+
+    @staticmethod
+    def label_array(data_source):
+        """Return the label index of every item as a numpy array."""
+        label2idx = data_source.label2idx
+        return np.fromiter((label2idx[info['meta_data'][0]['label']]
+                            for _, info in data_source.items),
+                           dtype='int64',
+                           count=len(data_source.items))
+
+
+def _mix64(x):
+    """splitmix64 finalizer, a cheap and well distributed 64 bit hash."""
+    x = (x + 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & 0xFFFFFFFFFFFFFFFF
+    return x ^ (x >> 31)
+
+
+class FeistelPermutation(object):
+    """A seeded pseudo-random permutation of ``range(size)`` that is never
+    materialized. A balanced Feistel network is a bijection on the smallest
+    even-bit domain covering ``size``; values outside of ``range(size)`` are
+    mapped again (cycle walking) until they fall inside. Any position can be
+    evaluated in O(1) time and memory.
+    Arguments:
+        size (int): number of elements to permute
+        seed (int, optional): permutation seed (default: 0)
+        rounds (int, optional): number of Feistel rounds (default: 4)
+    Example:
+        >>> perm = FeistelPermutation(10, seed=1)
+        >>> sorted(perm[i] for i in range(10))
+        [0, 1, 2, 3, 4, 5, 6, 7, 8, 9]
+    """
+
+    def __init__(self, size, seed=0, rounds=4):
+        self.size = size
+        self.half_bits = (max(2, (size - 1).bit_length()) + 1) // 2
+        self.mask = (1 << self.half_bits) - 1
+        self.keys = [_mix64(_mix64(seed) + r) for r in range(rounds)]
+
+    def _encrypt(self, x):
+        left, right = x >> self.half_bits, x & self.mask
+        for key in self.keys:
+            left, right = right, left ^ (_mix64(right ^ key) & self.mask)
+        return (left << self.half_bits) | right
+
+    def __getitem__(self, position):
+        if not 0 <= position < self.size:
+            raise IndexError("position {} out of range".format(position))
+        x = self._encrypt(position)
+        while x >= self.size:
+            x = self._encrypt(x)
+        return x
+
+    def __len__(self):
+        return self.size
+
+
+class PermutationSampler(AbstractBaseSampler):
+    """Samples elements randomly, without replacement, in constant memory.
+    Unlike ``RandomSampler`` the permutation is computed on the fly with a
+    ``FeistelPermutation``, so there is no startup cost, iteration can be
+    resumed at any position and the dataset can be sharded across ranks
+    (each rank takes every ``num_replicas``-th position, short shards wrap
+    around). Call ``set_epoch`` to get a fresh permutation per epoch.
+    Arguments:
+        data_source (Dataset): dataset to sample from
+        seed (int, optional): base seed, shared by all ranks (default: 0)
+        num_replicas (int, optional): total number of ranks (default: 1)
+        rank (int, optional): rank of the current process (default: 0)
+        start (int, optional): number of samples of this rank to skip, to
+            resume within an epoch (default: 0)
+    """
+
+    def __init__(self, data_source, seed=0, num_replicas=1, rank=0, start=0):
+        if not 0 <= rank < num_replicas:
+            raise ValueError("rank should be in [0, {}), got {}"
+                             .format(num_replicas, rank))
+        self.data_source = data_source
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.start = start
+        self.epoch = 0
+        self.num_samples = -(-len(self.data_source) // self.num_replicas)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def permutation(self):
+        """Return the ``FeistelPermutation`` of the current epoch."""
+        return FeistelPermutation(len(self.data_source),
+                                  seed=_mix64(self.seed) ^ self.epoch)
+
+    def __iter__(self):
+        perm = self.permutation()
+        size = len(perm)
+        for k in range(self.start, self.num_samples):
+            yield perm[(self.rank + k * self.num_replicas) % size]
+
+    def __len__(self):
+        return max(0, self.num_samples - self.start)
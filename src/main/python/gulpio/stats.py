@@ -0,0 +1,161 @@
+"""Throughput statistics of an ingestion.
+
+Ingestion workers time the stages of writing an item: reading (decoding
+the source with ffmpeg or OpenCV), resizing, JPEG encoding, and writing to
+the chunk. They also count items, frames and bytes, and keep the slowest
+items. All of this goes into the `IngestionStats` recording in the process,
+see `recording`. Outside of `recording` the timers do nothing. The ingestor
+merges the stats of all workers and turns them into a JSON serializable
+report.
+"""
+
+import time
+import heapq
+import threading
+
+from contextlib import contextmanager
+
+
+STAGES = ('read', 'resize', 'encode', 'write')
+
+_recording = None
+
+
+class IngestionStats(object):
+    """Accumulates the stage timings, the counts and the slowest items of
+    an ingestion. It is safe to add to the stats from several threads.
+
+    Parameters
+    ----------
+    num_slowest: (int)
+        The number of slowest items to keep.
+
+    """
+
+    def __init__(self, num_slowest=10):
+        self.num_slowest = num_slowest
+        self._lock = threading.Lock()
+        self._last_pop = time.perf_counter()
+        self.reset()
+
+    def reset(self):
+        self.stage_seconds = dict.fromkeys(STAGES, 0.)
+        self.items = 0
+        self.frames = 0
+        self.bytes = 0
+        # min-heap of (seconds, id, frames, bytes)
+        self.slowest = []
+
+    def _keep_if_slow(self, item):
+        if len(self.slowest) < self.num_slowest:
+            heapq.heappush(self.slowest, item)
+        elif self.num_slowest > 0:
+            heapq.heappushpop(self.slowest, item)
+
+    def add_time(self, stage, seconds):
+        with self._lock:
+            self.stage_seconds[stage] = (self.stage_seconds.get(stage, 0.) +
+                                         seconds)
+
+    def add_item(self, id_, seconds, num_frames, num_bytes):
+        """Count a written item, which took `seconds` from reading to
+        writing."""
+        with self._lock:
+            self.items += 1
+            self.frames += num_frames
+            self.bytes += num_bytes
+            self._keep_if_slow((seconds, str(id_), num_frames, num_bytes))
+
+    def state(self):
+        """Return the stats as a dict that can be sent to another process
+        and merged there."""
+        return {'stage_seconds': dict(self.stage_seconds),
+                'items': self.items,
+                'frames': self.frames,
+                'bytes': self.bytes,
+                'slowest': list(self.slowest)}
+
+    def pop_state(self, min_interval=0.):
+        """Return the state and reset the stats, or None if less than
+        `min_interval` seconds passed since the last call."""
+        with self._lock:
+            now = time.perf_counter()
+            if now - self._last_pop < min_interval:
+                return None
+            self._last_pop = now
+            state = self.state()
+            self.reset()
+        return state
+
+    def merge(self, state):
+        """Add the `state` of other stats."""
+        with self._lock:
+            for stage, seconds in state['stage_seconds'].items():
+                self.stage_seconds[stage] = (
+                    self.stage_seconds.get(stage, 0.) + seconds)
+            self.items += state['items']
+            self.frames += state['frames']
+            self.bytes += state['bytes']
+            for item in state['slowest']:
+                self._keep_if_slow(tuple(item))
+
+    def report(self, elapsed_seconds):
+        """Return a JSON serializable report of an ingestion that ran for
+        `elapsed_seconds`. Rates are per second of wall time, the stage
+        timings are summed over all workers (and threads)."""
+        def per(amount, total):
+            return amount / total if total > 0 else 0.
+        return {'elapsed_seconds': elapsed_seconds,
+                'items': self.items,
+                'frames': self.frames,
+                'bytes': self.bytes,
+                'frames_per_second': per(self.frames, elapsed_seconds),
+                'bytes_per_second': per(self.bytes, elapsed_seconds),
+                'bytes_per_frame': per(self.bytes, self.frames),
+                'stage_seconds': dict(self.stage_seconds),
+                'slowest_items': [
+                    {'id': id_, 'seconds': seconds, 'frames': num_frames,
+                     'bytes': num_bytes}
+                    for seconds, id_, num_frames, num_bytes in
+                    sorted(self.slowest, reverse=True)],
+                }
+
+
+def active_stats():
+    """Return the `IngestionStats` recording in this process, or None."""
+    return _recording
+
+
+@contextmanager
+def recording(stats=None):
+    """Record into `stats` (a new `IngestionStats` if None) within the
+    context, which yields the stats."""
+    global _recording
+    if stats is None:
+        stats = IngestionStats()
+    previous, _recording = _recording, stats
+    try:
+        yield stats
+    finally:
+        _recording = previous
+
+
+@contextmanager
+def timed(stage):
+    """Add the time spent within the context to `stage` of the recording
+    stats."""
+    stats = _recording
+    if stats is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats.add_time(stage, time.perf_counter() - start)
+
+
+def record_item(id_, seconds, num_frames, num_bytes):
+    """Count a written item in the recording stats."""
+    if _recording is not None:
+        _recording.add_item(id_, seconds, num_frames, num_bytes)
@@ -1,27 +1,44 @@
 from __future__ import division
+import os
 import random
 import numbers
-import collections
 import numpy as np
 import cv2
 
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from collections.abc import Iterable
+except ImportError:  # pragma: no cover
+    from collections import Iterable
+
 
 class Compose(object):
     r"""Composes several transforms together. It is for image problems
 
     Args:
         transforms (List[Transform]): list of transforms to compose.
+        optimize (bool or str): rewrite the transforms into a cheaper
+            equivalent with ``optimize_transforms``. ``True`` only applies
+            exact rewrites, ``'approximate'`` applies all of them. Default is
+            False.
 
     Example:
         >>> transforms = [transforms.Normalize()]
         >>> transforms.Compose(transforms)
     """
 
-    def __init__(self, transforms):
+    def __init__(self, transforms, optimize=False):
         self.transforms = transforms
+        self.optimize = optimize
+        self.plan = transforms
+        if optimize:
+            self.plan = optimize_transforms(
+                transforms, approximate=optimize == 'approximate')
 
     def __call__(self, img):
-        for t in self.transforms:
+        for t in self.plan:
             img = t(img)
         return img
 
@@ -35,6 +52,17 @@ class ComposeVideo(object):
     Args:
         img_transforms (List[Transform]): list of transforms to compose.
         video_transforms (List[Transform]): list of transforms to compose.
+        optimize (bool or str): rewrite the transforms into a cheaper
+            equivalent, see ``Compose``. Additionally, if all image transforms
+            are pointwise (``Normalize``), leading crops and flips of the
+            video transforms are applied first. Default is False.
+        num_threads (int): apply the image transforms to the frames of a
+            video in a pool of ``num_threads`` threads. OpenCV releases the
+            GIL, so this uses several cores for long videos when there are
+            few loader workers. Every frame runs through all image
+            transforms in one task, random image transforms are therefore
+            not reproducible with a fixed seed. Default is 1, i.e. no
+            threads.
 
     Example:
         >>> img_transforms = [transforms.Normalize()]
@@ -42,15 +70,57 @@ class ComposeVideo(object):
         >>> transforms.ComposeVideo(img_transforms, video_transforms)
     """
 
-    def __init__(self, img_transforms=[], video_transforms=[]):
+    def __init__(self, img_transforms=[], video_transforms=[],
+                 optimize=False, num_threads=1):
         self.img_transforms = img_transforms
         self.video_transforms = video_transforms
+        self.optimize = optimize
+        self.pre_video_plan = []
+        self.img_plan = img_transforms
+        self.video_plan = video_transforms
+        if optimize:
+            approximate = optimize == 'approximate'
+            video_plan = list(video_transforms)
+            if all(_is_pointwise(t) for t in img_transforms):
+                while video_plan and _is_geometric(video_plan[0]):
+                    self.pre_video_plan.append(video_plan.pop(0))
+            self.img_plan = optimize_transforms(img_transforms,
+                                                approximate=approximate)
+            self.video_plan = optimize_transforms(video_plan,
+                                                  approximate=approximate)
+        self.num_threads = num_threads
+        self._pool = None
+        self._pid = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_pool'] = state['_pid'] = None
+        return state
+
+    def _thread_pool(self):
+        # threads do not survive a fork, start a new pool in every process
+        if self._pid != os.getpid():
+            self._pool = ThreadPoolExecutor(self.num_threads)
+            self._pid = os.getpid()
+        return self._pool
+
+    def _apply_img_plan(self, img):
+        for t in self.img_plan:
+            img = t(img)
+        return img
 
     def __call__(self, imgs):
-        for t in self.img_transforms:
-            for idx, img in enumerate(imgs):
-                imgs[idx] = t(img)
-        for t in self.video_transforms:
+        for t in self.pre_video_plan:
+            imgs = t(imgs)
+        if self.img_plan and isinstance(imgs, np.ndarray):
+            imgs = list(imgs)
+        if self.img_plan and self.num_threads > 1 and len(imgs) > 1:
+            imgs[:] = self._thread_pool().map(self._apply_img_plan, imgs)
+        else:
+            for t in self.img_plan:
+                for idx, img in enumerate(imgs):
+                    imgs[idx] = t(img)
+        for t in self.video_plan:
             imgs = t(imgs)
         return imgs
 
@@ -322,7 +392,8 @@ class Scale(object):
     """
 
     def __init__(self, size, interpolation=cv2.INTER_LINEAR):
-        assert isinstance(size, int) or (isinstance(size, collections.Iterable) and len(size) == 2)
+        assert isinstance(size, int) or (isinstance(size, Iterable) and
+                                         len(size) == 2)
         self.size = size
         self.interpolation = interpolation
 
@@ -353,3 +424,735 @@ class Scale(object):
                     return cv2.resize(img, (ow, oh))
         else:
             return cv2.resize(img, tuple(self.size))
+
+
+class CropResizeNormalize(object):
+    """Crop, resize, convert and normalize an image in a single pass. The
+    crop is a view of the input, it is resized straight to the output size
+    and normalized into a newly allocated ``dtype`` array with in-place
+    operations, so no float64 or full resolution temporaries are created.
+    The result matches ``CenterCrop`` (or ``RandomCrop``), ``Scale`` and
+    ``Normalize`` applied in sequence, up to the precision of ``dtype``.
+    Args:
+        size (sequence or int): Output size (h, w). If size is an int, the
+            output is square.
+        mean (sequence): Sequence of means for R, G, B channels respecitvely.
+        std (sequence): Sequence of standard deviations for R, G, B channels
+            respecitvely.
+        crop_size (sequence or int, optional): Size (h, w) of the region to
+            crop from the input before resizing. Default is None, i.e. the
+            whole image.
+        random_crop (bool, optional): Crop at a random location instead of
+            the center. Default is False.
+        interpolation (int, optional): Desired interpolation. Default is
+            ``cv2.INTER_LINEAR``
+        dtype (numpy dtype, optional): Output dtype. Default is float32.
+    """
+
+    def __init__(self, size, mean, std, crop_size=None, random_crop=False,
+                 interpolation=cv2.INTER_LINEAR, dtype=np.float32):
+        if isinstance(size, numbers.Number):
+            self.size = (int(size), int(size))
+        else:
+            self.size = tuple(size)
+        if isinstance(crop_size, numbers.Number):
+            self.crop_size = (int(crop_size), int(crop_size))
+        else:
+            self.crop_size = crop_size
+        self.random_crop = random_crop
+        self.interpolation = interpolation
+        self.dtype = np.dtype(dtype)
+        self.mean = np.asarray(mean, dtype=self.dtype)
+        self.scale = (1. / (np.asarray(std) + 1e-8)).astype(self.dtype)
+
+    def crop_box(self, h, w):
+        """Return the crop (y1, x1, height, width) for an image of size
+        (h, w)."""
+        if self.crop_size is None:
+            return 0, 0, h, w
+        th, tw = self.crop_size
+        if th > h or tw > w:
+            raise ValueError("Crop size {} exceeds image size {}"
+                             .format(self.crop_size, (h, w)))
+        if self.random_crop:
+            return random.randint(0, h - th), random.randint(0, w - tw), th, tw
+        return int(round((h - th) / 2.)), int(round((w - tw) / 2.)), th, tw
+
+    def __call__(self, img):
+        """
+        Args:
+            img (numpy.array): Image to be transformed.
+        Returns:
+            numpy.array: Normalized image of size ``size`` and type ``dtype``.
+        """
+        y1, x1, th, tw = self.crop_box(*img.shape[:2])
+        img = img[y1:y1 + th, x1:x1 + tw]
+        oh, ow = self.size
+        if (th, tw) != (oh, ow):
+            img = cv2.resize(img, (ow, oh), interpolation=self.interpolation)
+        out = np.empty(img.shape, dtype=self.dtype)
+        np.subtract(img, self.mean, out=out)
+        np.multiply(out, self.scale, out=out)
+        return out
+
+
+###############################################################################
+#                   Transforms on stacked clips (T, H, W, C)                  #
+###############################################################################
+
+_NUMPY_PAD_MODES = {cv2.BORDER_CONSTANT: 'constant',
+                    cv2.BORDER_REPLICATE: 'edge',
+                    cv2.BORDER_REFLECT: 'symmetric',
+                    cv2.BORDER_REFLECT_101: 'reflect',
+                    cv2.BORDER_WRAP: 'wrap'}
+
+
+def _as_clip(imgs):
+    """Stack a list of frames into a (T, H, W[, C]) array, arrays are passed
+    through as they are."""
+    if isinstance(imgs, np.ndarray):
+        return imgs
+    return np.stack(imgs)
+
+
+def _pad_clip(clip, padding, pad_method=cv2.BORDER_CONSTANT):
+    """Pad the spatial dimensions of all frames of a clip at once."""
+    pad_width = [(0, 0), (padding, padding), (padding, padding)]
+    pad_width += [(0, 0)] * (clip.ndim - 3)
+    return np.pad(clip, pad_width, mode=_NUMPY_PAD_MODES[pad_method])
+
+
+class RandHorFlipClip(object):
+    r"""Apply random horizontal flip to a clip of shape (T, H, W[, C]).
+    The flip is a view, no pixels are copied. Use with ``Compose``.
+    """
+
+    def __call__(self, clip):
+        clip = _as_clip(clip)
+        if random.random() < 0.5:
+            clip = clip[:, :, ::-1]
+        return clip
+
+
+class RandVerFlipClip(object):
+    r"""Apply random vertical flip to a clip of shape (T, H, W[, C]).
+    The flip is a view, no pixels are copied. Use with ``Compose``.
+    """
+
+    def __call__(self, clip):
+        clip = _as_clip(clip)
+        if random.random() < 0.5:
+            clip = clip[:, ::-1]
+        return clip
+
+
+class CenterCropClip(object):
+    r"""Crops all frames of a clip of shape (T, H, W[, C]) at the center with
+    a single slicing operation.
+    Args:
+        size (sequence or int): Desired output size (h, w) of the crop. If
+            size is an int, a square crop (size, size) is made.
+    """
+
+    def __init__(self, size):
+        if isinstance(size, numbers.Number):
+            self.size = (int(size), int(size))
+        else:
+            self.size = size
+
+    def __call__(self, clip):
+        """
+        Args:
+            clip (numpy.array or list): Clip to be cropped.
+        Returns:
+            numpy.array: Cropped clip (a view of the input).
+        """
+        clip = _as_clip(clip)
+        h, w = clip.shape[1:3]
+        th, tw = self.size
+        x1 = int(round((w - tw) / 2.))
+        y1 = int(round((h - th) / 2.))
+        return clip[:, y1: y1 + th, x1: x1 + tw]
+
+
+class RandomCropClip(object):
+    """Crop all frames of a clip of shape (T, H, W[, C]) at the same random
+    location with a single slicing operation.
+    Args:
+        size (sequence or int): Desired output size (h, w) of the crop. If
+            size is an int, a square crop (size, size) is made.
+        padding (int, optional): Optional padding on each border of the
+            frames. Default is 0, i.e no padding.
+        pad_method (cv2 constant): Method to be used for padding.
+    """
+
+    def __init__(self, size, padding=0, pad_method=cv2.BORDER_CONSTANT):
+        if isinstance(size, numbers.Number):
+            self.size = (int(size), int(size))
+        else:
+            self.size = size
+        self.padding = padding
+        self.pad_method = pad_method
+
+    def __call__(self, clip):
+        """
+        Args:
+            clip (numpy.array or list): Clip to be cropped.
+        Returns:
+            numpy.array: Cropped clip (a view, unless padding is used).
+        """
+        clip = _as_clip(clip)
+        if self.padding > 0:
+            clip = _pad_clip(clip, self.padding, self.pad_method)
+        th, tw = self.size
+        h, w = clip.shape[1:3]
+        x1 = random.randint(0, w - tw)
+        y1 = random.randint(0, h - th)
+        return clip[:, y1:y1+th, x1:x1+tw]
+
+
+class JitterCropClip(object):
+    """Random cropping of a clip of shape (T, H, W[, C]) with pre-defined set
+    of w and h, the same crop for all frames.
+    Args:
+        sample_sizes (sequence, optional): possible crop sizes.
+        padding (int, optional): Optional padding on each border of the
+            frames. Default is 0, i.e no padding.
+    """
+
+    def __init__(self, sample_sizes=[256, 224, 192, 168], padding=0):
+        self.padding = padding
+        self.sample_sizes = sample_sizes
+
+    def __call__(self, clip):
+        """
+        Args:
+            clip (numpy.array or list): Clip to be cropped.
+        Returns:
+            numpy.array: Cropped clip (a view, unless padding is used).
+        """
+        clip = _as_clip(clip)
+        if self.padding > 0:
+            clip = _pad_clip(clip, self.padding)
+        sample_w = random.choice(self.sample_sizes)
+        sample_h = random.choice(self.sample_sizes)
+        h, w = clip.shape[1:3]
+        x1 = random.randint(0, w - sample_w)
+        y1 = random.randint(0, h - sample_h)
+        return clip[:, y1:y1+sample_h, x1:x1+sample_w]
+
+
+class ScaleClip(object):
+    """Rescale all frames of a clip of shape (T, H, W[, C]) to the given size.
+    The output is allocated once and every frame is resized straight into
+    it, there are no per-frame temporaries.
+    Args:
+        size (sequence or int): Desired output size. If size is a sequence like
+            (w, h), output size will be matched to this. If size is an int,
+            smaller edge of the frames will be matched to this number.
+        interpolation (int, optional): Desired interpolation. Default is
+            ``cv2.INTER_LINEAR``
+    """
+
+    def __init__(self, size, interpolation=cv2.INTER_LINEAR):
+        assert isinstance(size, int) or (isinstance(size, Iterable) and
+                                         len(size) == 2)
+        self.size = size
+        self.interpolation = interpolation
+
+    def output_size(self, h, w):
+        """Return the output size (w, h) for frames of height h, width w."""
+        if not isinstance(self.size, int):
+            return tuple(self.size)
+        if w < h:
+            return self.size, int(self.size * h / w)
+        return int(self.size * w / h), self.size
+
+    def __call__(self, clip):
+        """
+        Args:
+            clip (numpy.array or list): Clip to be scaled.
+        Returns:
+            numpy.array: Rescaled clip.
+        """
+        clip = _as_clip(clip)
+        h, w = clip.shape[1:3]
+        ow, oh = self.output_size(h, w)
+        if (ow, oh) == (w, h):
+            return clip
+        out = np.empty((len(clip), oh, ow) + clip.shape[3:], dtype=clip.dtype)
+        for frame, frame_out in zip(clip, out):
+            cv2.resize(frame, (ow, oh), dst=frame_out,
+                       interpolation=self.interpolation)
+        return out
+
+
+class MultiCropClip(object):
+    """Test time augmentation: take several crops (and their horizontal
+    flips) of a clip of shape (T, H, W[, C]). All views are strided views of
+    the input, they are copied once into the output of shape
+    (V, T, h, w[, C]).
+    Args:
+        size (sequence or int): Desired output size (h, w) of the crops. If
+            size is an int, square crops (size, size) are made.
+        num_crops (int): 1 (center), 3 (start, center and end of the longer
+            side), 5 (four corners and center) or 10 (5 crops and their
+            horizontal flips). Default is 10.
+        flip (bool): add the horizontal flip of every crop. Default is
+            False, 10 crops are the flipped 5 crops.
+    """
+
+    _NUM_CROPS = (1, 3, 5, 10)
+
+    def __init__(self, size, num_crops=10, flip=False):
+        if isinstance(size, numbers.Number):
+            self.size = (int(size), int(size))
+        else:
+            self.size = size
+        if num_crops not in self._NUM_CROPS:
+            raise ValueError("num_crops must be one of {}"
+                             .format(self._NUM_CROPS))
+        self.num_crops = num_crops
+        self.flip = flip or num_crops == 10
+
+    def crop_positions(self, h, w):
+        """Return the (y1, x1) of the crops, without flips."""
+        th, tw = self.size
+        if th > h or tw > w:
+            raise ValueError("Crop size {} exceeds image size {}"
+                             .format(self.size, (h, w)))
+        center = (int(round((h - th) / 2.)), int(round((w - tw) / 2.)))
+        if self.num_crops == 1:
+            return [center]
+        if self.num_crops == 3:
+            if h > w:
+                return [(0, center[1]), center, (h - th, center[1])]
+            return [(center[0], 0), center, (center[0], w - tw)]
+        return [(0, 0), (0, w - tw), (h - th, 0), (h - th, w - tw), center]
+
+    def __call__(self, clip):
+        """
+        Args:
+            clip (numpy.array or list): Clip to be cropped.
+        Returns:
+            numpy.array: Views of shape (V, T, h, w[, C]).
+        """
+        clip = _as_clip(clip)
+        th, tw = self.size
+        views = [clip[:, y1:y1 + th, x1:x1 + tw]
+                 for y1, x1 in self.crop_positions(*clip.shape[1:3])]
+        if self.flip:
+            views += [view[:, :, ::-1] for view in views]
+        return np.stack(views)
+
+
+###############################################################################
+#               Transforms on collated batches (B, [T,] H, W, C)              #
+###############################################################################
+
+class RandHorFlipBatch(object):
+    r"""Flip every sample of a batch of shape (B, [T,] H, W, C) horizontally
+    with probability ``p``, using a single masked assignment. The batch is
+    modified in place. Use as ``DataLoader(batch_transform=...)``.
+    Args:
+        p (float): Probability of a sample being flipped. Default is 0.5.
+    """
+
+    def __init__(self, p=0.5):
+        self.p = p
+
+    def __call__(self, batch):
+        mask = np.random.rand(len(batch)) < self.p
+        batch[mask] = batch[mask][..., ::-1, :]
+        return batch
+
+
+class RandVerFlipBatch(object):
+    r"""Flip every sample of a batch of shape (B, [T,] H, W, C) vertically
+    with probability ``p``, using a single masked assignment. The batch is
+    modified in place.
+    Args:
+        p (float): Probability of a sample being flipped. Default is 0.5.
+    """
+
+    def __init__(self, p=0.5):
+        self.p = p
+
+    def __call__(self, batch):
+        mask = np.random.rand(len(batch)) < self.p
+        batch[mask] = batch[mask][..., ::-1, :, :]
+        return batch
+
+
+class CenterCropBatch(object):
+    r"""Crop all samples of a batch of shape (B, [T,] H, W, C) at the center.
+    Args:
+        size (sequence or int): Desired output size (h, w) of the crop. If
+            size is an int, a square crop (size, size) is made.
+    """
+
+    def __init__(self, size):
+        if isinstance(size, numbers.Number):
+            self.size = (int(size), int(size))
+        else:
+            self.size = size
+
+    def __call__(self, batch):
+        """
+        Args:
+            batch (numpy.array): Batch to be cropped.
+        Returns:
+            numpy.array: Cropped batch (a view of the input).
+        """
+        h, w = batch.shape[-3:-1]
+        th, tw = self.size
+        x1 = int(round((w - tw) / 2.))
+        y1 = int(round((h - th) / 2.))
+        return batch[..., y1:y1 + th, x1:x1 + tw, :]
+
+
+class RandomCropBatch(object):
+    r"""Crop every sample of a batch of shape (B, [T,] H, W, C) at its own
+    random location, all frames of a sample get the same crop. The crops
+    are strided views of the batch, copied once into the output.
+    Args:
+        size (sequence or int): Desired output size (h, w) of the crop. If
+            size is an int, a square crop (size, size) is made.
+    """
+
+    def __init__(self, size):
+        if isinstance(size, numbers.Number):
+            self.size = (int(size), int(size))
+        else:
+            self.size = size
+
+    def __call__(self, batch):
+        """
+        Args:
+            batch (numpy.array): Batch to be cropped.
+        Returns:
+            numpy.array: Cropped batch.
+        """
+        h, w = batch.shape[-3:-1]
+        th, tw = self.size
+        if th > h or tw > w:
+            raise ValueError("Crop size {} exceeds image size {}"
+                             .format(self.size, (h, w)))
+        y1 = np.random.randint(0, h - th + 1, size=len(batch))
+        x1 = np.random.randint(0, w - tw + 1, size=len(batch))
+        out = np.empty(batch.shape[:-3] + (th, tw, batch.shape[-1]),
+                       dtype=batch.dtype)
+        for sample, sample_out, y, x in zip(batch, out, y1, x1):
+            sample_out[...] = sample[..., y:y + th, x:x + tw, :]
+        return out
+
+
+class NormalizeBatch(object):
+    r"""Normalize a batch of shape (B, [T,] H, W, C) with the given means and
+    standard deviations of the channels. Floating point batches of
+    ``dtype`` are normalized in place, others are converted into a single
+    newly allocated ``dtype`` array.
+    Args:
+        mean (sequence): Sequence of means for R, G, B channels respecitvely.
+        std (sequence): Sequence of standard deviations for R, G, B channels
+            respecitvely.
+        dtype (numpy dtype, optional): Output dtype. Default is float32.
+    """
+
+    def __init__(self, mean, std, dtype=np.float32):
+        self.dtype = np.dtype(dtype)
+        self.mean = np.asarray(mean, dtype=self.dtype)
+        self.scale = (1. / (np.asarray(std) + 1e-8)).astype(self.dtype)
+
+    def __call__(self, batch):
+        if batch.dtype == self.dtype and batch.flags.writeable:
+            out = batch
+        else:
+            out = np.empty(batch.shape, dtype=self.dtype)
+        np.subtract(batch, self.mean, out=out)
+        np.multiply(out, self.scale, out=out)
+        return out
+
+
+###############################################################################
+#                            Pipeline optimization                            #
+###############################################################################
+
+def _is_pointwise(t):
+    """Transforms that map every pixel value independently."""
+    return isinstance(t, (Normalize, _LookupNormalize))
+
+
+def _is_geometric(t):
+    """Transforms that only select or move pixels (crops and flips without
+    padding), so they commute with pointwise transforms."""
+    if isinstance(t, (RandHorFlipVideo, RandVerFlipVideo, RandHorFlipClip,
+                      RandVerFlipClip, CenterCrop, CenterCropClip,
+                      _ChainedCenterCrop)):
+        return True
+    if isinstance(t, (RandomCrop, RandomCropVideo, RandomCropClip,
+                      JitterCrop, JitterCropVideo, JitterCropClip)):
+        return t.padding == 0
+    return False
+
+
+class _LookupNormalize(object):
+    """``Normalize`` through a 256 entry lookup table for uint8 images, other
+    inputs are passed on to the wrapped ``Normalize``. Exact."""
+
+    def __init__(self, normalize):
+        self.normalize = normalize
+        values = np.arange(256, dtype='float64')[:, np.newaxis]
+        table = (values - normalize.mean) / (normalize.std + 1e-8)
+        self.table = np.ascontiguousarray(table.reshape(1, 256, -1))
+
+    def __call__(self, img):
+        channels = 1 if img.ndim == 2 else img.shape[2]
+        if (img.dtype != np.uint8 or channels > 4 or
+                self.table.shape[2] not in (1, channels)):
+            return self.normalize(img)
+        return cv2.LUT(img, self.table)
+
+
+class _ChainedCenterCrop(object):
+    """Consecutive ``CenterCrop`` transforms as a single slice. Exact, falls
+    back to the single crops if any of them needs to scale the image."""
+
+    def __init__(self, crops):
+        self.crops = crops
+
+    def __call__(self, img):
+        h, w = img.shape[:2]
+        y1 = x1 = 0
+        for crop in self.crops:
+            th, tw = crop.size
+            if th > h or tw > w or crop.size[0] > w or crop.size[1] > h:
+                for crop in self.crops:
+                    img = crop(img)
+                return img
+            y1 += int(round((h - th) / 2.))
+            x1 += int(round((w - tw) / 2.))
+            h, w = th, tw
+        return img[y1:y1 + h, x1:x1 + w]
+
+
+class _ScaledCrop(object):
+    """``Scale`` followed by ``CenterCrop`` or ``RandomCrop``, computed by
+    sampling only the cropped region from the source image with a single
+    affine warp that uses the same pixel mapping as ``cv2.resize``.
+    Approximate: the geometry (and random crop location, given the same
+    random state) is identical, but ``cv2.warpAffine`` rounds the sampling
+    positions to 1/32 pixel. Pixel values therefore differ by at most 9
+    intensity levels (255 times 1/32 pixel, plus rounding) at sharp edges,
+    and by much less in smooth regions."""
+
+    def __init__(self, scale, crop):
+        self.scale = scale
+        self.crop = crop
+        self.size_of = ScaleClip(scale.size).output_size
+
+    def __call__(self, img):
+        h, w = img.shape[:2]
+        if isinstance(self.scale.size, int) and (
+                (w <= h and w == self.scale.size) or
+                (h <= w and h == self.scale.size)):
+            return self.crop(img)
+        ow, oh = self.size_of(h, w)
+        th, tw = self.crop.size
+        if th > oh or tw > ow:
+            return self.crop(self.scale(img))
+        if isinstance(self.crop, RandomCrop):
+            x1 = random.randint(0, ow - tw)
+            y1 = random.randint(0, oh - th)
+        else:
+            x1 = int(round((ow - tw) / 2.))
+            y1 = int(round((oh - th) / 2.))
+        fx, fy = w / ow, h / oh
+        matrix = np.array([[fx, 0, (x1 + 0.5) * fx - 0.5],
+                           [0, fy, (y1 + 0.5) * fy - 0.5]])
+        return cv2.warpAffine(img, matrix, (tw, th),
+                              flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP,
+                              borderMode=cv2.BORDER_REPLICATE)
+
+
+def optimize_transforms(transforms, approximate=False):
+    """Rewrite a list of transforms into a cheaper equivalent.
+
+    Exact rewrites:
+        - crops and flips (without padding) are moved in front of
+          ``Normalize``, so they run on the smaller uint8 data
+        - consecutive ``CenterCrop`` transforms become a single slice
+        - ``Normalize`` uses a lookup table for uint8 input
+
+    Approximate rewrites (only with ``approximate=True``):
+        - ``Scale`` followed by ``CenterCrop`` or ``RandomCrop`` (without
+          padding) only resamples the cropped region. The geometry is
+          identical, pixel values differ by at most 9 intensity levels
+          (8 bit) at sharp edges and much less in smooth regions.
+
+    Args:
+        transforms (List[Transform]): list of transforms.
+        approximate (bool): also apply approximate rewrites.
+    Returns:
+        List[Transform]: the rewritten transforms.
+    """
+    plan = list(transforms)
+    # bubble crops and flips in front of pointwise transforms
+    swapped = True
+    while swapped:
+        swapped = False
+        for i in range(len(plan) - 1):
+            if _is_pointwise(plan[i]) and _is_geometric(plan[i + 1]):
+                plan[i], plan[i + 1] = plan[i + 1], plan[i]
+                swapped = True
+    rewritten = []
+    for t in plan:
+        previous = rewritten[-1] if rewritten else None
+        if (approximate and isinstance(previous, Scale) and
+                (isinstance(t, CenterCrop) or
+                 (isinstance(t, RandomCrop) and t.padding == 0))):
+            rewritten[-1] = _ScaledCrop(previous, t)
+        elif isinstance(t, CenterCrop) and isinstance(previous, CenterCrop):
+            rewritten[-1] = _ChainedCenterCrop([previous, t])
+        elif (isinstance(t, CenterCrop) and
+                isinstance(previous, _ChainedCenterCrop)):
+            rewritten[-1] = _ChainedCenterCrop(previous.crops + [t])
+        elif isinstance(t, Normalize):
+            rewritten.append(_LookupNormalize(t))
+        else:
+            rewritten.append(t)
+    return rewritten
+
+
+def defer_normalize(transform, dtype=np.float32):
+    """Split the normalization off a transform, so that samples stay uint8
+    until they are collated and the batch is normalized at once on the
+    consumer side. A single ``Normalize`` is removed from a ``Compose`` or
+    ``ComposeVideo`` if only crops and flips (without padding) follow it.
+    Args:
+        transform (callable): ``Normalize``, ``Compose``, ``ComposeVideo``
+            or None.
+        dtype (numpy dtype): Output dtype of the batch normalization.
+    Returns:
+        (callable, NormalizeBatch): the transform without normalization and
+        the equivalent batch normalization. If nothing can be deferred the
+        transform is returned as is, together with None.
+    """
+    if isinstance(transform, Normalize):
+        return None, NormalizeBatch(transform.mean, transform.std, dtype)
+    if isinstance(transform, Compose):
+        stages = [transform.transforms]
+    elif isinstance(transform, ComposeVideo):
+        stages = [transform.img_transforms, transform.video_transforms]
+    else:
+        return transform, None
+    flat = [t for stage in stages for t in stage]
+    positions = [i for i, t in enumerate(flat) if isinstance(t, Normalize)]
+    if (len(positions) != 1 or
+            not all(_is_geometric(t) for t in flat[positions[0] + 1:])):
+        return transform, None
+    normalize = flat[positions[0]]
+    stages = [[t for t in stage if t is not normalize] for stage in stages]
+    if isinstance(transform, Compose):
+        remaining = Compose(stages[0], optimize=transform.optimize)
+    else:
+        remaining = ComposeVideo(stages[0], stages[1],
+                                 optimize=transform.optimize)
+    return remaining, NormalizeBatch(normalize.mean, normalize.std, dtype)
+
+
+###############################################################################
+#                          Cropping at decode time                            #
+###############################################################################
+
+DecodePlan = namedtuple('DecodePlan', ['reduce', 'box', 'size'])
+
+
+class DecodeCrop(object):
+    """Crop and resize all frames of a clip with the same geometry. When
+    passed as ``decode_crop`` to a gulp reader (``GulpDirectory.fetch``,
+    ``GulpVideoDataset``, ``GulpImageDataset``) the geometry is planned from
+    the JPEG header of the first frame and the frames are decoded at a
+    reduced scale (1/2, 1/4 or 1/8) whenever the cropped region still has at
+    least ``size`` pixels, so full resolution images are never created.
+    Called as a regular transform on decoded frames it gives the same result
+    without the decoding savings.
+    Args:
+        crop_size (sequence or int, optional): Size (h, w) of the region to
+            crop at full resolution. It is clipped to the image size. Default
+            is None, i.e. the whole image.
+        size (sequence or int, optional): Output size (h, w). Default is None,
+            i.e. the crop size.
+        random_crop (bool, optional): Crop at a random location instead of
+            the center. Default is False.
+        reduced_decode (bool, optional): Allow reduced scale decoding.
+            Default is True.
+        interpolation (int, optional): Desired interpolation. Default is
+            ``cv2.INTER_AREA``
+    """
+
+    def __init__(self, crop_size=None, size=None, random_crop=False,
+                 reduced_decode=True, interpolation=cv2.INTER_AREA):
+        if isinstance(crop_size, numbers.Number):
+            crop_size = (int(crop_size), int(crop_size))
+        if isinstance(size, numbers.Number):
+            size = (int(size), int(size))
+        self.crop_size = crop_size
+        self.size = size
+        self.random_crop = random_crop
+        self.reduced_decode = reduced_decode
+        self.interpolation = interpolation
+
+    def plan(self, h, w, reduced=True):
+        """Plan the decoding of frames of size (h, w).
+        Args:
+            h (int), w (int): Size of the encoded frames.
+            reduced (bool): Whether the frames can be decoded at a reduced
+                scale.
+        Returns:
+            DecodePlan: the scale reduction factor, the crop box
+            (y1, x1, height, width) in the coordinates of the reduced frame
+            and the output size (h, w).
+        """
+        th, tw = self.crop_size or (h, w)
+        th, tw = min(th, h), min(tw, w)
+        if self.random_crop:
+            y1, x1 = random.randint(0, h - th), random.randint(0, w - tw)
+        else:
+            y1, x1 = int(round((h - th) / 2.)), int(round((w - tw) / 2.))
+        oh, ow = self.size or (th, tw)
+        reduce = 1
+        if reduced and self.reduced_decode:
+            for factor in (8, 4, 2):
+                if th // factor >= oh and tw // factor >= ow:
+                    reduce = factor
+                    break
+        # the reduced frame is ceil(h / reduce) x ceil(w / reduce)
+        rh, rw = -(-h // reduce), -(-w // reduce)
+        y1, x1 = y1 // reduce, x1 // reduce
+        box = (y1, x1,
+               max(1, min(th // reduce, rh - y1)),
+               max(1, min(tw // reduce, rw - x1)))
+        return DecodePlan(reduce, box, (oh, ow))
+
+    def apply(self, plan, img):
+        """Crop and resize a single (decoded) frame according to ``plan``."""
+        y1, x1, th, tw = plan.box
+        img = img[y1:y1 + th, x1:x1 + tw]
+        oh, ow = plan.size
+        if (th, tw) != (oh, ow):
+            img = cv2.resize(img, (ow, oh), interpolation=self.interpolation)
+        return img
+
+    def __call__(self, imgs):
+        """
+        Args:
+            imgs (numpy.array or list of numpy.array): Image or frames to be
+                cropped, all frames get the same crop.
+        Returns:
+            numpy.array or list of numpy.array: Cropped and resized frames.
+        """
+        if isinstance(imgs, np.ndarray) and imgs.ndim < 4:
+            return self.apply(self.plan(*imgs.shape[:2], reduced=False), imgs)
+        plan = self.plan(*imgs[0].shape[:2], reduced=False)
+        return [self.apply(plan, img) for img in imgs]
@@ -3,11 +3,16 @@
 import os
 import sh
 import random
+import subprocess
 import cv2
+import numpy as np
 import shutil
 import glob
+import struct
 from contextlib import contextmanager
 
+from .stats import timed
+
 
 ###############################################################################
 #                                Helper Functions                             #
@@ -18,6 +23,10 @@ class FFMPEGNotFound(Exception):
     pass
 
 
+class FFMPEGError(Exception):
+    pass
+
+
 def check_ffmpeg_exists():
     return os.system('ffmpeg -version > /dev/null') == 0
 
@@ -27,8 +36,10 @@ def temp_dir_for_bursting(shm_dir_path='/dev/shm'):
     hash_str = str(random.getrandbits(128))
     temp_dir = os.path.join(shm_dir_path, hash_str)
     os.makedirs(temp_dir)  # creates error if paths conflict (unlikely)
-    yield temp_dir
-    shutil.rmtree(temp_dir)
+    try:
+        yield temp_dir
+    finally:
+        shutil.rmtree(temp_dir)
 
 
 def burst_frames_to_shm(vid_path, temp_burst_dir, frame_rate=None):
@@ -51,7 +62,8 @@ def burst_frames_to_shm(vid_path, temp_burst_dir, frame_rate=None):
         if frame_rate:
             ffmpeg_args.insert(2, '-r')
             ffmpeg_args.insert(3, frame_rate)
-        sh.ffmpeg(*ffmpeg_args)
+        with timed('read'):
+            sh.ffmpeg(*ffmpeg_args)
     except Exception as e:
         print(repr(e))
 
@@ -61,6 +73,71 @@ def burst_video_into_frames(vid_path, temp_burst_dir, frame_rate=None):
     return find_images_in_folder(temp_burst_dir, formats=['jpg'])
 
 
+def _read_ppm(stream):
+    """ Read one binary PPM (P6) image from a stream as an RGB array.
+    Returns None at the end of the stream. """
+    tokens = []
+    while len(tokens) < 4:
+        line = stream.readline()
+        if not line:
+            return None
+        tokens.extend(line.split(b'#')[0].split())
+    if tokens[0] != b'P6' or tokens[3] != b'255':
+        raise ValueError("Unsupported PPM header: {}".format(tokens))
+    width, height = int(tokens[1]), int(tokens[2])
+    data = stream.read(width * height * 3)
+    if len(data) < width * height * 3:
+        return None
+    return np.frombuffer(data, np.uint8).reshape(height, width, 3)
+
+
+def read_video_frames(vid_path, frame_rate=None, img_size=-1):
+    """
+    - Decode a video with ffmpeg and stream the frames through a pipe,
+      without writing them to disk.
+    - Resizing (to `img_size` on the short edge) and frame rate conversion
+      are done by ffmpeg, frames are never encoded to JPEG.
+    - Yields BGR numpy arrays, like `cv2.imread` on bursted frames.
+    - Raises `FFMPEGError` with the error output of ffmpeg if it fails.
+      ffmpeg is killed if the generator is closed before the end.
+    """
+    if not check_ffmpeg_exists():
+        raise FFMPEGNotFound()
+    ffmpeg_args = ['ffmpeg', '-v', 'error', '-i', vid_path]
+    if frame_rate:
+        ffmpeg_args += ['-r', str(frame_rate)]
+    if img_size > 0:
+        # same output size as `resize_by_short_edge`
+        ffmpeg_args += ['-vf', "scale='if(lt(ih,iw),trunc({0}*iw/ih),{0})':"
+                               "'if(lt(ih,iw),{0},trunc({0}*ih/iw))'"
+                               .format(img_size)]
+    ffmpeg_args += ['-f', 'image2pipe', '-c:v', 'ppm', '-']
+    process = subprocess.Popen(ffmpeg_args, stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+    try:
+        while True:
+            # waiting for ffmpeg, resizing by ffmpeg counts as reading
+            with timed('read'):
+                img = _read_ppm(process.stdout)
+                if img is None:
+                    break
+                img = cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
+            yield img
+        # ffmpeg closed its output, so it exits by itself
+        error = process.stderr.read()
+        if process.wait() != 0:
+            raise FFMPEGError("ffmpeg failed with exit code {} on {}: {}"
+                              .format(process.returncode, vid_path,
+                                      error.decode(errors='replace').strip()))
+    finally:
+        # only kill ffmpeg if the frames were not read to the end
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        process.stdout.close()
+        process.stderr.close()
+
+
 class ImageNotFound(Exception):
     pass
 
@@ -68,7 +145,8 @@ class ImageNotFound(Exception):
 def resize_images(imgs, img_size=-1):
     for img in imgs:
         img_path = img
-        img = cv2.imread(img_path, cv2.IMREAD_ANYCOLOR)
+        with timed('read'):
+            img = cv2.imread(img_path, cv2.IMREAD_ANYCOLOR)
         if img is None:
             raise ImageNotFound("Image is  None from path:{}".format(img_path))
         if img_size > 0:
@@ -79,23 +157,135 @@ def resize_images(imgs, img_size=-1):
 def resize_by_short_edge(img, size):
     if isinstance(img, str):
         img_path = img
-        img = cv2.imread(img_path, cv2.IMREAD_ANYCOLOR)
+        with timed('read'):
+            img = cv2.imread(img_path, cv2.IMREAD_ANYCOLOR)
         if img is None:
             raise ImageNotFound("Image read None from path ", img_path)
     if size < 1:
         return img
     h, w = img.shape[0], img.shape[1]
-    if h < w:
-        scale = w / float(h)
-        new_width = int(size * scale)
-        img = cv2.resize(img, (new_width, size))
-    else:
-        scale = h / float(w)
-        new_height = int(size * scale)
-        img = cv2.resize(img, (size, new_height))
+    with timed('resize'):
+        if h < w:
+            scale = w / float(h)
+            new_width = int(size * scale)
+            img = cv2.resize(img, (new_width, size))
+        else:
+            scale = h / float(w)
+            new_height = int(size * scale)
+            img = cv2.resize(img, (size, new_height))
+    return img
+
+
+def load_encoded_image(img_path, validate=False):
+    """ Read an image file for JPEG passthrough: the content of a complete
+    JPEG file is returned as bytes, to be stored without decoding and
+    re-encoding. Images in other formats and truncated JPEG files are
+    decoded like in `resize_images`, so that they are re-encoded.
+    With `validate`, a JPEG file is also decoded once, and raises
+    `ImageNotFound` if it can not be decoded. """
+    if not os.path.isfile(img_path):
+        raise ImageNotFound("Image not found at path:{}".format(img_path))
+    with timed('read'):
+        with open(img_path, 'rb') as fp:
+            data = fp.read()
+        complete = is_complete_jpeg(data)
+        if complete and not validate:
+            return data
+        img = cv2.imdecode(np.frombuffer(data, np.uint8),
+                           cv2.IMREAD_ANYCOLOR)
+        if complete and img is not None:
+            return data
+    if img is None:
+        raise ImageNotFound("Image is  None from path:{}".format(img_path))
     return img
 
 
+# start of frame markers, except DHT (0xC4), JPG (0xC8) and DAC (0xCC)
+_JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7,
+                     0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+def _jpeg_header_segments(data):
+    """ Yield (marker, offset of the marker) for the segments of a JPEG
+    header, up to the start of frame. Stops early if the data is not a JPEG
+    or the header is incomplete. """
+    if bytes(data[:2]) != b'\xff\xd8':
+        return
+    i = 2
+    while i + 4 <= len(data):
+        if data[i] != 0xFF:
+            return
+        marker = data[i + 1]
+        if marker == 0xFF:  # fill byte
+            i += 1
+        elif marker == 0x01 or 0xD0 <= marker <= 0xD8:  # no payload
+            i += 2
+        else:
+            yield marker, i
+            if marker in _JPEG_SOF_MARKERS or marker == 0xDA:
+                return
+            i += 2 + ((data[i + 2] << 8) | data[i + 3])
+
+
+def get_jpeg_size(data):
+    """ Read the size of a JPEG image from its header, without decoding.
+
+    Returns (height, width, number of color components), or None if the
+    data is not a JPEG or the header is incomplete.
+    """
+    data = memoryview(data)
+    for marker, i in _jpeg_header_segments(data):
+        if marker in _JPEG_SOF_MARKERS:
+            if i + 10 > len(data):
+                return None
+            height = (data[i + 5] << 8) | data[i + 6]
+            width = (data[i + 7] << 8) | data[i + 8]
+            return height, width, data[i + 9]
+    return None
+
+
+def get_jpeg_orientation(data):
+    """ Read the EXIF orientation of a JPEG image from its header.
+
+    Returns the orientation from 1 to 8, 1 (upright) if there is none.
+    `cv2.imdecode` applies it, orientations 5 to 8 rotate the image by 90
+    degrees and so swap its height and width.
+    """
+    data = memoryview(data)
+    for marker, i in _jpeg_header_segments(data):
+        if marker != 0xE1:  # APP1
+            continue
+        length = (data[i + 2] << 8) | data[i + 3]
+        exif = bytes(data[i + 4:i + 2 + length])
+        if exif[:6] != b'Exif\0\0':
+            continue
+        tiff = exif[6:]
+        order = {b'II': '<', b'MM': '>'}.get(tiff[:2])
+        if order is None or len(tiff) < 8:
+            return 1
+        ifd = struct.unpack(order + 'I', tiff[4:8])[0]
+        if ifd + 2 > len(tiff):
+            return 1
+        count = struct.unpack(order + 'H', tiff[ifd:ifd + 2])[0]
+        for entry in range(ifd + 2, min(ifd + 2 + 12 * count,
+                                        len(tiff) - 11), 12):
+            tag, type_ = struct.unpack(order + 'HH', tiff[entry:entry + 4])
+            if tag == 0x0112 and type_ == 3:  # orientation, a short
+                value = struct.unpack(order + 'H',
+                                      tiff[entry + 8:entry + 10])[0]
+                return value if 1 <= value <= 8 else 1
+        return 1
+    return 1
+
+
+def is_complete_jpeg(data):
+    """ Check that data is a JPEG with a readable header that ends with an
+    end of image marker, i.e. that it is not truncated. Zero bytes after the
+    marker (e.g. the padding of gulp records) are ignored. """
+    return (get_jpeg_size(data) is not None and
+            bytes(data).rstrip(b'\0').endswith(b'\xff\xd9'))
+
+
 ###############################################################################
 #                                 File management                             #
 ###############################################################################
@@ -104,6 +294,39 @@ def ensure_output_dir_exists(output_dir):
     os.makedirs(output_dir, exist_ok=True)
 
 
+_BYTE_SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3,
+                    'T': 1024 ** 4}
+
+
+def parse_byte_size(size):
+    """ Parse a number of bytes like '4096', '512M' or '2G' (binary units),
+    integers are returned unchanged. """
+    if isinstance(size, int):
+        return size
+    text = size.strip().upper()
+    if text.endswith('B'):
+        text = text[:-1]
+    unit = text[-1:] if text[-1:] in _BYTE_SIZE_UNITS else ''
+    try:
+        value = float(text[:len(text) - len(unit)])
+    except ValueError:
+        raise ValueError("Invalid byte size: '{}'".format(size))
+    return int(value * _BYTE_SIZE_UNITS[unit])
+
+
+def parse_shard(shard):
+    """ Parse a shard specification 'i/N' into the tuple (i, N), with the
+    zero based index i of a shard out of N shards. """
+    try:
+        index, count = (int(part) for part in shard.split('/'))
+    except ValueError:
+        raise ValueError("Invalid shard: '{}', expected 'i/N'".format(shard))
+    if not 0 <= index < count:
+        raise ValueError("Invalid shard: '{}', expected 0 <= i < N"
+                         .format(shard))
+    return index, count
+
+
 ###############################################################################
 #                       Helper Functions for input iterator                   #
 ###############################################################################
@@ -0,0 +1,51 @@
+import inspect
+import unittest
+
+import gulpio.transforms
+from gulpio.benchmark import (default_transforms,
+                              run_benchmarks,
+                              compare_results,
+                              KINDS,
+                              )
+
+
+class TestDefaultTransforms(unittest.TestCase):
+
+    def test_all_transforms_are_covered(self):
+        public = {name for name, obj in
+                  inspect.getmembers(gulpio.transforms, inspect.isclass)
+                  if obj.__module__ == 'gulpio.transforms' and
+                  not name.startswith('_') and name != 'DecodePlan'}
+        covered = {name for name, kind, _ in default_transforms(64, 80)}
+        self.assertEqual(public, covered)
+        for _, kind, _ in default_transforms(64, 80):
+            self.assertIn(kind, KINDS)
+
+
+class TestRunBenchmarks(unittest.TestCase):
+
+    def test_report(self):
+        report = run_benchmarks(height=32, width=40, num_frames=4,
+                                batch_size=2, repeat=2, warmup=1,
+                                names=['Scale', 'NormalizeBatch'])
+        self.assertEqual(32, report['config']['height'])
+        results = {r['name']: r for r in report['results']}
+        self.assertEqual({'Scale', 'NormalizeBatch'}, set(results))
+        normalize = results['NormalizeBatch']
+        self.assertEqual('batch', normalize['kind'])
+        self.assertGreater(normalize['frames_per_second'], 0)
+        # the float32 output of 2 x 4 x 32 x 40 x 3 values is allocated
+        self.assertGreaterEqual(normalize['peak_alloc_bytes'],
+                                2 * 4 * 32 * 40 * 3 * 4)
+        for key in ['median', 'mean', 'min', 'p90']:
+            self.assertIn(key, normalize['latency_ms'])
+
+    def test_compare_results(self):
+        def report(**medians):
+            return {'results': [{'name': name,
+                                 'latency_ms': {'median': median}}
+                                for name, median in medians.items()]}
+        baseline = report(Scale=1., Normalize=2., CenterCrop=1.)
+        current = report(Scale=1.1, Normalize=3., UnitNorm=5.)
+        self.assertEqual([('Normalize', 2., 3., 0.5)],
+                         compare_results(baseline, current, threshold=0.2))
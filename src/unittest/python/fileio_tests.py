@@ -3,10 +3,14 @@ import tempfile
 import shutil
 import json
 import pickle
+import queue
+import struct
+import multiprocessing
 
 from collections import OrderedDict
 from io import BytesIO
 
+import cv2
 import numpy as np
 import numpy.testing as npt
 
@@ -17,6 +21,16 @@ from gulpio.fileio import (GulpChunk,
                            ChunkWriter,
                            GulpIngestor,
                            GulpDirectory,
+                           MultiGulpDirectory,
+                           ChunkHandlePool,
+                           RollingChunkWriter,
+                           SharedCounter,
+                           recover_chunks,
+                           chunk_file_paths,
+                           _encode_items,
+                           _finish_stage,
+                           merge_shards,
+                           shard_index_path,
                            calculate_chunk_slices,
                            json_serializer,
                            pickle_serializer,
@@ -24,6 +38,9 @@ from gulpio.fileio import (GulpChunk,
                            ImgInfo,
                            )
 from gulpio.adapters import AbstractDatasetAdapter
+from gulpio.transforms import DecodeCrop
+
+from utils_tests import with_orientation
 
 
 class FSBase(unittest.TestCase):
@@ -300,6 +317,120 @@ class TestGulpChunk(GulpChunkElement):
         npt.assert_array_equal(image, np.array(frames[0]))
         self.assertEqual({}, meta)
 
+    def test_read_frames_with_indices(self):
+        self.gulp_chunk.meta_dict = OrderedDict()
+        self.gulp_chunk.fp = BytesIO()
+        images = [np.ones((3, 3, 3), dtype='uint8') * i * 50
+                  for i in range(5)]
+        for image in images:
+            self.gulp_chunk._write_frame(0, image)
+        self.gulp_chunk.meta_dict['0']['meta_data'].append({})
+        read_mock = mock.Mock(wraps=self.gulp_chunk.fp.read)
+        self.gulp_chunk.fp.read = read_mock
+
+        frames, meta = self.gulp_chunk.read_frames('0', [4, 0, 1, 4])
+        for index, frame in zip([4, 0, 1, 4], frames):
+            npt.assert_array_equal(images[index], frame)
+        # frames 0 and 1 are adjacent and read at once
+        self.assertEqual(2, read_mock.call_count)
+
+    def test_read_frames_with_decode_crop(self):
+        self.gulp_chunk.meta_dict = OrderedDict()
+        self.gulp_chunk.fp = BytesIO()
+        image = np.zeros((64, 96, 3), dtype='uint8')
+        image[:, 48:] = 200
+        for _ in range(3):
+            self.gulp_chunk._write_frame(0, image)
+        self.gulp_chunk.meta_dict['0']['meta_data'].append({})
+
+        decode_crop = DecodeCrop(crop_size=32, size=8)
+        with mock.patch('cv2.imdecode', wraps=cv2.imdecode) as imdecode:
+            frames, _ = self.gulp_chunk.read_frames('0', [0, 2],
+                                                    decode_crop=decode_crop)
+        self.assertEqual(2, len(frames))
+        for frame in frames:
+            self.assertEqual((8, 8, 3), frame.shape)
+        # only 32 / 4 = 8 pixels are needed, decode at a quarter scale
+        for call in imdecode.call_args_list:
+            self.assertEqual(cv2.IMREAD_REDUCED_COLOR_4, call[0][1])
+        expected = decode_crop(self.gulp_chunk.read_frames('0')[0])
+        npt.assert_allclose(expected[0], frames[0], atol=2)
+
+    def test_read_frames_with_decode_crop_exif_orientation(self):
+        self.gulp_chunk.meta_dict = OrderedDict()
+        self.gulp_chunk.fp = BytesIO()
+        image = np.zeros((64, 96, 3), dtype='uint8')
+        image[:, 48:] = 200
+        jpeg = with_orientation(cv2.imencode('.jpg', image)[1].tobytes(), 6)
+        self.gulp_chunk._write_frame(0, jpeg)
+        self.gulp_chunk.meta_dict['0']['meta_data'].append({})
+
+        decode_crop = DecodeCrop(crop_size=32, size=8)
+        frames, _ = self.gulp_chunk.read_frames('0', decode_crop=decode_crop)
+        full = self.gulp_chunk.read_frames('0')[0][0]
+        # imdecode turns the frame upright
+        self.assertEqual((96, 64, 3), full.shape)
+        self.assertEqual((8, 8, 3), frames[0].shape)
+        npt.assert_allclose(decode_crop([full])[0], frames[0], atol=2)
+
+    def test_write_encoded_frame(self):
+        self.gulp_chunk.meta_dict = OrderedDict()
+        self.gulp_chunk.fp = BytesIO()
+        image = np.arange(48, dtype='uint8').reshape(4, 4, 3)
+        jpeg = cv2.imencode('.jpg', image)[1].tobytes()
+        self.gulp_chunk._write_frame(0, jpeg)
+        self.gulp_chunk.meta_dict['0']['meta_data'].append({})
+        # stored as it is
+        record = self.gulp_chunk.fp.getvalue()
+        self.assertEqual(jpeg, record[:len(jpeg)])
+        frames, _ = self.gulp_chunk.read_frames('0')
+        npt.assert_array_equal(
+            cv2.cvtColor(cv2.imdecode(np.frombuffer(jpeg, np.uint8),
+                                      cv2.IMREAD_ANYCOLOR),
+                         cv2.COLOR_BGR2RGB),
+            frames[0])
+        with self.assertRaises(ValueError):
+            self.gulp_chunk._write_frame(0, b'ANY_BYTES')
+        # a truncated JPEG is not stored either
+        with self.assertRaises(ValueError):
+            self.gulp_chunk._write_frame(0, jpeg[:-10])
+
+    def test_append_generator(self):
+        images = [np.ones((3, 3, 3), dtype='uint8') * i * 50
+                  for i in range(3)]
+        self.gulp_chunk.serializer = json_serializer
+        with self.gulp_chunk.open('wb'):
+            num_frames = self.gulp_chunk.append(0, {}, iter(images))
+        self.assertEqual(3, num_frames)
+        with self.gulp_chunk.open('rb'):
+            frames, _ = self.gulp_chunk.read_frames('0')
+        npt.assert_array_equal(images, frames)
+
+    def test_append_rolls_back(self):
+        image = np.ones((3, 3, 3), dtype='uint8')
+
+        def failing_frames():
+            yield image
+            raise ValueError('ANY_ERROR')
+
+        self.gulp_chunk.serializer = json_serializer
+        with self.gulp_chunk.open('wb'):
+            self.gulp_chunk.append(0, {'meta': 0}, [image])
+            size = self.gulp_chunk.fp.tell()
+            # no frames at all
+            self.assertEqual(0, self.gulp_chunk.append(1, {}, iter([])))
+            # an error after the first frame
+            with self.assertRaises(ValueError):
+                self.gulp_chunk.append(2, {}, failing_frames())
+            with self.assertRaises(ValueError):
+                self.gulp_chunk.append(0, {'meta': 1}, failing_frames())
+            self.assertEqual(size, self.gulp_chunk.fp.tell())
+        self.assertEqual(['0'], list(self.gulp_chunk.meta_dict))
+        self.assertEqual([{'meta': 0}],
+                         self.gulp_chunk.meta_dict['0']['meta_data'])
+        self.assertEqual(1, len(self.gulp_chunk.meta_dict['0']['frame_info']))
+        self.assertEqual(size, os.path.getsize(self.gulp_chunk.data_file_path))
+
     def test_iter(self):
         read_mock = mock.Mock()
         read_mock.return_value = [], []
@@ -399,6 +530,19 @@ class TestChunkWriter(ChunkWriterElement):
         mock_gulp.append.assert_called_once_with(
             0, {'meta': 'ANY_META'}, ['ANY_FRAME1', 'ANY_FRAME2'])
 
+    def test_write_chunk_empty_video(self):
+        def mock_iter_data(input_slice):
+            yield {'id': 0, 'meta': {}, 'frames': iter([])}
+            yield {'id': 1, 'meta': {}, 'frames': iter([np.zeros((2, 2))])}
+        self.adapter.iter_data = mock_iter_data
+        chunk = GulpChunk(os.path.join(self.temp_dir, 'data_0.gulp'),
+                          os.path.join(self.temp_dir, 'meta_0.gmeta'))
+        with mock.patch('builtins.print') as print_mock:
+            self.chunk_writer.write_chunk(chunk, slice(0, 2))
+        print_mock.assert_called_once_with(
+            "Failed to write video with id: 0; no frames")
+        self.assertEqual(['1'], list(chunk.meta_dict))
+
 
 class GulpIngestorElement(FSBase):
 
@@ -450,10 +594,12 @@ class TestGulpIngestor(GulpIngestorElement):
 
 class DummyVideosAdapter(AbstractDatasetAdapter):
 
-    def __init__(self, num_videos):
+    def __init__(self, num_videos, shuffle=True):
         self.num_videos = num_videos
         self.ids = [str(i) for i in range(num_videos)]
-        np.random.shuffle(self.ids)
+        self.shuffle = shuffle
+        if shuffle:
+            np.random.shuffle(self.ids)
 
     def __len__(self):
         return self.num_videos
@@ -631,3 +777,624 @@ class TestGulpDirectory(FSBase):
                 img, meta = gulp_directory[id_]
                 # check the meta id match
                 self.assertEqual(meta['id'], id_)
+
+
+class TestRollingChunkWriter(FSBase):
+
+    def test_roll_over(self):
+        writer = RollingChunkWriter(self.temp_dir, SharedCounter(3), 2)
+        for video in RoundTripAdapter(ids=[0, 1, 2]).iter_data():
+            writer.write(video)
+        writer.close()
+        # the empty video is not counted
+        gulp_directory = GulpDirectory(self.temp_dir)
+        self.assertEqual({'1': 3, '2': 3}, gulp_directory.chunk_lookup)
+        for video in RoundTripAdapter(ids=[3, 4, 5]).iter_data():
+            writer.write(video)
+        writer.close()
+        gulp_directory = GulpDirectory(self.temp_dir)
+        self.assertEqual([3, 4], gulp_directory._chunk_ids())
+
+    def test_byte_budget(self):
+        writer = RollingChunkWriter(self.temp_dir, SharedCounter(), None,
+                                    chunk_size_bytes=1)
+        for video in RoundTripAdapter(ids=[0, 1, 2]).iter_data():
+            writer.write(video)
+        writer.close()
+        # every video exceeds the budget and finishes its chunk
+        gulp_directory = GulpDirectory(self.temp_dir)
+        self.assertEqual({'1': 0, '2': 1}, gulp_directory.chunk_lookup)
+
+    def test_empty_chunk_is_removed(self):
+        writer = RollingChunkWriter(self.temp_dir, SharedCounter(), 2)
+        writer.write({'id': 0, 'meta': {}, 'frames': []})
+        writer.close()
+        self.assertEqual([], os.listdir(self.temp_dir))
+
+
+class TestDynamicIngestion(FSBase):
+
+    def test_ingest(self):
+        adapter = DummyVideosAdapter(num_videos=25)
+        output_directory = os.path.join(self.temp_dir, "ANY_OUTPUT_DIR")
+        GulpIngestor(adapter, output_directory, 4, 3, dynamic=True,
+                     unit_size=2)()
+        gulp_directory = GulpDirectory(output_directory)
+        self.assertEqual(set(adapter.ids), set(gulp_directory.chunk_lookup))
+        for meta_dict in gulp_directory.all_meta_dicts:
+            self.assertLessEqual(len(meta_dict), 4)
+        # chunk ids are unique and continue after existing chunks
+        GulpIngestor(DummyVideosAdapter(num_videos=2), output_directory,
+                     4, 2, dynamic=True)()
+        chunk_ids = sorted(int(f[len('data_'):-len('.gulp')])
+                           for f in os.listdir(output_directory)
+                           if f.endswith('.gulp'))
+        self.assertEqual(list(range(len(chunk_ids))), chunk_ids)
+
+    def test_ingest_chunk_size_bytes(self):
+        adapter = DummyVideosAdapter(num_videos=25)
+        ingestor = GulpIngestor(adapter, self.temp_dir, None, 2,
+                                chunk_size_bytes='1K')
+        self.assertTrue(ingestor.dynamic)
+        ingestor()
+        gulp_directory = GulpDirectory(self.temp_dir)
+        self.assertEqual(set(adapter.ids), set(gulp_directory.chunk_lookup))
+        self.assertGreater(len(gulp_directory.all_meta_dicts), 2)
+        for chunk in gulp_directory.chunks():
+            # a chunk exceeds the budget by less than one video
+            size = os.path.getsize(chunk.data_file_path)
+            self.assertLess(size - 1024, size / len(chunk.meta_dict))
+
+    def test_resume(self):
+        adapter = DummyVideosAdapter(num_videos=10)
+        # an interrupted ingestion, which got the first three items into
+        # a chunk that was never closed
+        writer = RollingChunkWriter(self.temp_dir, SharedCounter(), 5)
+        for video in adapter.iter_data(slice(0, 3)):
+            writer.write(video)
+        writer.chunk.fp.flush()
+        writer.chunk._journal.flush()
+        GulpIngestor(adapter, self.temp_dir, 5, 2, resume=True)()
+        gulp_directory = GulpDirectory(self.temp_dir)
+        self.assertEqual(set(adapter.ids), set(gulp_directory.chunk_lookup))
+        for id_ in adapter.ids[:3]:
+            self.assertEqual(0, gulp_directory.chunk_lookup[id_])
+
+    def test_pipeline(self):
+        adapter = DummyVideosAdapter(num_videos=25)
+        ingestor = GulpIngestor(adapter, self.temp_dir, 4, 2, pipeline=True,
+                                num_encoders=2, num_writers=2, queue_size=2)
+        self.assertTrue(ingestor.dynamic)
+        ingestor()
+        gulp_directory = GulpDirectory(self.temp_dir)
+        self.assertEqual(set(adapter.ids), set(gulp_directory.chunk_lookup))
+        for meta_dict in gulp_directory.all_meta_dicts:
+            self.assertLessEqual(len(meta_dict), 4)
+        frames, meta = gulp_directory[adapter.ids[0]]
+        self.assertEqual({'id': adapter.ids[0]}, meta)
+        self.assertEqual((1, 1, 3), frames[0].shape)
+
+    def test_pipeline_resume(self):
+        adapter = DummyVideosAdapter(num_videos=10)
+        writer = RollingChunkWriter(self.temp_dir, SharedCounter(), 4)
+        for video in adapter.iter_data(slice(0, 2)):
+            writer.write(video)
+        writer.close()
+        GulpIngestor(adapter, self.temp_dir, 4, 2, pipeline=True,
+                     resume=True)()
+        gulp_directory = GulpDirectory(self.temp_dir)
+        self.assertEqual(set(adapter.ids), set(gulp_directory.chunk_lookup))
+
+    def test_pipeline_worker_error(self):
+        adapter = DummyVideosAdapter(num_videos=2)
+        adapter.iter_data = mock.Mock(side_effect=ValueError('ANY_ERROR'))
+        with self.assertRaisesRegex(RuntimeError, 'decode'):
+            GulpIngestor(adapter, self.temp_dir, 4, 2, pipeline=True)()
+
+    @mock.patch('gulpio.fileio.RESULT_TIMEOUT', 0.1)
+    def test_pipeline_worker_died(self):
+        adapter = DummyVideosAdapter(num_videos=8)
+        with mock.patch('gulpio.fileio.GulpChunk.encode_frame',
+                        side_effect=lambda frame: os._exit(1)):
+            with self.assertRaisesRegex(RuntimeError,
+                                        'encode-0 died with exit code 1'):
+                GulpIngestor(adapter, self.temp_dir, 4, 2, pipeline=True,
+                             queue_size=1)()
+
+    def test_pipeline_many_decoders(self):
+        # items of decoders that finish early must not be overtaken by the
+        # end of the stage
+        adapter = DummyVideosAdapter(num_videos=40)
+        GulpIngestor(adapter, self.temp_dir, 4, 4, pipeline=True,
+                     num_encoders=3, num_writers=2)()
+        gulp_directory = GulpDirectory(self.temp_dir)
+        self.assertEqual(set(adapter.ids), set(gulp_directory.chunk_lookup))
+
+    def test_worker_error(self):
+        adapter = DummyVideosAdapter(num_videos=2)
+        adapter.iter_data = mock.Mock(side_effect=ValueError('ANY_ERROR'))
+        with self.assertRaises(RuntimeError):
+            GulpIngestor(adapter, self.temp_dir, 4, 2, dynamic=True)()
+
+    @mock.patch('gulpio.fileio.RESULT_TIMEOUT', 0.1)
+    def test_worker_died(self):
+        # e.g. killed by the OOM killer
+        adapter = DummyVideosAdapter(num_videos=4)
+        adapter.iter_data = mock.Mock(side_effect=lambda unit: os._exit(1))
+        with self.assertRaisesRegex(RuntimeError, 'exit code 1'):
+            GulpIngestor(adapter, self.temp_dir, 4, 2, dynamic=True)()
+
+    @mock.patch('gulpio.fileio.RESULT_TIMEOUT', 0.1)
+    def test_worker_exited_early(self):
+        adapter = DummyVideosAdapter(num_videos=4)
+        adapter.iter_data = mock.Mock(side_effect=lambda unit: os._exit(0))
+        with self.assertRaisesRegex(RuntimeError, 'before it was done'):
+            GulpIngestor(adapter, self.temp_dir, 4, 2, dynamic=True)()
+
+
+class TestIngestionReport(FSBase):
+
+    def _check_report(self, report, adapter):
+        self.assertEqual(len(adapter), report['items'])
+        self.assertEqual(len(adapter), report['frames'])
+        gulp_directory = GulpDirectory(self.temp_dir)
+        self.assertEqual(sum(os.path.getsize(chunk.data_file_path)
+                             for chunk in gulp_directory.chunks()),
+                         report['bytes'])
+        self.assertEqual(report['bytes'] / len(adapter),
+                         report['bytes_per_frame'])
+        self.assertGreater(report['stage_seconds']['encode'], 0.)
+        self.assertGreater(report['stage_seconds']['write'], 0.)
+        slowest = report['slowest_items']
+        self.assertEqual(3, len(slowest))
+        self.assertTrue(set(item['id'] for item in slowest) <=
+                        set(adapter.ids))
+        self.assertEqual(sorted((item['seconds'] for item in slowest),
+                                reverse=True),
+                         [item['seconds'] for item in slowest])
+
+    def test_static(self):
+        adapter = DummyVideosAdapter(num_videos=5)
+        report_path = os.path.join(self.temp_dir, 'report.json')
+        report = GulpIngestor(adapter, self.temp_dir, 2, 2,
+                              report_path=report_path, num_slowest=3)()
+        self.assertEqual('static', report['mode'])
+        self._check_report(report, adapter)
+        self.assertEqual(report, json.load(open(report_path)))
+
+    def test_dynamic_live_report(self):
+        adapter = DummyVideosAdapter(num_videos=5)
+        live_report_path = os.path.join(self.temp_dir, 'live.jsonl')
+        ingestor = GulpIngestor(adapter, self.temp_dir, 2, 2, dynamic=True,
+                                live_report_path=live_report_path,
+                                report_interval=0., num_slowest=3)
+        report = ingestor()
+        self._check_report(report, adapter)
+        with open(live_report_path) as fp:
+            lines = [json.loads(line) for line in fp]
+        self.assertGreater(len(lines), 0)
+        self.assertLessEqual(lines[-1]['items'], report['items'])
+
+    def test_pipeline(self):
+        adapter = DummyVideosAdapter(num_videos=5)
+        report = GulpIngestor(adapter, self.temp_dir, 2, 2, pipeline=True,
+                              num_slowest=3)()
+        self.assertEqual('pipeline', report['mode'])
+        self._check_report(report, adapter)
+
+
+class TestThreadedEncoding(FSBase):
+
+    def _write(self, chunk_id, frames, encode_threads):
+        chunk = GulpChunk(*chunk_file_paths(self.temp_dir, chunk_id),
+                          encode_threads=encode_threads)
+        with chunk.open('wb'):
+            num_frames = chunk.append('0', {}, iter(frames))
+        self.assertIsNone(chunk._encode_pool)
+        return chunk, num_frames
+
+    def test_same_output_as_serial(self):
+        rng = np.random.RandomState(0)
+        frames = [rng.randint(0, 256, (8, 8, 3)).astype('uint8')
+                  for _ in range(11)]
+        serial, _ = self._write(0, frames, 1)
+        threaded, num_frames = self._write(1, frames, 3)
+        self.assertEqual(11, num_frames)
+        self.assertEqual(serial.meta_dict, threaded.meta_dict)
+        with open(serial.data_file_path, 'rb') as expected, \
+                open(threaded.data_file_path, 'rb') as received:
+            self.assertEqual(expected.read(), received.read())
+
+    def test_error_rolls_back(self):
+        def frames():
+            for _ in range(5):
+                yield np.ones((4, 4, 3), dtype='uint8')
+            yield b'NOT A JPEG'
+        chunk = GulpChunk(*chunk_file_paths(self.temp_dir, 0),
+                          encode_threads=2)
+        with chunk.open('wb'):
+            with self.assertRaises(ValueError):
+                chunk.append('0', {}, frames())
+            self.assertEqual(0, chunk.fp.tell())
+        self.assertEqual({}, chunk.meta_dict)
+
+
+class TestJournal(FSBase):
+
+    def setUp(self):
+        super().setUp()
+        self.data_file_path, self.meta_file_path = chunk_file_paths(
+            self.temp_dir, 0)
+
+    def _crashed_chunk(self, ids, serializer=json_serializer):
+        # write items and die before the meta file is written
+        chunk = GulpChunk(self.data_file_path, self.meta_file_path,
+                          serializer=serializer, journal_interval=1)
+        context = chunk.open('wb')
+        context.__enter__()
+        for video in RoundTripAdapter(ids=ids).iter_data():
+            chunk.append(video['id'], video['meta'], video['frames'])
+        return chunk
+
+    def test_no_journal_by_default(self):
+        chunk = GulpChunk(self.data_file_path, self.meta_file_path)
+        with chunk.open('wb'):
+            for video in RoundTripAdapter().iter_data():
+                chunk.append(video['id'], video['meta'], video['frames'])
+            self.assertFalse(os.path.exists(chunk.journal_file_path))
+
+    def test_journal_is_removed_on_close(self):
+        chunk = GulpChunk(self.data_file_path, self.meta_file_path,
+                          journal_interval=1)
+        with chunk.open('wb'):
+            for video in RoundTripAdapter().iter_data():
+                chunk.append(video['id'], video['meta'], video['frames'])
+            # the empty video is not recorded
+            self.assertEqual(2, len(chunk._read_journal()))
+        self.assertFalse(os.path.exists(chunk.journal_file_path))
+
+    def test_journal_interval(self):
+        chunk = GulpChunk(self.data_file_path, self.meta_file_path,
+                          journal_interval=3)
+        with chunk.open('wb'):
+            for video in RoundTripAdapter().iter_data():
+                chunk.append(video['id'], video['meta'], video['frames'])
+            self.assertEqual([], chunk._read_journal())
+            chunk.append('3', {}, [np.ones((1, 1, 3), dtype='uint8')])
+            self.assertEqual(['1', '2', '3'],
+                             [e['id'] for e in chunk._read_journal()])
+
+    def test_failed_journal_entry_rolls_back(self):
+        chunk = GulpChunk(self.data_file_path, self.meta_file_path,
+                          journal_interval=1)
+        with chunk.open('wb'):
+            chunk.append('0', {}, [np.ones((1, 1, 3), dtype='uint8')])
+            size = chunk.fp.tell()
+            # not JSON serializable
+            with self.assertRaises(TypeError):
+                chunk.append('1', {'bad': object()},
+                             [np.ones((1, 1, 3), dtype='uint8')])
+            self.assertEqual(size, chunk.fp.tell())
+            self.assertEqual(['0'], list(chunk.meta_dict))
+        self.assertEqual(['0'], list(GulpChunk(self.data_file_path,
+                                               self.meta_file_path).meta_dict))
+
+    def test_recover(self):
+        chunk = self._crashed_chunk([0, 1, 2])
+        expected = chunk.meta_dict
+        size = chunk.fp.tell()
+        # a partially written item
+        chunk.fp.write(b'PARTIAL')
+        chunk._journal.write(struct.pack('<I', 100) + b'{"id": "3", "meta_')
+        chunk.fp.flush()
+        chunk._journal.flush()
+        self.assertFalse(os.path.exists(self.meta_file_path))
+
+        recovered = GulpChunk(self.data_file_path, self.meta_file_path)
+        self.assertEqual(2, recovered.recover())
+        self.assertEqual(size, os.path.getsize(self.data_file_path))
+        self.assertFalse(os.path.exists(recovered.journal_file_path))
+        self.assertEqual(json.loads(json.dumps(expected)),
+                         GulpChunk(self.data_file_path,
+                                   self.meta_file_path).meta_dict)
+        with recovered.open('rb'):
+            frames, meta = recovered.read_frames('2')
+        self.assertEqual(2, len(frames))
+        self.assertEqual({'name': 'shorter_video'}, meta)
+
+    def test_recover_with_pickle_serializer(self):
+        chunk = self._crashed_chunk([0, 1, 2], serializer=pickle_serializer)
+        # meta data that JSON can not represent
+        chunk.append('3', {'shape': (1, 1)},
+                     [np.ones((1, 1, 3), dtype='uint8')])
+        chunk.fp.flush()
+        recovered = GulpChunk(self.data_file_path, self.meta_file_path,
+                              serializer=pickle_serializer)
+        self.assertEqual(3, recovered.recover())
+        self.assertEqual({'shape': (1, 1)},
+                         recovered.meta_dict['3']['meta_data'][0])
+
+    def test_recover_after_meta_was_written(self):
+        # the writer died after writing the meta file, before removing the
+        # journal
+        chunk = self._crashed_chunk([0, 1, 2])
+        chunk.flush()
+        expected = json.loads(json.dumps(chunk.meta_dict))
+        self.assertTrue(os.path.exists(chunk.journal_file_path))
+        self.assertEqual({0: 0}, recover_chunks(self.temp_dir))
+        self.assertEqual(expected, GulpChunk(self.data_file_path,
+                                             self.meta_file_path).meta_dict)
+        self.assertFalse(os.path.exists(chunk.journal_file_path))
+
+    def test_recover_torn_meta(self):
+        chunk = self._crashed_chunk([0, 1, 2])
+        expected = json.loads(json.dumps(chunk.meta_dict))
+        with open(self.meta_file_path, 'w') as fp:
+            fp.write('{"1": {"frame_info": [[0, ')
+        self.assertEqual({0: 2}, recover_chunks(self.temp_dir))
+        self.assertEqual(expected, GulpChunk(self.data_file_path,
+                                             self.meta_file_path).meta_dict)
+
+    def test_flush_replaces_meta_atomically(self):
+        chunk = GulpChunk(self.data_file_path, self.meta_file_path)
+        with chunk.open('wb'):
+            chunk.append('0', {}, [np.ones((1, 1, 3), dtype='uint8')])
+            with mock.patch('os.replace', wraps=os.replace) as replace:
+                chunk.flush()
+        replace.assert_called_once_with(self.meta_file_path + '.tmp',
+                                        self.meta_file_path)
+        self.assertEqual(['data_0.gulp', 'meta_0.gmeta'],
+                         sorted(os.listdir(self.temp_dir)))
+
+    def test_recover_drops_items_beyond_data(self):
+        chunk = self._crashed_chunk([0, 1, 2])
+        chunk.fp.flush()
+        chunk._journal.flush()
+        last = chunk.meta_dict['2']['frame_info'][0]
+        with open(self.data_file_path, 'r+b') as fp:
+            fp.truncate(last[0] + 1)
+        recovered = GulpChunk(self.data_file_path, self.meta_file_path)
+        self.assertEqual(1, recovered.recover())
+        self.assertEqual(['1'], list(recovered.meta_dict))
+        self.assertEqual(last[0], os.path.getsize(self.data_file_path))
+
+    def test_recover_chunks(self):
+        chunk = self._crashed_chunk([0, 1, 2])
+        chunk.fp.flush()
+        chunk._journal.flush()
+        # an orphaned data file without meta or journal is removed
+        orphan = chunk_file_paths(self.temp_dir, 1)[0]
+        open(orphan, 'wb').close()
+        # complete chunks are left alone
+        writer = RollingChunkWriter(self.temp_dir, SharedCounter(2), 2)
+        writer.write({'id': 'other', 'meta': {},
+                      'frames': [np.ones((1, 1, 3))]})
+        writer.close()
+        self.assertEqual({0: 2, 1: 0}, recover_chunks(self.temp_dir))
+        self.assertFalse(os.path.exists(orphan))
+        gulp_directory = GulpDirectory(self.temp_dir)
+        self.assertEqual({'1': 0, '2': 0, 'other': 2},
+                         gulp_directory.chunk_lookup)
+
+
+class TestPipelineStages(unittest.TestCase):
+
+    def test_encode_items(self):
+        decoded, encoded = queue.Queue(), queue.Queue()
+        image = np.ones((2, 2, 3), dtype='uint8')
+        encoded_image = GulpChunk.encode_frame(image)
+        decoded.put(('0', {}, [image, encoded_image], 1.))
+        decoded.put(None)
+        results = queue.Queue()
+        _encode_items(decoded, encoded, results)
+        id_, meta, frames, seconds = encoded.get_nowait()
+        self.assertEqual(('0', {}, [encoded_image, encoded_image]),
+                         (id_, meta, frames))
+        self.assertGreaterEqual(seconds, 1.)
+        self.assertTrue(encoded.empty())
+        # no stats are sent when not recording
+        self.assertTrue(results.empty())
+
+    def test_last_worker_finishes_stage(self):
+        remaining = multiprocessing.Value('l', 2)
+        downstream = mock.Mock()
+        _finish_stage(remaining, downstream, 3)
+        downstream.put.assert_not_called()
+        # the items of every worker are flushed before it counts as finished
+        downstream.join_thread.assert_called_once_with()
+        _finish_stage(remaining, downstream, 3)
+        self.assertEqual([mock.call(None)] * 3,
+                         downstream.put.call_args_list)
+        self.assertEqual(2, downstream.join_thread.call_count)
+
+
+def ingest_shard(adapter, output_dir, shard, **kwargs):
+    GulpIngestor(adapter, output_dir, 2, 2, shard=shard, **kwargs)()
+
+
+def ingest_shard_on_node(num_videos, output_dir, shard):
+    # like a node of a cluster, which builds its own adapter
+    ingest_shard(DummyVideosAdapter(num_videos, shuffle=False), output_dir,
+                 shard)
+
+
+class TestShardedIngestion(FSBase):
+
+    def _run_nodes(self, num_videos, output_dirs, num_shards):
+        # one process per shard, standing in for the nodes of a cluster
+        nodes = [multiprocessing.Process(
+            target=ingest_shard_on_node,
+            args=(num_videos, output_dirs[i], (i, num_shards)))
+            for i in range(num_shards)]
+        for node in nodes:
+            node.start()
+        for node in nodes:
+            node.join()
+            self.assertEqual(0, node.exitcode)
+
+    def test_shared_folder(self):
+        adapter = DummyVideosAdapter(num_videos=23, shuffle=False)
+        self._run_nodes(23, [self.temp_dir] * 3, 3)
+        for i in range(3):
+            shard_index = json.load(open(shard_index_path(self.temp_dir,
+                                                          (i, 3))))
+            self.assertTrue(shard_index['complete'])
+            for chunk_id in shard_index['chunks']:
+                self.assertEqual(i, int(chunk_id) % 3)
+        gulp_directory = merge_shards(self.temp_dir)
+        self.assertEqual(set(adapter.ids), set(gulp_directory.chunk_lookup))
+        self.assertFalse([f for f in os.listdir(self.temp_dir)
+                          if f.endswith('.gindex')])
+
+    def test_separate_folders(self):
+        adapter = DummyVideosAdapter(num_videos=11, shuffle=False)
+        shard_dirs = [os.path.join(self.temp_dir, str(i)) for i in range(2)]
+        output_dir = os.path.join(self.temp_dir, 'merged')
+        self._run_nodes(11, shard_dirs, 2)
+        gulp_directory = merge_shards(output_dir, shard_dirs)
+        self.assertEqual(set(adapter.ids), set(gulp_directory.chunk_lookup))
+        self.assertEqual([], os.listdir(shard_dirs[0]))
+
+    def test_merge_missing_shard(self):
+        adapter = DummyVideosAdapter(num_videos=6, shuffle=False)
+        ingest_shard(adapter, self.temp_dir, '0/2')
+        with self.assertRaisesRegex(ValueError, 'missing'):
+            merge_shards(self.temp_dir)
+
+    def test_shuffled_adapter_is_rejected(self):
+        with self.assertRaises(ValueError):
+            GulpIngestor(DummyVideosAdapter(num_videos=6), self.temp_dir, 2,
+                         2, shard='0/2')
+
+    def test_merge_overlapping_shards(self):
+        # shards split from different orders of the same items
+        for i in range(2):
+            adapter = DummyVideosAdapter(num_videos=6, shuffle=False)
+            adapter.ids = adapter.ids[::1 - 2 * i]
+            ingest_shard(adapter, self.temp_dir, (i, 2))
+        with self.assertRaisesRegex(ValueError, 'Duplicate id'):
+            merge_shards(self.temp_dir)
+
+    def test_merge_item_missing_from_chunk(self):
+        ingest_shard(DummyVideosAdapter(num_videos=6, shuffle=False),
+                     self.temp_dir, (0, 1))
+        shard_index = json.load(open(shard_index_path(self.temp_dir,
+                                                      (0, 1))))
+        chunk_id = next(iter(shard_index['chunks']))
+        shard_index['chunks'][chunk_id].append('LOST')
+        with open(shard_index_path(self.temp_dir, (0, 1)), 'w') as fp:
+            json.dump(shard_index, fp)
+        with self.assertRaisesRegex(ValueError, "'LOST'.*missing"):
+            merge_shards(self.temp_dir)
+
+    def test_resume(self):
+        adapter = DummyVideosAdapter(num_videos=8, shuffle=False)
+        ingest_shard(adapter, self.temp_dir, '0/2')
+        # an interrupted shard 1, and a chunk of shard 0 still being
+        # written, which must not be touched
+        with open(shard_index_path(self.temp_dir, (1, 2)), 'w') as fp:
+            json.dump({'shard': 1, 'num_shards': 2, 'first_chunk_id': 3,
+                       'complete': False, 'chunks': {}}, fp)
+        writer = RollingChunkWriter(self.temp_dir, SharedCounter(3), 4)
+        writer.write(next(adapter.iter_data(slice(4, 5))))
+        writer.chunk.fp.flush()
+        writer.chunk._journal.flush()
+        in_progress = chunk_file_paths(self.temp_dir, 10)[0]
+        open(in_progress, 'wb').close()
+        ingest_shard(adapter, self.temp_dir, '1/2', resume=True)
+        self.assertTrue(os.path.exists(in_progress))
+        os.remove(in_progress)
+        gulp_directory = merge_shards(self.temp_dir)
+        self.assertEqual(set(adapter.ids), set(gulp_directory.chunk_lookup))
+        self.assertEqual(3, gulp_directory.chunk_lookup[adapter.ids[4]])
+
+
+class TestChunkHandlePool(FSBase):
+
+    def test_least_recently_used_is_closed(self):
+        paths = []
+        for i in range(3):
+            paths.append(os.path.join(self.temp_dir, str(i)))
+            open(paths[-1], 'w').close()
+        pool = ChunkHandlePool(max_open=2)
+        first = pool.get(paths[0])
+        self.assertIs(first, pool.get(paths[0]))
+        second = pool.get(paths[1])
+        pool.get(paths[0])
+        pool.get(paths[2])
+        self.assertEqual(2, len(pool))
+        self.assertFalse(first.closed)
+        self.assertTrue(second.closed)
+        pool.close()
+        self.assertTrue(first.closed)
+        self.assertEqual(0, len(pool))
+
+    def test_pickle_drops_handles(self):
+        path = os.path.join(self.temp_dir, 'ANY_FILE')
+        open(path, 'w').close()
+        pool = ChunkHandlePool(max_open=3)
+        pool.get(path)
+        unpickled = pickle.loads(pickle.dumps(pool))
+        self.assertEqual(3, unpickled.max_open)
+        self.assertEqual(0, len(unpickled))
+        pool.close()
+
+
+class TestMultiGulpDirectory(FSBase):
+
+    def _ingest(self, name, num_videos, labels):
+        output_directory = os.path.join(self.temp_dir, name)
+        GulpIngestor(DummyVideosAdapter(num_videos),
+                     output_directory, 2, 1)()
+        json_serializer.dump(labels, os.path.join(output_directory,
+                                                  'label2idx.json'))
+        return output_directory
+
+    def test_multi_directory(self):
+        first = self._ingest('first', 3, {'a': 0, 'b': 1})
+        second = self._ingest('second', 4, {'c': 0, 'a': 1})
+        multi = MultiGulpDirectory([first, second], max_open_chunks=1)
+        self.assertEqual(7, len(multi))
+        self.assertEqual(4, multi.num_chunks)
+        self.assertEqual({'a': 0, 'b': 1, 'c': 2}, multi.label2idx)
+        self.assertEqual([0, 1], multi.label_maps[0].tolist())
+        self.assertEqual([2, 0], multi.label_maps[1].tolist())
+        self.assertEqual([0, 0, 1, 2, 2, 3, 3], multi.chunk_lookup.tolist())
+        infos = list(multi.item_infos())
+        for index in range(len(multi)):
+            with self.subTest(index=index):
+                directory, chunk_id, id_ = multi.locate(index)
+                gd = multi.directories[directory]
+                self.assertEqual(chunk_id, gd.chunk_lookup[id_])
+                self.assertEqual(gd.merged_meta_dict[id_],
+                                 multi.item_info(index))
+                self.assertEqual(infos[index], multi.item_info(index))
+                frames, meta = multi[index]
+                self.assertEqual(id_, meta['id'])
+                self.assertEqual([(1, 1, 3)], [f.shape for f in frames])
+                frames, meta = multi[index, [0, 0]]
+                self.assertEqual(2, len(frames))
+        self.assertEqual(1, len(multi.handles))
+        unpickled = pickle.loads(pickle.dumps(multi))
+        self.assertEqual(multi.locate(6), unpickled.locate(6))
+        self.assertEqual(multi[6][1], unpickled[6][1])
+        multi.close()
+        unpickled.close()
+        with self.assertRaises(TypeError):
+            multi['0']
+
+    def test_decoding_does_not_hold_the_lock(self):
+        multi = MultiGulpDirectory([self._ingest('first', 3, {})])
+        decode_record = GulpChunk._decode_record
+        locked = []
+
+        def check_lock(*args, **kwargs):
+            locked.append(multi._lock.locked())
+            return decode_record(*args, **kwargs)
+
+        with mock.patch.object(GulpChunk, '_decode_record',
+                               side_effect=check_lock):
+            frames, _ = multi.fetch(1, decode_crop=DecodeCrop(crop_size=1))
+        self.assertEqual([(1, 1, 3)], [f.shape for f in frames])
+        self.assertEqual([False], locked)
+        multi.close()
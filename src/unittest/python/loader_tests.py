@@ -6,6 +6,8 @@ import tempfile
 from gulpio.loader import DataLoader
 from gulpio.dataset import GulpVideoDataset, GulpImageDataset
 from gulpio.fileio import GulpChunk
+from gulpio.transforms import (DecodeCrop, CenterCropBatch, Compose,
+                               Normalize)
 
 
 class SimpleDataset(object):
@@ -84,6 +86,83 @@ class TestGulpVideoDataset(unittest.TestCase):
                                    False, stack=False)
         self.iterate(loader)
 
+    def test_sample_indices(self):
+        self.create_chunk()
+        dataset = GulpVideoDataset(self.temp_dir, 4, 2, True)
+        np.testing.assert_array_equal([[0, 2, 4, 6]],
+                                      dataset.sample_indices(32))
+        # short videos are padded with the last frame
+        np.testing.assert_array_equal([[0, 2, 4, 4]],
+                                      dataset.sample_indices(5))
+        dataset = GulpVideoDataset(self.temp_dir, 2, 1, True, num_clips=3)
+        np.testing.assert_array_equal([[0, 1], [4, 5], [8, 9]],
+                                      dataset.sample_indices(10))
+
+    def test_segment_sampling(self):
+        self.create_chunk()
+        dataset = GulpVideoDataset(self.temp_dir, 4, 1, True,
+                                   segment_sampling=True)
+        np.testing.assert_array_equal([[1, 3, 5, 7]],
+                                      dataset.sample_indices(8))
+        dataset = GulpVideoDataset(self.temp_dir, 4, 1, False,
+                                   segment_sampling=True, num_clips=2)
+        indices = dataset.sample_indices(32)
+        self.assertEqual((2, 4), indices.shape)
+        for clip in indices:
+            np.testing.assert_array_equal([0, 1, 2, 3], clip // 8)
+        frames, label = dataset[0]
+        self.assertEqual((2, 4, 100, 100, 3), frames.shape)
+        self.assertEqual(1, label)
+        with self.assertRaises(ValueError):
+            GulpVideoDataset(self.temp_dir, -1, 1, False,
+                             segment_sampling=True)
+
+    def test_multiple_data_paths(self):
+        self.create_chunk()
+        first_dir = self.temp_dir
+        self.create_chunk()
+        dataset = GulpVideoDataset([first_dir, self.temp_dir], 2, 1, True)
+        self.assertEqual(256, len(dataset))
+        self.assertEqual(2, dataset.num_chunks)
+        self.assertEqual({"0": 0, "1": 1, "2": 2}, dataset.label2idx)
+        frames, label = dataset[200]
+        self.assertEqual((2, 100, 100, 3), frames.shape)
+        self.assertEqual(0, label)
+
+    def test_batch_transform(self):
+        self.create_chunk()
+        dataset = GulpVideoDataset(self.temp_dir, 2, 1, True)
+        for num_workers in [0, 2]:
+            loader = DataLoader(dataset, batch_size=4,
+                                num_workers=num_workers,
+                                batch_transform=CenterCropBatch(50))
+            data, labels = next(iter(loader))
+            self.assertEqual((4, 2, 50, 50, 3), data.shape)
+            self.assertEqual([1] * 4, labels)
+
+    def test_defer_normalize(self):
+        self.create_chunk()
+        transform = Compose([Normalize([10, 20, 30], [2, 2, 2])])
+        dataset = GulpVideoDataset(self.temp_dir, 2, 1, True,
+                                   transform=transform, defer_normalize=True)
+        frames, _ = dataset[0]
+        self.assertEqual(np.uint8, frames.dtype)
+        loader = DataLoader(dataset, batch_size=2,
+                            batch_transform=CenterCropBatch(10))
+        data, _ = next(iter(loader))
+        self.assertEqual((2, 2, 10, 10, 3), data.shape)
+        self.assertEqual(np.float32, data.dtype)
+        np.testing.assert_allclose([-5, -10, -15], data[0, 0, 0, 0],
+                                   rtol=1e-6)
+
+    def test_decode_crop(self):
+        self.create_chunk()
+        dataset = GulpVideoDataset(self.temp_dir, 2, 1, True,
+                                   decode_crop=DecodeCrop(64, size=16))
+        frames, label = dataset[3]
+        self.assertEqual((2, 16, 16, 3), frames.shape)
+        self.assertEqual(1, label)
+
 
 class TestGulpImageDataset(unittest.TestCase):
 
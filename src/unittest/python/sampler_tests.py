@@ -0,0 +1,221 @@
+import unittest
+import unittest.mock as mock
+
+import numpy as np
+
+from gulpio.sampler import (DistributedSampler,
+                            BucketBatchSampler,
+                            WeightedRandomSampler,
+                            ClassBalancedSampler,
+                            FeistelPermutation,
+                            PermutationSampler,
+                            )
+
+
+class DummyGulpDataset(object):
+    """Mimics the `gd` and `items` attributes of the gulp datasets."""
+
+    def __init__(self, chunk_sizes, lengths=None):
+        self.items = []
+        self.gd = mock.Mock()
+        self.gd.chunk_lookup = {}
+        for chunk_id, size in enumerate(chunk_sizes):
+            for i in range(size):
+                id_ = '{}-{}'.format(chunk_id, i)
+                length = lengths[len(self.items)] if lengths else 1
+                self.items.append((id_, {'frame_info': [[0, 0, 4]] * length,
+                                         'meta_data': [{}]}))
+                self.gd.chunk_lookup[id_] = chunk_id
+
+    def __len__(self):
+        return len(self.items)
+
+
+class TestDistributedSampler(unittest.TestCase):
+
+    def test_shards_are_disjoint_and_cover_dataset(self):
+        dataset = DummyGulpDataset([5, 5])
+        shards = [list(DistributedSampler(dataset, 3, rank))
+                  for rank in range(3)]
+        for shard in shards:
+            self.assertEqual(4, len(shard))
+        # 12 slots for 10 items, two of them are padding
+        self.assertEqual(set(range(10)), set(sum(shards, [])))
+
+    def test_no_shuffle(self):
+        dataset = DummyGulpDataset([4])
+        sampler = DistributedSampler(dataset, 2, 1, shuffle=False)
+        self.assertEqual([1, 3], list(sampler))
+
+    def test_set_epoch_reshuffles_consistently(self):
+        dataset = DummyGulpDataset([50])
+        sampler = DistributedSampler(dataset, 2, 0, seed=3)
+        other = DistributedSampler(dataset, 2, 0, seed=3)
+        first = list(sampler)
+        self.assertEqual(first, list(other))
+        sampler.set_epoch(1)
+        self.assertNotEqual(first, list(sampler))
+
+    def test_invalid_rank(self):
+        dataset = DummyGulpDataset([4])
+        with self.assertRaises(ValueError):
+            DistributedSampler(dataset, 2, 2)
+
+    def test_chunk_aligned(self):
+        dataset = DummyGulpDataset([6, 3, 2, 1])
+        chunk_of = [dataset.gd.chunk_lookup[id_] for id_, _ in dataset.items]
+        samplers = [DistributedSampler(dataset, 2, rank, chunk_aligned=True)
+                    for rank in range(2)]
+        chunks_per_rank = []
+        for sampler in samplers:
+            indices = list(sampler)
+            self.assertEqual(6, len(indices))
+            chunks_per_rank.append({chunk_of[i] for i in indices})
+        self.assertEqual({0}, chunks_per_rank[0])
+        self.assertEqual({1, 2, 3}, chunks_per_rank[1])
+        # the chunk assignment is stable across epochs
+        samplers[1].set_epoch(5)
+        self.assertEqual({1, 2, 3}, {chunk_of[i] for i in samplers[1]})
+
+    def test_chunk_aligned_too_few_chunks(self):
+        dataset = DummyGulpDataset([6])
+        with self.assertRaises(ValueError):
+            DistributedSampler(dataset, 2, 0, chunk_aligned=True)
+
+
+class TestBucketBatchSampler(unittest.TestCase):
+
+    def test_batches_group_equal_lengths(self):
+        lengths = [3, 1, 2, 1, 3, 2]
+        dataset = DummyGulpDataset([6], lengths)
+        sampler = BucketBatchSampler(dataset, 2)
+        batches = list(sampler)
+        self.assertEqual(3, len(batches))
+        self.assertEqual(3, len(sampler))
+        for batch in batches:
+            self.assertEqual(1, len({lengths[i] for i in batch}))
+        self.assertEqual(list(range(6)), sorted(sum(batches, [])))
+
+    def test_no_shuffle_drop_last(self):
+        dataset = DummyGulpDataset([5], [5, 4, 3, 2, 1])
+        sampler = BucketBatchSampler(dataset, 2, drop_last=True,
+                                     shuffle=False)
+        self.assertEqual([[4, 3], [2, 1]], list(sampler))
+        self.assertEqual(2, len(sampler))
+
+    def test_lengths_are_clipped_to_num_frames(self):
+        dataset = DummyGulpDataset([3], [10, 6, 2])
+        dataset.num_frames, dataset.step_size = 2, 2
+        sampler = BucketBatchSampler(dataset, 2)
+        self.assertEqual([4, 4, 2], sampler.lengths.tolist())
+
+
+class TestWeightedRandomSampler(unittest.TestCase):
+
+    def test_with_replacement(self):
+        sampler = WeightedRandomSampler([0, 1, 0, 3], 1000)
+        indices = list(sampler)
+        self.assertEqual(1000, len(indices))
+        self.assertEqual({1, 3}, set(indices))
+        self.assertGreater(indices.count(3), indices.count(1))
+
+    def test_with_replacement_target_at_end(self):
+        # u * sum(weights) can round up to sum(weights)
+        sampler = WeightedRandomSampler([0.1, 0.2, 0, 0], 3)
+        with mock.patch('numpy.random.rand',
+                        return_value=np.ones(3)):
+            indices = list(sampler)
+        self.assertEqual([1, 1, 1], indices)
+
+    def test_without_replacement(self):
+        sampler = WeightedRandomSampler([1, 0, 5, 2, 1], 4,
+                                        replacement=False)
+        indices = list(sampler)
+        self.assertEqual([0, 2, 3, 4], sorted(indices))
+
+    def test_without_replacement_too_many_samples(self):
+        with self.assertRaises(ValueError):
+            WeightedRandomSampler([1, 0, 1], 3, replacement=False)
+
+    def test_invalid_weights(self):
+        with self.assertRaises(ValueError):
+            WeightedRandomSampler([0, 0], 1)
+        with self.assertRaises(ValueError):
+            WeightedRandomSampler([1, -1], 1)
+
+
+class TestClassBalancedSampler(unittest.TestCase):
+
+    def _dataset(self, labels):
+        dataset = DummyGulpDataset([len(labels)])
+        for (_, info), label in zip(dataset.items, labels):
+            info['meta_data'] = [{'label': label}]
+        dataset.label2idx = {'a': 0, 'b': 1}
+        return dataset
+
+    def test_label_array(self):
+        dataset = self._dataset(['a', 'b', 'b'])
+        labels = ClassBalancedSampler.label_array(dataset)
+        self.assertEqual([0, 1, 1], labels.tolist())
+
+    def test_balanced(self):
+        dataset = self._dataset(['a'] + ['b'] * 9)
+        np.random.seed(0)
+        sampler = ClassBalancedSampler(dataset, num_samples=2000)
+        self.assertEqual(2000, len(sampler))
+        drawn_a = sum(1 for i in sampler if i == 0)
+        self.assertTrue(800 < drawn_a < 1200)
+        self.assertEqual(10, len(ClassBalancedSampler(dataset)))
+
+
+class TestFeistelPermutation(unittest.TestCase):
+
+    def test_is_permutation(self):
+        for size in [1, 2, 7, 64, 1000]:
+            with self.subTest(size=size):
+                perm = FeistelPermutation(size, seed=size)
+                self.assertEqual(list(range(size)),
+                                 sorted(perm[i] for i in range(size)))
+
+    def test_seeded(self):
+        first = [FeistelPermutation(100, seed=1)[i] for i in range(100)]
+        again = [FeistelPermutation(100, seed=1)[i] for i in range(100)]
+        other = [FeistelPermutation(100, seed=2)[i] for i in range(100)]
+        self.assertEqual(first, again)
+        self.assertNotEqual(first, other)
+        self.assertNotEqual(list(range(100)), first)
+
+    def test_out_of_range(self):
+        with self.assertRaises(IndexError):
+            FeistelPermutation(10)[10]
+
+
+class TestPermutationSampler(unittest.TestCase):
+
+    def test_covers_dataset(self):
+        dataset = DummyGulpDataset([50])
+        sampler = PermutationSampler(dataset, seed=4)
+        self.assertEqual(list(range(50)), sorted(sampler))
+        self.assertEqual(50, len(sampler))
+
+    def test_set_epoch(self):
+        dataset = DummyGulpDataset([50])
+        sampler = PermutationSampler(dataset)
+        first = list(sampler)
+        sampler.set_epoch(1)
+        self.assertNotEqual(first, list(sampler))
+
+    def test_sharding(self):
+        dataset = DummyGulpDataset([10])
+        shards = [list(PermutationSampler(dataset, num_replicas=3, rank=r))
+                  for r in range(3)]
+        for shard in shards:
+            self.assertEqual(4, len(shard))
+        self.assertEqual(set(range(10)), set(sum(shards, [])))
+
+    def test_start(self):
+        dataset = DummyGulpDataset([20])
+        full = list(PermutationSampler(dataset, seed=7))
+        resumed = PermutationSampler(dataset, seed=7, start=15)
+        self.assertEqual(5, len(resumed))
+        self.assertEqual(full[15:], list(resumed))
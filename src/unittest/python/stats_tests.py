@@ -0,0 +1,91 @@
+import unittest
+
+import numpy as np
+
+from gulpio.stats import (IngestionStats,
+                          active_stats,
+                          recording,
+                          record_item,
+                          timed,
+                          )
+from gulpio.utils import resize_by_short_edge
+
+
+class TestIngestionStats(unittest.TestCase):
+
+    def test_slowest(self):
+        stats = IngestionStats(num_slowest=2)
+        for id_, seconds in [('a', 1.), ('b', 3.), ('c', 2.), ('d', 0.5)]:
+            stats.add_item(id_, seconds, 4, 100)
+        self.assertEqual(4, stats.items)
+        self.assertEqual(16, stats.frames)
+        self.assertEqual(400, stats.bytes)
+        report = stats.report(2.)
+        self.assertEqual(['b', 'c'],
+                         [item['id'] for item in report['slowest_items']])
+        self.assertEqual({'id': 'b', 'seconds': 3., 'frames': 4,
+                          'bytes': 100}, report['slowest_items'][0])
+
+    def test_report(self):
+        stats = IngestionStats()
+        stats.add_item('a', 1., 10, 1000)
+        stats.add_time('encode', 0.5)
+        report = stats.report(4.)
+        self.assertEqual(2.5, report['frames_per_second'])
+        self.assertEqual(250., report['bytes_per_second'])
+        self.assertEqual(100., report['bytes_per_frame'])
+        self.assertEqual(0.5, report['stage_seconds']['encode'])
+        self.assertEqual(0., report['stage_seconds']['read'])
+
+    def test_empty_report(self):
+        report = IngestionStats().report(0.)
+        self.assertEqual(0., report['frames_per_second'])
+        self.assertEqual(0., report['bytes_per_frame'])
+        self.assertEqual([], report['slowest_items'])
+
+    def test_merge(self):
+        stats, other = IngestionStats(num_slowest=2), IngestionStats()
+        stats.add_item('a', 1., 1, 10)
+        stats.add_time('read', 1.)
+        other.add_item('b', 2., 2, 20)
+        other.add_item('c', 3., 3, 30)
+        other.add_time('read', 2.)
+        stats.merge(other.state())
+        self.assertEqual((3, 6, 60), (stats.items, stats.frames,
+                                      stats.bytes))
+        self.assertEqual(3., stats.stage_seconds['read'])
+        self.assertEqual(['c', 'b'], [item['id'] for item in
+                                      stats.report(1.)['slowest_items']])
+
+    def test_pop_state(self):
+        stats = IngestionStats()
+        stats.add_item('a', 1., 1, 10)
+        self.assertIsNone(stats.pop_state(min_interval=60.))
+        state = stats.pop_state()
+        self.assertEqual(1, state['items'])
+        self.assertEqual(0, stats.items)
+        self.assertEqual([], stats.slowest)
+
+
+class TestRecording(unittest.TestCase):
+
+    def test_timers_do_nothing_outside_recording(self):
+        self.assertIsNone(active_stats())
+        with timed('read'):
+            pass
+        record_item('a', 1., 1, 1)
+
+    def test_recording(self):
+        with recording() as stats:
+            self.assertIs(stats, active_stats())
+            with recording() as inner:
+                record_item('a', 1., 2, 3)
+            self.assertIs(stats, active_stats())
+            with timed('read'):
+                pass
+            resize_by_short_edge(np.zeros((4, 8, 3), dtype='uint8'), 2)
+        self.assertIsNone(active_stats())
+        self.assertEqual(0, stats.items)
+        self.assertEqual(1, inner.items)
+        self.assertGreater(stats.stage_seconds['read'], 0.)
+        self.assertGreater(stats.stage_seconds['resize'], 0.)
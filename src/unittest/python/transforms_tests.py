@@ -1,3 +1,5 @@
+import random
+import pickle
 import numpy as np
 import unittest
 from gulpio.transforms import Scale
@@ -8,6 +10,15 @@ from gulpio.transforms import CenterCrop
 from gulpio.transforms import RandomCropVideo, RandomCrop
 from gulpio.transforms import JitterCropVideo, JitterCrop
 from gulpio.transforms import ComposeVideo, Compose
+from gulpio.transforms import CropResizeNormalize
+from gulpio.transforms import optimize_transforms, defer_normalize
+from gulpio.transforms import DecodeCrop
+from gulpio.transforms import (RandHorFlipBatch, RandVerFlipBatch,
+                               CenterCropBatch, RandomCropBatch,
+                               NormalizeBatch)
+from gulpio.transforms import (RandHorFlipClip, RandVerFlipClip,
+                               CenterCropClip, RandomCropClip,
+                               JitterCropClip, ScaleClip, MultiCropClip)
 
 
 class TestTransforms(unittest.TestCase):
@@ -70,6 +81,46 @@ class TestTransforms(unittest.TestCase):
         print(img.mean())
         assert img.mean() > 1 - 1e-3 and img.mean() < 1 + 1e-3
 
+    def test_cropresizenormalize(self):
+        img = self._img()
+        mean, std = [100, 110, 120], [50, 60, 70]
+        fused = CropResizeNormalize((20, 10), mean, std, crop_size=(40, 30))
+        out = fused(img)
+        self.assertEqual(np.float32, out.dtype)
+        self.assertEqual((20, 10, 3), out.shape)
+        expected = Compose([CenterCrop((40, 30)), Scale((10, 20)),
+                            Normalize(mean, std)])(img)
+        np.testing.assert_allclose(expected, out, rtol=1e-5, atol=1e-5)
+
+        out = CropResizeNormalize(30, mean, std, random_crop=True,
+                                  crop_size=30, dtype=np.float16)(img)
+        self.assertEqual(np.float16, out.dtype)
+        self.assertEqual((30, 30, 3), out.shape)
+
+        out = CropResizeNormalize(10, [0.5], [0.5])(self._img_gray())
+        self.assertEqual((10, 10), out.shape)
+        with self.assertRaises(ValueError):
+            CropResizeNormalize(10, mean, std, crop_size=200)(img)
+
+    def test_decodecrop(self):
+        decode_crop = DecodeCrop(crop_size=(100, 120), size=20)
+        plan = decode_crop.plan(200, 300)
+        # the crop can be decoded at 1/4 scale and still cover 20 pixels
+        self.assertEqual(4, plan.reduce)
+        self.assertEqual((12, 22, 25, 30), plan.box)
+        self.assertEqual((20, 20), plan.size)
+        self.assertEqual(1, decode_crop.plan(200, 300, reduced=False).reduce)
+        # the crop is clipped to the image
+        self.assertEqual((0, 0, 10, 10), DecodeCrop(32).plan(10, 10).box)
+        # every frame of a clip gets the same crop
+        video = [self._img()] * 5
+        out = DecodeCrop(crop_size=30, random_crop=True)(video)
+        self.assertEqual((30, 30, 3), out[0].shape)
+        for img in out[1:]:
+            np.testing.assert_array_equal(out[0], img)
+        self.assertEqual((20, 10, 3),
+                         DecodeCrop(size=(20, 10))(self._img()).shape)
+
     def test_unitnorm(self):
         img = np.ones([120, 120, 3])
         norm = UnitNorm()
@@ -132,6 +183,18 @@ class TestTransforms(unittest.TestCase):
         vid = self._video(10)
         vid = compose(vid)
 
+    def test_composevideo_threads(self):
+        img_transforms = [Scale(40), CenterCrop(30)]
+        video = self._video(10)
+        expected = ComposeVideo(img_transforms)(list(video))
+        compose = ComposeVideo(img_transforms, num_threads=4)
+        np.testing.assert_array_equal(np.stack(expected),
+                                      np.stack(compose(list(video))))
+        # the pool is not pickled, but recreated on demand
+        compose = pickle.loads(pickle.dumps(compose))
+        np.testing.assert_array_equal(np.stack(expected),
+                                      np.stack(compose(list(video))))
+
     def test_compose(self):
         transforms = [CenterCrop(30)]
         compose = Compose(transforms)
@@ -140,3 +203,253 @@ class TestTransforms(unittest.TestCase):
         compose = ComposeVideo()
         img = self._img()
         img = compose(img)
+
+
+class TestClipTransforms(unittest.TestCase):
+
+    def _clip(self, length):
+        return np.random.randint(0, 255, [length, 60, 120, 3]).astype('uint8')
+
+    def test_randhorflipclip(self):
+        clip = self._clip(4)
+        flip = RandHorFlipClip()
+        flipped = [flip(clip) for _ in range(20)]
+        for out in flipped:
+            self.assertEqual(clip.shape, out.shape)
+            self.assertTrue(np.shares_memory(clip, out))
+        self.assertTrue(any((out == clip[:, :, ::-1]).all()
+                            for out in flipped))
+
+    def test_randverflipclip(self):
+        clip = self._clip(4)
+        flip = RandVerFlipClip()
+        flipped = [flip(clip) for _ in range(20)]
+        self.assertTrue(any((out == clip[:, ::-1]).all() for out in flipped))
+        self.assertTrue(any((out == clip).all() for out in flipped))
+
+    def test_centercropclip(self):
+        clip = self._clip(4)
+        out = CenterCropClip(20)(clip)
+        self.assertEqual((4, 20, 20, 3), out.shape)
+        np.testing.assert_array_equal(clip[:, 20:40, 50:70], out)
+        # the same crop as the per frame transform
+        np.testing.assert_array_equal(CenterCrop(20)(clip[1]), out[1])
+
+    def test_randomcropclip(self):
+        clip = self._clip(4)
+        out = RandomCropClip(30)(list(clip))
+        self.assertEqual((4, 30, 30, 3), out.shape)
+        out = RandomCropClip((60, 120), padding=2)(clip)
+        self.assertEqual((4, 60, 120, 3), out.shape)
+
+    def test_jittercropclip(self):
+        clip = self._clip(4)
+        out = JitterCropClip([30, 20])(clip)
+        self.assertIn(out.shape[1], [20, 30])
+        self.assertIn(out.shape[2], [20, 30])
+        self.assertEqual(4, len(out))
+
+    def test_scaleclip(self):
+        clip = self._clip(4)
+        out = ScaleClip(30)(clip)
+        self.assertEqual((4, 30, 60, 3), out.shape)
+        for frame, frame_out in zip(clip, out):
+            np.testing.assert_array_equal(Scale((60, 30))(frame), frame_out)
+        out = ScaleClip((20, 10))(clip[..., 0])
+        self.assertEqual((4, 10, 20), out.shape)
+        self.assertIs(clip, ScaleClip(60)(clip))
+
+    def test_multicropclip(self):
+        clip = self._clip(4)
+        views = MultiCropClip(40)(clip)
+        self.assertEqual((10, 4, 40, 40, 3), views.shape)
+        self.assertTrue(views.flags.c_contiguous)
+        np.testing.assert_array_equal(clip[:, :40, :40], views[0])
+        np.testing.assert_array_equal(clip[:, 20:, 80:], views[3])
+        np.testing.assert_array_equal(clip[:, 10:50, 40:80], views[4])
+        np.testing.assert_array_equal(views[4][:, :, ::-1], views[9])
+        views = MultiCropClip(60, num_crops=3, flip=True)(clip)
+        self.assertEqual((6, 4, 60, 60, 3), views.shape)
+        np.testing.assert_array_equal(clip[:, :, 60:], views[2])
+        self.assertEqual((1, 4, 20, 30, 3),
+                         MultiCropClip((20, 30), num_crops=1)(clip).shape)
+        with self.assertRaises(ValueError):
+            MultiCropClip(40, num_crops=4)
+
+    def test_compose_clip_transforms(self):
+        compose = Compose([ScaleClip(40), RandomCropClip(30),
+                           RandHorFlipClip()])
+        out = compose(list(self._clip(6)))
+        self.assertEqual((6, 30, 30, 3), out.shape)
+
+
+class TestBatchTransforms(unittest.TestCase):
+
+    def _batch(self):
+        return np.random.randint(0, 255, [6, 4, 12, 10, 3]).astype('uint8')
+
+    def test_randhorflipbatch(self):
+        batch = self._batch()
+        original = batch.copy()
+        np.random.seed(1)
+        out = RandHorFlipBatch()(batch)
+        self.assertIs(batch, out)
+        flipped = [(out[i] == original[i][:, :, ::-1]).all()
+                   for i in range(len(out))]
+        kept = [(out[i] == original[i]).all() for i in range(len(out))]
+        self.assertTrue(all(np.logical_or(flipped, kept)))
+        self.assertTrue(any(flipped) and any(kept))
+
+    def test_randverflipbatch(self):
+        batch = self._batch()
+        original = batch.copy()
+        out = RandVerFlipBatch(p=1)(batch)
+        np.testing.assert_array_equal(original[:, :, ::-1], out)
+
+    def test_centercropbatch(self):
+        batch = self._batch()
+        out = CenterCropBatch((6, 4))(batch)
+        self.assertEqual((6, 4, 6, 4, 3), out.shape)
+        np.testing.assert_array_equal(batch[:, :, 3:9, 3:7], out)
+
+    def test_randomcropbatch(self):
+        batch = self._batch()
+        out = RandomCropBatch(5)(batch)
+        self.assertEqual((6, 4, 5, 5, 3), out.shape)
+        for sample, cropped in zip(batch, out):
+            self.assertTrue(any(
+                (sample[:, y:y + 5, x:x + 5] == cropped).all()
+                for y in range(8) for x in range(6)))
+        with self.assertRaises(ValueError):
+            RandomCropBatch(11)(batch)
+
+    def test_normalizebatch(self):
+        batch = self._batch()
+        mean, std = [100, 110, 120], [50, 60, 70]
+        expected = (batch - np.array(mean)) / np.array(std)
+        out = NormalizeBatch(mean, std)(batch)
+        self.assertEqual(np.float32, out.dtype)
+        np.testing.assert_allclose(expected, out, rtol=1e-5, atol=1e-5)
+        # float32 batches are normalized in place
+        batch = batch.astype(np.float32)
+        self.assertIs(batch, NormalizeBatch(mean, std)(batch))
+
+
+class TestOptimizeTransforms(unittest.TestCase):
+
+    def _img(self):
+        return np.random.randint(0, 255, [120, 90, 3]).astype('uint8')
+
+    def _run(self, transforms, img, seed=0):
+        random.seed(seed)
+        return transforms(img.copy())
+
+    def test_plan(self):
+        normalize = Normalize([1, 2, 3], [4, 5, 6])
+        crop = RandomCrop(10)
+        plan = optimize_transforms([normalize, crop, CenterCrop(8),
+                                    CenterCrop(5), CenterCrop(3)])
+        self.assertEqual(3, len(plan))
+        self.assertIs(crop, plan[0])
+        self.assertEqual([8, 5, 3], [c.size[0] for c in plan[1].crops])
+        self.assertIs(normalize, plan[2].normalize)
+        # padded crops do not commute with normalization
+        padded = RandomCrop(10, padding=2)
+        plan = optimize_transforms([normalize, padded])
+        self.assertIs(padded, plan[1])
+
+    def test_compose_exact(self):
+        transforms = [Normalize([100, 110, 120], [50, 60, 70]),
+                      RandomCrop((61, 41)), CenterCrop(40), CenterCrop(21)]
+        img = self._img()
+        for seed in range(5):
+            expected = self._run(Compose(transforms), img, seed)
+            received = self._run(Compose(transforms, optimize=True), img,
+                                 seed)
+            np.testing.assert_array_equal(expected, received)
+        gray = img[..., 0]
+        transforms = [Normalize(0.5, 0.5), CenterCrop(30)]
+        np.testing.assert_array_equal(
+            Compose(transforms)(gray),
+            Compose(transforms, optimize=True)(gray))
+
+    def test_compose_approximate(self):
+        # a smooth image
+        y, x = np.mgrid[0:120, 0:90]
+        img = np.stack([x * 2, y * 2, x + y], axis=-1).astype('uint8')
+        for crop in [CenterCrop(30), RandomCrop(25)]:
+            transforms = [Scale(40), crop]
+            optimized = Compose(transforms, optimize='approximate')
+            self.assertNotIsInstance(optimized.plan[0], Scale)
+            for seed in range(5):
+                expected = self._run(Compose(transforms), img, seed)
+                received = self._run(optimized, img, seed)
+                self.assertEqual(expected.shape, received.shape)
+                diff = np.abs(expected.astype(int) - received)
+                self.assertLessEqual(diff.max(), 4)
+        self.assertIsInstance(Compose([Scale(40), CenterCrop(30)],
+                                      optimize=True).plan[0], Scale)
+
+    def test_compose_approximate_bound(self):
+        # random noise and hard black/white edges are the worst case
+        rng = np.random.RandomState(0)
+        noise = rng.randint(0, 256, (97, 131, 3)).astype('uint8')
+        edges = (rng.rand(83, 61, 1) > 0.5).repeat(3, 2).astype('uint8')
+        worst = 0
+        for img in [noise, edges * 255]:
+            for size, crop_size in [(40, 30), (150, 64), (57, 13), (23, 23)]:
+                for crop in [CenterCrop(crop_size), RandomCrop(crop_size)]:
+                    transforms = [Scale(size), crop]
+                    optimized = Compose(transforms, optimize='approximate')
+                    for seed in range(3):
+                        expected = self._run(Compose(transforms), img, seed)
+                        received = self._run(optimized, img, seed)
+                        self.assertEqual(expected.shape, received.shape)
+                        diff = np.abs(expected.astype(int) - received)
+                        worst = max(worst, diff.max())
+        self.assertLessEqual(worst, 9)
+
+    def test_compose_video(self):
+        img_transforms = [Normalize([100, 110, 120], [50, 60, 70])]
+        video_transforms = [RandHorFlipVideo(), RandomCropVideo(30),
+                            JitterCropVideo([20, 10])]
+        video = [self._img() for _ in range(4)]
+        optimized = ComposeVideo(img_transforms, video_transforms,
+                                 optimize=True)
+        self.assertEqual(3, len(optimized.pre_video_plan))
+        for seed in range(5):
+            expected = self._run(ComposeVideo(img_transforms,
+                                              video_transforms),
+                                 list(video), seed)
+            received = self._run(optimized, list(video), seed)
+            np.testing.assert_array_equal(np.stack(expected),
+                                          np.stack(received))
+
+
+class TestDeferNormalize(unittest.TestCase):
+
+    def test_compose_video(self):
+        normalize = Normalize([100, 110, 120], [50, 60, 70])
+        transform = ComposeVideo([normalize], [RandHorFlipVideo(),
+                                               RandomCropVideo(20)])
+        remaining, batch_normalize = defer_normalize(transform)
+        self.assertEqual([], remaining.img_transforms)
+        video = [np.random.randint(0, 255, [30, 40, 3]).astype('uint8')
+                 for _ in range(4)]
+        random.seed(0)
+        expected = np.stack(transform(list(video)))
+        random.seed(0)
+        clip = np.stack(remaining(list(video)))
+        self.assertEqual(np.uint8, clip.dtype)
+        received = batch_normalize(clip[np.newaxis])[0]
+        np.testing.assert_allclose(expected, received, rtol=1e-5, atol=1e-5)
+
+    def test_not_deferrable(self):
+        normalize = Normalize([100, 110, 120], [50, 60, 70])
+        # Scale does not commute with Normalize
+        transform = Compose([normalize, Scale(10)])
+        self.assertEqual((transform, None), defer_normalize(transform))
+        self.assertEqual((None, None), defer_normalize(None))
+        remaining, batch_normalize = defer_normalize(normalize)
+        self.assertIsNone(remaining)
+        np.testing.assert_array_equal(normalize.mean, batch_normalize.mean)
@@ -1,7 +1,9 @@
 import os
 import tempfile
 import shutil
+import struct
 
+import cv2
 import numpy as np
 
 import unittest
@@ -13,9 +15,29 @@ from gulpio.utils import (check_ffmpeg_exists,
                           resize_images,
                           get_single_video_path,
                           temp_dir_for_bursting,
+                          get_jpeg_size,
+                          get_jpeg_orientation,
+                          read_video_frames,
+                          load_encoded_image,
+                          is_complete_jpeg,
+                          parse_byte_size,
+                          parse_shard,
+                          ImageNotFound,
+                          FFMPEGError,
                           )
 
 
+def with_orientation(jpeg, orientation, order=b'MM'):
+    """ Insert an APP1 EXIF segment with the orientation tag after SOI. """
+    fmt = '>' if order == b'MM' else '<'
+    tiff = (order + struct.pack(fmt + 'HIH', 0x2a, 8, 1) +
+            struct.pack(fmt + 'HHIHH', 0x0112, 3, 1, orientation, 0) +
+            struct.pack(fmt + 'I', 0))
+    payload = b'Exif\0\0' + tiff
+    return (jpeg[:2] + b'\xff\xe1' + struct.pack('>H', len(payload) + 2) +
+            payload + jpeg[2:])
+
+
 class FSBase(unittest.TestCase):
 
     def setUp(self):
@@ -67,6 +89,50 @@ class TestBurstVideoIntoFrames(unittest.TestCase):
         self.assertEqual(39, len(imgs))
 
 
+class TestReadVideoFrames(unittest.TestCase):
+
+    def test_mp4(self):
+        video_path = os.path.join(os.path.dirname(__file__), 'test.mp4')
+        frames = list(read_video_frames(video_path))
+        # different ffmpeg versions, yield slightly different numbers
+        self.assertIn(len(frames), [140, 141])
+        self.assertEqual((144, 256, 3), frames[0].shape)
+        self.assertEqual(np.uint8, frames[0].dtype)
+
+    def test_same_frames_as_bursting(self):
+        video_path = os.path.join(os.path.dirname(__file__), 'test.webm')
+        frames = list(read_video_frames(video_path, frame_rate=8,
+                                        img_size=64))
+        with temp_dir_for_bursting() as temp_burst_dir:
+            imgs = list(resize_images(
+                burst_video_into_frames(video_path, temp_burst_dir,
+                                        frame_rate=8), 64))
+        self.assertEqual(len(imgs), len(frames))
+        for img, frame in zip(imgs, frames):
+            self.assertEqual(img.shape, frame.shape)
+        # the bursted frames went through a lossy JPEG round trip
+        difference = np.abs(imgs[10].astype(int) - frames[10]).mean()
+        self.assertLess(difference, 5)
+
+    def test_missing_file(self):
+        with self.assertRaisesRegex(FFMPEGError, 'ANY_MISSING.mp4'):
+            list(read_video_frames('ANY_MISSING.mp4'))
+
+    def test_corrupt_file(self):
+        with tempfile.NamedTemporaryFile(suffix='.mp4') as fp:
+            fp.write(b'NOT A VIDEO')
+            fp.flush()
+            with self.assertRaises(FFMPEGError):
+                list(read_video_frames(fp.name))
+
+    def test_close_early(self):
+        video_path = os.path.join(os.path.dirname(__file__), 'test.mp4')
+        frames = read_video_frames(video_path)
+        next(frames)
+        # ffmpeg is killed, which is not an error
+        frames.close()
+
+
 class TestResizeImages(unittest.TestCase):
 
     @mock.patch('cv2.imread')
@@ -115,3 +181,139 @@ class TestGetSingleVideoPath(FSBase):
 
     def test_video_doesnt_exists(self):
         self.assertRaises(AssertionError, get_single_video_path, 'ANY_PATH')
+
+
+class TestGetJpegSize(unittest.TestCase):
+
+    def test_color_and_grayscale(self):
+        for shape, expected in [((37, 53, 3), (37, 53, 3)),
+                                ((20, 11), (20, 11, 1))]:
+            data = cv2.imencode('.jpg', np.zeros(shape, dtype='uint8'))[1]
+            self.assertEqual(expected, get_jpeg_size(data.tobytes()))
+
+    def test_not_a_jpeg(self):
+        data = cv2.imencode('.png', np.zeros((3, 3), dtype='uint8'))[1]
+        self.assertIsNone(get_jpeg_size(data.tobytes()))
+        jpeg = cv2.imencode('.jpg', np.zeros((3, 3), dtype='uint8'))[1]
+        self.assertIsNone(get_jpeg_size(jpeg.tobytes()[:20]))
+
+    def test_with_exif(self):
+        data = cv2.imencode('.jpg', np.zeros((16, 40, 3), dtype='uint8'))[1]
+        self.assertEqual((16, 40, 3),
+                         get_jpeg_size(with_orientation(data.tobytes(), 6)))
+
+
+class TestGetJpegOrientation(unittest.TestCase):
+
+    def setUp(self):
+        image = np.zeros((16, 40, 3), dtype='uint8')
+        self.jpeg = cv2.imencode('.jpg', image)[1].tobytes()
+
+    def test_no_exif(self):
+        self.assertEqual(1, get_jpeg_orientation(self.jpeg))
+
+    def test_orientation(self):
+        for order in [b'MM', b'II']:
+            for orientation in range(1, 9):
+                data = with_orientation(self.jpeg, orientation, order)
+                self.assertEqual(orientation, get_jpeg_orientation(data))
+
+    def test_invalid_orientation(self):
+        self.assertEqual(1, get_jpeg_orientation(
+            with_orientation(self.jpeg, 42)))
+
+    def test_matches_imdecode(self):
+        for orientation in [1, 6, 8]:
+            data = with_orientation(self.jpeg, orientation)
+            shape = cv2.imdecode(np.frombuffer(data, dtype='uint8'),
+                                 cv2.IMREAD_COLOR).shape
+            expected = (40, 16, 3) if orientation >= 5 else (16, 40, 3)
+            self.assertEqual(expected, shape)
+
+
+class TestLoadEncodedImage(FSBase):
+
+    def test_jpeg_is_passed_through(self):
+        path = os.path.join(self.temp_dir, 'ANY_IMAGE.jpg')
+        cv2.imwrite(path, np.zeros((5, 7, 3), dtype='uint8'))
+        data = load_encoded_image(path)
+        self.assertIsInstance(data, bytes)
+        self.assertEqual(open(path, 'rb').read(), data)
+
+    def test_other_formats_are_decoded(self):
+        path = os.path.join(self.temp_dir, 'ANY_IMAGE.png')
+        cv2.imwrite(path, np.ones((5, 7, 3), dtype='uint8'))
+        np.testing.assert_array_equal(np.ones((5, 7, 3)),
+                                      load_encoded_image(path))
+
+    def test_missing_image(self):
+        with self.assertRaises(ImageNotFound):
+            load_encoded_image(os.path.join(self.temp_dir, 'ANY_IMAGE.jpg'))
+
+    def _jpeg(self):
+        rng = np.random.RandomState(0)
+        return cv2.imencode('.jpg', rng.randint(0, 256, (16, 24, 3))
+                            .astype('uint8'))[1].tobytes()
+
+    def _write(self, data):
+        path = os.path.join(self.temp_dir, 'ANY_IMAGE.jpg')
+        with open(path, 'wb') as fp:
+            fp.write(data)
+        return path
+
+    def test_truncated_jpeg_is_reencoded(self):
+        jpeg = self._jpeg()
+        # cut off within the image data
+        img = load_encoded_image(self._write(
+            jpeg[:jpeg.index(b'\xff\xda') + 100]))
+        self.assertIsInstance(img, np.ndarray)
+        self.assertEqual((16, 24, 3), img.shape)
+
+    def test_validate(self):
+        # a complete header and end marker, but no image data
+        jpeg = self._jpeg()
+        path = self._write(jpeg[:jpeg.index(b'\xff\xda')] + b'\xff\xd9')
+        self.assertIsInstance(load_encoded_image(path), bytes)
+        with self.assertRaises(ImageNotFound):
+            load_encoded_image(path, validate=True)
+        self.assertEqual(jpeg, load_encoded_image(self._write(jpeg),
+                                                  validate=True))
+
+
+class TestIsCompleteJpeg(unittest.TestCase):
+
+    def test_complete(self):
+        jpeg = cv2.imencode('.jpg', np.zeros((4, 4, 3), dtype='uint8'))[1]
+        jpeg = jpeg.tobytes()
+        self.assertTrue(is_complete_jpeg(jpeg))
+        # padded like a gulp record
+        self.assertTrue(is_complete_jpeg(jpeg + b'\0\0\0'))
+        self.assertFalse(is_complete_jpeg(jpeg[:-2]))
+        self.assertFalse(is_complete_jpeg(b'ANY_BYTES\xff\xd9'))
+
+
+class TestParseByteSize(unittest.TestCase):
+
+    def test_parse(self):
+        self.assertEqual(4096, parse_byte_size(4096))
+        self.assertEqual(4096, parse_byte_size('4096'))
+        self.assertEqual(512 * 1024 ** 2, parse_byte_size('512M'))
+        self.assertEqual(2 * 1024 ** 3, parse_byte_size('2gb'))
+        self.assertEqual(1536, parse_byte_size('1.5K'))
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            parse_byte_size('many')
+
+
+class TestParseShard(unittest.TestCase):
+
+    def test_parse(self):
+        self.assertEqual((0, 4), parse_shard('0/4'))
+        self.assertEqual((3, 4), parse_shard('3/4'))
+
+    def test_invalid(self):
+        for shard in ['4/4', '-1/4', '1', 'a/b']:
+            with self.subTest(shard=shard):
+                with self.assertRaises(ValueError):
+                    parse_shard(shard)